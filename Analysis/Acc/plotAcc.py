@@ -1,10 +1,15 @@
 import matplotlib.pyplot as plt
 import pandas as pd
-import json
 import re
 import numpy as np
 import matplotlib.cm as cm
 import random
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
+
+from sparch.results import ResultsStore
 
 # Define a color mapping for specific model types
 color_map = {
@@ -41,19 +46,6 @@ plt.rcParams.update({
 def random_color():
     return "#{:02x}{:02x}{:02x}".format(random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
 
-# Function to save results to JSON
-def save_results_to_json(result_entry, filename='resultsSHD.json'):
-    try:
-        with open(filename, 'r') as file:
-            results = json.load(file)
-    except FileNotFoundError:
-        results = []
-
-    results.append(result_entry)
-    
-    with open(filename, 'w') as file:
-        json.dump(results, file, indent=4)
-
 # Function to combine LIFcomplex and LIFcomplexDiscr by taking the maximum accuracy for each X value
 def combine_lif_complex(df):
     lif_complex = df[df['model_type'] == 'LIFcomplex']
@@ -183,12 +175,10 @@ def plot_results(df, model_types_to_plot, save_dir, plotMax, layers_to_plot, neu
     plt.close()
     print(f"Plot saved as {filename}")
 
-def load_results_from_json(filename='resultsSHD.json'):
-    try:
-        with open(filename, 'r') as file:
-            return json.load(file)
-    except FileNotFoundError:
-        return []
+def load_results(ds, model_types_to_plot, filename='../../results.db'):
+    # Only the results of the plotted models are read from the store
+    store = ResultsStore(filename)
+    return store.query(dataset_name=ds.lower(), model_type=model_types_to_plot)
     
 def generate_filename(model_types_to_plot):
     sanitized_names = [re.sub(r'\W+', '', model) for model in model_types_to_plot]
@@ -198,8 +188,6 @@ def generate_filename(model_types_to_plot):
 def main():
     ds = "SSC"
     save_dir = '../../plots/'+str(ds)+'/Acc/'
-    results = load_results_from_json(filename='../../results'+str(ds)+'.json')
-    df = pd.DataFrame(results)
 
     plotMax = True
     broader_linewidth = True
@@ -215,6 +203,7 @@ def main():
                            # "RadLIF", "LIFcomplex", "RLIFcomplex1MinAlpha", "adLIFclamp", "LIFcomplexDiscr"]
     layers_to_plot = [2, 3, 4, 5, 6,7,8,9,10]
     neurons_to_plot = [64,128,256,512,1024, 2048,3072,4096]
+    df = pd.DataFrame(load_results(ds, model_types_to_plot))
     plot_results(df, model_types_to_plot, save_dir, plotMax, layers_to_plot,neurons_to_plot,broader_linewidth)
 
 
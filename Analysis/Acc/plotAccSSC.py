@@ -1,23 +1,14 @@
-import json
 import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 import numpy as np
 import re
+import os
+import sys
 
-# Function to save results to JSON
-def save_results_to_json(result_entry, filename='resultsSHD.json'):
-    try:
-        with open(filename, 'r') as file:
-            results = json.load(file)
-    except FileNotFoundError:
-        results = []
-
-    results.append(result_entry)
-    
-    with open(filename, 'w') as file:
-        json.dump(results, file, indent=4)
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
 
+from sparch.results import ResultsStore
 
 # Plot
 def plot_results(df, model_types_to_plot,  save_dir, plotMax):
@@ -81,12 +72,10 @@ def plot_results(df, model_types_to_plot,  save_dir, plotMax):
     print(f"Plot saved as {filename}")
 
 
-def load_results_from_json(filename='resultsSHD.json'):
-    try:
-        with open(filename, 'r') as file:
-            return json.load(file)
-    except FileNotFoundError:
-        return []
+def load_results(ds, model_types_to_plot, filename='../../results.db'):
+    # Only the results of the plotted models are read from the store
+    store = ResultsStore(filename)
+    return store.query(dataset_name=ds.lower(), model_type=model_types_to_plot)
     
 def generate_filename(model_types_to_plot):
     sanitized_names = [re.sub(r'\W+', '', model) for model in model_types_to_plot]
@@ -96,13 +85,12 @@ def generate_filename(model_types_to_plot):
 def main():
     ds = "SSC"
     save_dir = '../../plots/'+str(ds)+'/Acc/'
-    results = load_results_from_json(filename='../../results'+str(ds)+'.json')
-    df = pd.DataFrame(results)
 
     plotMax = False
     
     model_types_to_plot = [ "LIFcomplex"]
 
+    df = pd.DataFrame(load_results(ds, model_types_to_plot))
     plot_results(df, model_types_to_plot, save_dir, plotMax)
 
 
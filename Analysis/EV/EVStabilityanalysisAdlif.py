@@ -1,4 +1,10 @@
 import torch
+import sys
+import os
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
+
+from sparch.models.weights import load_model
 
 def compute_eigenvalues(alpha, beta, a):
     # Construct the 2x2 matrix
@@ -10,7 +16,7 @@ def compute_eigenvalues(alpha, beta, a):
 
 def find_problematic_values(model_path):
     # Load the model
-    model = torch.load(model_path, map_location=torch.device('cpu'))
+    model = load_model(model_path, map_location=torch.device('cpu'))
     
     # If the model is wrapped in a checkpoint dictionary, extract the actual model
     if isinstance(model, dict) and 'model' in model:
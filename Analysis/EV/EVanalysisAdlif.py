@@ -3,6 +3,11 @@ import torch.nn as nn
 import numpy as np
 import matplotlib.pyplot as plt
 import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
+
+from sparch.models.weights import load_model
 
 def compute_eigenvalues(alpha, beta, a):
     # Construct the 2x2 matrix
@@ -47,7 +52,7 @@ def plot_eigenvalues_distribution(layer_data, save_dir):
 
 def analyze_eigenvalues(model_path, save_dir):
     # Load the model
-    model = torch.load(model_path, map_location=torch.device('cpu'))
+    model = load_model(model_path, map_location=torch.device('cpu'))
     
     # If the model is wrapped in a checkpoint dictionary, extract the actual model
     if isinstance(model, dict) and 'model' in model:
@@ -2,6 +2,11 @@ import torch
 import torch.nn as nn
 import matplotlib.pyplot as plt
 import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
+
+from sparch.models.weights import load_model
 
 def compute_alpha(log_log_alpha, alpha_img, log_dt):
     log_log_alpha = log_log_alpha.float()
@@ -50,7 +55,7 @@ def plot_distribution(layer_data, save_path):
 
 def print_model_parameters(model_path):
     # Load the model
-    model = torch.load(model_path, map_location=torch.device('cpu'))
+    model = load_model(model_path, map_location=torch.device('cpu'))
     
     # If the model is wrapped in a checkpoint dictionary, extract the actual model
     if isinstance(model, dict) and 'model' in model:
@@ -62,7 +67,7 @@ def print_model_parameters(model_path):
 
 def analyze_alpha_parameters(model_path, save_dir):
     # Load the model
-    model = torch.load(model_path, map_location=torch.device('cpu'))
+    model = load_model(model_path, map_location=torch.device('cpu'))
     
     # If the model is wrapped in a checkpoint dictionary, extract the actual model
     if isinstance(model, dict) and 'model' in model:
@@ -5,22 +5,22 @@ import os
 import torch
 from matplotlib.patches import Rectangle
 from matplotlib.lines import Line2D
-from sympy import symbols, Eq, solve, sqrt, pi
 
 # Adjust the path to include the project_root directory
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
 
 from sparch.models.snns import SNN
+from sparch.models.weights import load_model
 from sparch.models.snns import LIFcomplexLayer, adLIFclampLayer, BRFLayer, ResonateFireLayer
 
 
 model_path = '../../exp/test_exps/shd_LIFcomplex_3lay512_drop0_1_batchnorm_nobias_udir_noreg_lr0_01/checkpoints/best_model.pth'
 #model_path = '../../exp/paper_models/ssc_LIFcomplex_3lay512_/checkpoints/best_model.pth'
-trained_net_cmplx = torch.load(model_path)
+trained_net_cmplx = load_model(model_path)
 model_path = '../../exp/test_exps/shd_adLIFclamp_3lay512_drop0_1_batchnorm_nobias__/checkpoints/best_model.pth'
-trained_net_adLIF = torch.load(model_path)
+trained_net_adLIF = load_model(model_path)
 model_path = '../../SHD_runs/exp/paper_models/shd_ResonateFire_3lay512_/checkpoints/best_model.pth'
-trained_net_rf = torch.load(model_path)
+trained_net_rf = load_model(model_path)
 
 
 def find_system_eigenvalues_numeric(tau_m_array, tau_w_array, R_array, a_w_array):
@@ -36,6 +36,8 @@ def find_system_eigenvalues_numeric(tau_m_array, tau_w_array, R_array, a_w_array
 
 
 def compute_rat_R_a(real_value, img_value, tau_m=0.01):
+    # sympy is slow to import, only needed here
+    from sympy import symbols, Eq, solve, sqrt
     rat, R_a = symbols('rat R_a')
     eq1 = Eq(-(rat + 1) / (2 * tau_m), real_value)
     eq2 = Eq(sqrt((rat**2 - 2*rat + 1 - 4*R_a * rat)*(-1)) / (2 * tau_m), img_value)
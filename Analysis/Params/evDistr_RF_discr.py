@@ -5,12 +5,12 @@ import os
 import torch
 from matplotlib.patches import Rectangle
 from matplotlib.lines import Line2D
-from sympy import symbols, Eq, solve, sqrt, pi
 
 # Adjust the path to include the project_root directory
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
 
 from sparch.models.snns import SNN
+from sparch.models.weights import load_model
 from sparch.models.snns import LIFcomplexLayer, adLIFclampLayer, BRFLayer, ResonateFireLayer
 
 dataset_name = "shd"
@@ -59,7 +59,7 @@ net = SNN(
 model_path = '../../SHD_runs/exp/paper_models/shd_ResonateFire_3lay512_/checkpoints/best_model.pth'
 
 
-trained_net = torch.load(model_path)
+trained_net = load_model(model_path)
 
 def plot_eigenvalue_distribution():
     R = 1  # You may adjust this value for different systems
@@ -133,6 +133,8 @@ def compute_alpha(log_log_alpha, alpha_img, log_dt):
     return alpha
 
 def compute_rat_R_a(real_value, img_value, tau_m=0.01):
+    # sympy is slow to import, only needed here
+    from sympy import symbols, Eq, solve, sqrt
     rat, R_a = symbols('rat R_a')
     eq1 = Eq(-(rat + 1) / (2 * tau_m), real_value)
     eq2 = Eq(sqrt((rat**2 - 2*rat + 1 - 4*R_a * rat)*(-1)) / (2 * tau_m), img_value)
@@ -9,6 +9,7 @@ from matplotlib.patches import Circle
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
 
 from sparch.models.snns import SNN
+from sparch.models.weights import load_model
 from sparch.models.snns import LIFcomplexLayer
 
 dataset_name = "SHD"
@@ -54,7 +55,7 @@ net = SNN(
 
 # Load the trained model
 model_path = '../../exp/test_exps/shd_LIFcomplex_3lay512_drop0_1_batchnorm_nobias_udir_noreg_lr0_01/checkpoints/best_model.pth'
-trained_net = torch.load(model_path)
+trained_net = load_model(model_path)
 
 def compute_alpha(log_log_alpha, alpha_img, log_dt):
     # Compute alpha as per your formula
@@ -0,0 +1,91 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is the script used to measure the speedup of torch.compile on CPU for
+every neuron type, for a training step (forward and backward) on random
+spiking inputs. It also reports the number of graphs and graph breaks of
+the forward pass given by torch._dynamo.explain, and the number of
+recompilations when the batch size changes, e.g. for the last partial
+batch of an epoch. Both counts should be 1 graph, 0 breaks and 0
+recompilations for every neuron type. With --fullgraph, models are
+compiled with fullgraph=True, which fails on the first graph break.
+"""
+import argparse
+
+import torch
+from utils import ANN_TYPES
+from utils import SNN_TYPES
+from utils import build_model
+from utils import timeit
+
+
+def graph_breaks(net, x):
+    """Number of graphs and graph breaks of the forward pass of a model."""
+    torch._dynamo.reset()
+    explanation = torch._dynamo.explain(net)(x)
+    for reason in explanation.break_reasons:
+        print(f"  graph break: {reason.reason}")
+    torch._dynamo.reset()
+    return explanation.graph_count, explanation.graph_break_count
+
+
+def compiled_graphs():
+    return torch._dynamo.utils.counters["stats"]["unique_graphs"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="torch.compile speedup on CPU.")
+    parser.add_argument("--model_type", nargs="+", default=SNN_TYPES + ANN_TYPES)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--nb_steps", type=int, default=100)
+    parser.add_argument("--nb_hiddens", type=int, default=128)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--fullgraph", action="store_true")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    x = (torch.rand(args.batch_size, args.nb_steps, 700) < 0.02).float()
+
+    # Last partial batch, with another size
+    x_last = x[: args.batch_size // 2].clone()
+
+    print(
+        f"{'model':<14}{'eager (ms)':>12}{'compiled (ms)':>15}{'speedup':>10}"
+        f"{'graphs':>8}{'breaks':>8}{'recompiles':>12}"
+    )
+    for model_type in args.model_type:
+        net = build_model(model_type, nb_hiddens=args.nb_hiddens)
+        graphs, breaks = graph_breaks(net, x)
+
+        compiled = torch.compile(net, fullgraph=args.fullgraph)
+        torch._dynamo.mark_dynamic(x, 0)
+        torch._dynamo.mark_dynamic(x_last, 0)
+
+        def step(model, inputs=x):
+            out, _ = model(inputs)
+            out.sum().backward()
+
+        t_eager = timeit(lambda: step(net), repeats=args.repeats)
+        t_comp = timeit(lambda: step(compiled), repeats=args.repeats)
+
+        # Graphs compiled again for another batch size
+        nb_graphs = compiled_graphs()
+        step(compiled, x_last)
+        recompiles = compiled_graphs() - nb_graphs
+
+        print(
+            f"{model_type:<14}{1e3 * t_eager:>12.1f}{1e3 * t_comp:>15.1f}"
+            f"{t_eager / t_comp:>9.2f}x{graphs:>8}{breaks:>8}{recompiles:>12}"
+        )
+        torch._dynamo.reset()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is the script used to compare the inference latency of the exported
+streaming models (TorchScript, and ONNX if onnxruntime is installed) with
+the eager models on CPU. The outputs of the exported models are also
+compared with the eager ones, starting from the same random initial state.
+"""
+import argparse
+import os
+import tempfile
+
+import torch
+from utils import build_model
+from utils import timeit
+
+from sparch.deploy.export import eager_initial_state
+from sparch.deploy.export import export_model
+from sparch.deploy.export import to_streaming
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exported vs eager inference.")
+    parser.add_argument(
+        "--model_type",
+        nargs="+",
+        default=["LIF", "adLIF", "RLIF", "RadLIF", "LIFcomplex", "MLP", "GRU"],
+    )
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--nb_steps", type=int, default=100)
+    parser.add_argument("--nb_hiddens", type=int, default=128)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    try:
+        import onnxruntime
+    except ImportError:
+        onnxruntime = None
+
+    torch.manual_seed(0)
+    x = (torch.rand(args.batch_size, args.nb_steps, 700) < 0.02).float()
+    tmpdir = tempfile.mkdtemp()
+
+    print(
+        f"{'model':<12}{'eager (ms)':>12}{'script (ms)':>13}{'onnx (ms)':>11}"
+        f"{'max diff':>10}"
+    )
+    for model_type in args.model_type:
+        net = build_model(model_type, nb_hiddens=args.nb_hiddens).eval()
+        scripted = torch.jit.script(to_streaming(net))
+
+        # Same initial state as the eager model for the comparison
+        torch.manual_seed(1)
+        with torch.no_grad():
+            ref, _ = net(x)
+        torch.manual_seed(1)
+        state = eager_initial_state(to_streaming(net), args.batch_size)
+        with torch.no_grad():
+            out, _ = scripted(x, state)
+        diff = (out - ref).abs().max().item()
+
+        with torch.no_grad():
+            t_eager = timeit(lambda: net(x), repeats=args.repeats)
+            t_script = timeit(lambda: scripted(x, state), repeats=args.repeats)
+
+        t_onnx = float("nan")
+        if onnxruntime is not None:
+            path = os.path.join(tmpdir, f"{model_type}.onnx")
+            export_model(net, path, fmt="onnx", batch_size=args.batch_size)
+            session = onnxruntime.InferenceSession(path)
+            feeds = {"x": x.numpy(), "state": state.numpy()}
+            t_onnx = timeit(lambda: session.run(None, feeds), repeats=args.repeats)
+
+        print(
+            f"{model_type:<12}{1e3 * t_eager:>12.1f}{1e3 * t_script:>13.1f}"
+            f"{1e3 * t_onnx:>11.1f}{diff:>10.1e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is the script used to evaluate the NumPy inference runtime. For every
+neuron type it measures the cold start (interpreter start, imports, loading
+the .npz and classifying one sample) in a fresh process, compares the warm
+latency with the eager model, and checks the outputs against the eager
+model starting from the same random initial state.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+import torch
+from utils import build_model
+from utils import timeit
+
+from sparch.deploy.export import eager_initial_state
+from sparch.deploy.export import to_streaming
+from sparch.deploy.npz import snn_to_npz
+from sparch.deploy.runtime import NumpySNN
+
+COLD_START = """
+import time
+t0 = time.perf_counter()
+import numpy as np
+from sparch.deploy.runtime import NumpySNN
+net = NumpySNN({path!r})
+x = np.zeros((1, {nb_steps}, 700), dtype=np.float32)
+net(x)
+print(time.perf_counter() - t0)
+"""
+
+
+def cold_start(path, nb_steps):
+    """Returns the time to import, load and run the runtime in a new process."""
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    code = COLD_START.format(path=path, nb_steps=nb_steps)
+    out = subprocess.run(
+        [sys.executable, "-c", code], cwd=root, capture_output=True, text=True,
+        check=True,
+    )
+    return float(out.stdout.strip())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NumPy runtime vs eager.")
+    parser.add_argument(
+        "--model_type",
+        nargs="+",
+        default=["LIF", "adLIF", "RLIF", "RadLIF", "LIFcomplex", "ResonateFire"],
+    )
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--nb_steps", type=int, default=100)
+    parser.add_argument("--nb_hiddens", type=int, default=128)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    x = (torch.rand(args.batch_size, args.nb_steps, 700) < 0.02).float()
+    tmpdir = tempfile.mkdtemp()
+
+    print(
+        f"{'model':<14}{'cold (ms)':>11}{'eager (ms)':>12}{'numpy (ms)':>12}"
+        f"{'size (kB)':>11}{'max diff':>10}"
+    )
+    for model_type in args.model_type:
+        net = build_model(model_type, nb_hiddens=args.nb_hiddens).eval()
+        path = os.path.join(tmpdir, f"{model_type}.npz")
+        snn_to_npz(net, path)
+        runtime = NumpySNN(path)
+
+        # Same initial state as the eager model for the comparison
+        torch.manual_seed(1)
+        with torch.no_grad():
+            ref, _ = net(x)
+        torch.manual_seed(1)
+        state = eager_initial_state(to_streaming(net), args.batch_size).numpy()
+        out, _ = runtime(x.numpy(), state)
+        diff = abs(out - ref.numpy()).max()
+
+        with torch.no_grad():
+            t_eager = timeit(lambda: net(x), repeats=args.repeats)
+        x_np = x.numpy()
+        t_numpy = timeit(lambda: runtime(x_np, state), repeats=args.repeats)
+        t_cold = cold_start(path, args.nb_steps)
+        size = os.path.getsize(path) / 1e3
+
+        print(
+            f"{model_type:<14}{1e3 * t_cold:>11.1f}{1e3 * t_eager:>12.1f}"
+            f"{1e3 * t_numpy:>12.1f}{size:>11.1f}{diff:>10.1e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
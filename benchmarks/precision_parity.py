@@ -0,0 +1,153 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is the script used to compare the fp32, bf16 and fp16 precisions for
+every neuron type. For each precision it reports the agreement of the
+predictions with fp32 (or the test accuracy of SHD/SSC with --model_path),
+the maximum deviation of the outputs, the time of a training step and the
+memory of the activations saved for the backward pass.
+
+Both runs of a model start from the same random initial states, so that
+the differences only come from the precision. The neuron types with a
+fixed-point spike solver are also run with it.
+"""
+import argparse
+
+import torch
+from utils import ANN_TYPES
+from utils import SNN_TYPES
+from utils import build_model
+from utils import timeit
+
+from sparch.dataloaders.spiking_datasets import load_shd_or_ssc
+from sparch.models.precision import autocast
+from sparch.models.weights import load_model
+
+# Neuron types with a fixed-point spike solver
+FIXED_POINT_TYPES = ["LIF", "adLIF", "LIFcomplex"]
+
+
+def run(net, x, precision, device, seed=0):
+    """Outputs of the model in the given precision from a fixed state."""
+    torch.manual_seed(seed)
+    with torch.no_grad(), autocast(device, precision):
+        out, _ = net(x)
+    return out.float()
+
+
+def saved_bytes(net, x, precision, device):
+    """Memory of the activations saved for the backward pass."""
+    total = 0
+
+    def pack(t):
+        nonlocal total
+        total += t.numel() * t.element_size()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        with autocast(device, precision):
+            out, _ = net(x)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mixed precision parity.")
+    parser.add_argument("--model_type", nargs="+", default=SNN_TYPES + ANN_TYPES)
+    parser.add_argument("--model_path", nargs="*", default=[])
+    parser.add_argument("--precision", nargs="+", default=["bf16", "fp16"])
+    parser.add_argument(
+        "--spike_solver",
+        nargs="+",
+        default=["loop", "fixed_point"],
+        help="Spike solvers of the neuron types that have a fixed-point one.",
+    )
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--dataset_name", type=str, default="shd")
+    parser.add_argument("--data_folder", type=str, default="SHD")
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--nb_steps", type=int, default=100)
+    parser.add_argument("--nb_hiddens", type=int, default=128)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    # Trained models are evaluated on the test split, others on random inputs
+    if args.model_path:
+        models = []
+        for path in args.model_path:
+            net = load_model(path, map_location=device)
+            name = net.neuron_type if net.is_snn else net.ann_type
+            models.append((name, net))
+        loader = load_shd_or_ssc(
+            dataset_name=args.dataset_name,
+            data_folder=args.data_folder,
+            split="test",
+            batch_size=args.batch_size,
+            nb_steps=args.nb_steps,
+            shuffle=False,
+        )
+    else:
+        models = []
+        for t in args.model_type:
+            solvers = args.spike_solver if t in FIXED_POINT_TYPES else ["loop"]
+            for solver in solvers:
+                net = build_model(t, nb_hiddens=args.nb_hiddens, spike_solver=solver)
+                name = t if solver == "loop" else f"{t} {solver}"
+                models.append((name, net.to(device)))
+        torch.manual_seed(0)
+        x = (torch.rand(args.batch_size, args.nb_steps, 700) < 0.02).float()
+        loader = [(x, None, None)]
+
+    print(
+        f"{'model':<24}{'precision':<10}{'acc/agree':>10}{'delta':>9}"
+        f"{'max dev':>10}{'step (ms)':>11}{'saved (MB)':>12}"
+    )
+    for name, net in models:
+        net.eval()
+        ref_correct, total = 0, 0
+        results = {p: [0, 0.0] for p in args.precision}
+        for step, (x, _, y) in enumerate(loader):
+            x = x.to(device)
+            ref = run(net, x, "fp32", device, seed=step)
+            ref_pred = ref.argmax(1)
+            if y is not None:
+                y = y.to(device)
+                ref_correct += (ref_pred == y).sum().item()
+            total += x.shape[0]
+            for p in args.precision:
+                out = run(net, x, p, device, seed=step)
+                target = y if y is not None else ref_pred
+                results[p][0] += (out.argmax(1) == target).sum().item()
+                results[p][1] = max(results[p][1], (out - ref).abs().max().item())
+
+        # Training step time and activation memory on the last batch
+        net.train()
+
+        def train_step(precision):
+            with autocast(device, precision):
+                out, _ = net(x)
+            out.float().sum().backward()
+
+        ref_acc = ref_correct / total if y is not None else 1.0
+        for p in ["fp32"] + args.precision:
+            t = timeit(lambda: train_step(p), repeats=args.repeats)
+            mem = saved_bytes(net, x, p, device)
+            if p == "fp32":
+                acc, dev = ref_acc, 0.0
+            else:
+                acc, dev = results[p][0] / total, results[p][1]
+            print(
+                f"{name:<24}{p:<10}{acc:>10.4f}{acc - ref_acc:>+9.4f}"
+                f"{dev:>10.2e}{1e3 * t:>11.1f}{mem / 1e6:>12.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
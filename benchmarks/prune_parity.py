@@ -0,0 +1,103 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is the script used to check that pruning the dead and saturated
+neurons of an SNN does not change its outputs in eval mode.
+
+For every neuron type, a quarter of the neurons of each hidden layer are
+made dead and another quarter saturated by a large constant input. The
+firing rates are measured on random spike trains, a copy of the model is
+pruned with sparch/deploy/prune.py, and both models run on the same inputs
+with zero initial states. The outputs must agree up to the given tolerance
+and give the same predictions, otherwise the script fails.
+"""
+import argparse
+import copy
+
+import torch
+from utils import SNN_TYPES
+from utils import build_model
+
+from sparch.deploy.prune import activity_stats
+from sparch.deploy.prune import compare_outputs
+from sparch.deploy.prune import prune_snn
+from sparch.deploy.prune import zero_initial_states
+
+
+def force_activity(net, current):
+    """Makes the first and second quarters of the neurons dead and saturated."""
+    for layer in net.snn[:-1]:
+        quarter = layer.hidden_size // 4
+        shift = torch.zeros(layer.hidden_size)
+        shift[:quarter] = -current
+        shift[quarter : 2 * quarter] = current
+        bias = layer.norm.bias if layer.normalize else layer.W.bias
+        bias.data += shift
+
+
+def compare(model_type, args):
+    """Neurons removed by pruning and deviation of the outputs."""
+    torch.manual_seed(0)
+    net = build_model(model_type, nb_hiddens=args.nb_hiddens, use_bias=True)
+    force_activity(net, args.current)
+
+    shape = (args.batch_size, args.nb_steps, 700)
+    loader = [
+        ((torch.rand(shape) < args.input_rate).float(), None, None)
+        for _ in range(args.batches)
+    ]
+    with zero_initial_states():
+        rates = activity_stats(net, loader, torch.device("cpu"))
+
+    pruned = copy.deepcopy(net)
+    layers = prune_snn(pruned, rates)
+    removed = sum(layer["neurons"] - layer["kept"] for layer in layers)
+    deviation, agreement = compare_outputs(net, pruned, loader, torch.device("cpu"))
+    return removed, deviation, agreement
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pruning parity.")
+    parser.add_argument(
+        "--model_type", nargs="+", default=SNN_TYPES + ["RLIFcomplex1MinAlpha"]
+    )
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--batches", type=int, default=2)
+    parser.add_argument("--nb_steps", type=int, default=100)
+    parser.add_argument("--nb_hiddens", type=int, default=64)
+    parser.add_argument("--input_rate", type=float, default=0.05)
+    parser.add_argument(
+        "--current",
+        type=float,
+        default=1e3,
+        help="Constant input that makes the neurons dead or saturated.",
+    )
+    parser.add_argument(
+        "--atol",
+        type=float,
+        default=1e-4,
+        help="Largest absolute deviation of the outputs of the pruned model.",
+    )
+    args = parser.parse_args()
+
+    print(f"{'model':<22}{'removed':>10}{'deviation':>12}{'agreement':>12}")
+    failed = []
+    for model_type in args.model_type:
+        removed, deviation, agreement = compare(model_type, args)
+        print(f"{model_type:<22}{removed:>10}{deviation:>12.2e}{agreement:>12.4f}")
+        if deviation > args.atol or agreement < 1:
+            failed.append(model_type)
+
+    if failed:
+        raise SystemExit(f"Pruning changes the outputs of: {failed}")
+
+
+if __name__ == "__main__":
+    main()
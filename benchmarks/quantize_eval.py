@@ -0,0 +1,115 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is the script used to evaluate the post-training quantization of SNNs.
+It reports the accuracy of the float eager model and of the quantized model
+on the test split of SHD or SSC, both starting from the same random initial
+states, as well as the CPU latency and the memory of the weights.
+
+Without --model_path, a randomly initialized model is used and only the
+latency, the memory and the agreement of the predictions are reported.
+"""
+import argparse
+
+import torch
+from utils import build_model
+from utils import timeit
+
+from sparch.dataloaders.spiking_datasets import load_shd_or_ssc
+from sparch.deploy.export import eager_initial_state
+from sparch.deploy.export import to_streaming
+from sparch.deploy.quantize import quantize_snn
+from sparch.models.weights import load_model
+
+
+def model_bytes(net):
+    """Memory of the parameters and buffers of a model."""
+    tensors = list(net.parameters()) + list(net.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+@torch.no_grad()
+def predict(net, qnet, x, seed):
+    """Predictions of the float and quantized models from the same state."""
+    torch.manual_seed(seed)
+    out, _ = net(x)
+    torch.manual_seed(seed)
+    state = eager_initial_state(to_streaming(net), x.shape[0])
+    qout, _ = qnet(x, state)
+    return out.argmax(1), qout.argmax(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantized vs float SNN.")
+    parser.add_argument("--model_path", type=str, default=None)
+    parser.add_argument("--model_type", type=str, default="adLIF")
+    parser.add_argument("--dataset_name", type=str, default="shd")
+    parser.add_argument("--data_folder", type=str, default="SHD")
+    parser.add_argument("--nb_steps", type=int, default=100)
+    parser.add_argument("--max_time", type=float, default=1.4)
+    parser.add_argument("--spatial_bin", type=int, default=1)
+    parser.add_argument("--batch_size", type=int, default=128)
+    parser.add_argument("--weight_bits", type=int, default=8)
+    parser.add_argument("--state_bits", type=int, default=16)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.model_path is not None:
+        net = load_model(args.model_path, map_location="cpu")
+    else:
+        net = build_model(args.model_type, nb_outputs=20)
+    net = getattr(net, "_orig_mod", net).cpu().eval()
+    qnet = quantize_snn(net, args.weight_bits, args.state_bits)
+
+    if args.model_path is not None:
+        loader = load_shd_or_ssc(
+            dataset_name=args.dataset_name,
+            data_folder=args.data_folder,
+            split="test",
+            batch_size=args.batch_size,
+            nb_steps=args.nb_steps,
+            max_time=args.max_time,
+            spatial_bin=args.spatial_bin,
+            shuffle=False,
+        )
+        correct, qcorrect, total = 0, 0, 0
+        for step, (x, _, y) in enumerate(loader):
+            pred, qpred = predict(net, qnet, x, seed=step)
+            correct += (pred == y).sum().item()
+            qcorrect += (qpred == y).sum().item()
+            total += y.numel()
+        acc, qacc = correct / total, qcorrect / total
+        print(f"Test accuracy float: {acc:.4f}, quantized: {qacc:.4f}")
+        print(f"Accuracy delta: {qacc - acc:+.4f}")
+        x = x[: args.batch_size]
+    else:
+        torch.manual_seed(0)
+        nb_inputs = net.snn[0].W.weight.shape[1]
+        x = (torch.rand(args.batch_size, args.nb_steps, nb_inputs) < 0.02).float()
+        pred, qpred = predict(net, qnet, x, seed=0)
+        print(f"Prediction agreement: {(pred == qpred).float().mean().item():.4f}")
+
+    state = qnet.initial_state(x.shape[0])
+    with torch.no_grad():
+        t_float = timeit(lambda: net(x), repeats=args.repeats)
+        t_quant = timeit(lambda: qnet(x, state), repeats=args.repeats)
+    m_float, m_quant = model_bytes(net), model_bytes(qnet)
+    print(
+        f"Latency float: {1e3 * t_float:.1f} ms, quantized: {1e3 * t_quant:.1f} ms "
+        f"({t_float / t_quant:.2f}x)"
+    )
+    print(
+        f"Memory float: {m_float / 1e3:.1f} kB, quantized: {m_quant / 1e3:.1f} kB "
+        f"({m_float / m_quant:.2f}x)"
+    )
+
+
+if __name__ == "__main__":
+    main()
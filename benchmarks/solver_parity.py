@@ -0,0 +1,123 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is the script used to check that the fixed-point spike solver of the
+LIF, adLIF and LIFcomplex layers gives the same spikes and the same
+surrogate gradients as the reference time loop, and to compare their time.
+
+For every neuron type, both solvers run the neuron dynamics of a layer with
+the same parameters, input currents and random initial states. The spike
+trains must be equal and the gradients of a random linear function of the
+spikes with respect to the input currents and to the neuron parameters must
+agree up to the given tolerances, otherwise the script fails.
+"""
+import argparse
+
+import torch
+from utils import build_model
+from utils import timeit
+
+# Neuron dynamics of the layers with a fixed-point solver
+CELLS = {"LIF": "_lif_cell", "adLIF": "_adlif_cell", "LIFcomplex": "_lif_cell"}
+
+
+def run_cell(layer, cell, Wx, grad_s, seed):
+    """Spikes of a layer and gradients of (spikes * grad_s).sum()."""
+    Wx = Wx.detach().requires_grad_(True)
+    params = [p for p in layer.parameters() if p.requires_grad]
+    torch.manual_seed(seed)
+    s = getattr(layer, cell)(Wx)
+    grads = torch.autograd.grad((s * grad_s).sum(), [Wx] + params, allow_unused=True)
+    return s.detach(), grads
+
+
+def compare(model_type, args, dtype):
+    """Maximum deviations of the fixed-point solver from the loop."""
+    loop = build_model(model_type, nb_hiddens=args.nb_hiddens, spike_solver="loop")
+    fixed = build_model(
+        model_type, nb_hiddens=args.nb_hiddens, spike_solver="fixed_point"
+    )
+    fixed.load_state_dict(loop.state_dict())
+    layers = [loop.snn[0].to(dtype), fixed.snn[0].to(dtype)]
+    cell = CELLS[model_type]
+
+    spike_errors, grad_error, nb_spikes = 0, 0.0, 0
+    for seed in range(args.seeds):
+        torch.manual_seed(seed)
+        shape = (args.batch_size, args.nb_steps, args.nb_hiddens)
+        Wx = args.scale * torch.randn(shape, dtype=dtype) + args.offset
+        grad_s = torch.randn(shape, dtype=dtype)
+
+        s_loop, g_loop = run_cell(layers[0], cell, Wx, grad_s, seed)
+        s_fixed, g_fixed = run_cell(layers[1], cell, Wx, grad_s, seed)
+
+        spike_errors += (s_loop != s_fixed).sum().item()
+        nb_spikes += s_loop.sum().item()
+        for a, b in zip(g_loop, g_fixed):
+            if a is None or b is None:
+                assert a is None and b is None, "Gradient missing in one solver"
+                continue
+            dev = (a - b).abs().max() / (a.abs().max() + args.atol)
+            grad_error = max(grad_error, dev.item())
+
+    def step(layer):
+        run_cell(layer, cell, Wx, grad_s, seed=0)
+
+    t_loop = timeit(lambda: step(layers[0]), repeats=args.repeats)
+    t_fixed = timeit(lambda: step(layers[1]), repeats=args.repeats)
+    return spike_errors, nb_spikes, grad_error, t_loop, t_fixed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fixed-point solver parity.")
+    parser.add_argument("--model_type", nargs="+", default=list(CELLS))
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--nb_steps", type=int, default=100)
+    parser.add_argument("--nb_hiddens", type=int, default=64)
+    parser.add_argument("--scale", type=float, default=2.0)
+    parser.add_argument("--offset", type=float, default=0.5)
+    parser.add_argument("--seeds", type=int, default=5)
+    parser.add_argument("--dtype", type=str, default="float64")
+    parser.add_argument(
+        "--atol",
+        type=float,
+        default=1e-12,
+        help="Added to the largest gradient of the loop to get relative deviations.",
+    )
+    parser.add_argument(
+        "--rtol",
+        type=float,
+        default=1e-6,
+        help="Largest relative deviation of the gradients of the fixed-point solver.",
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+    dtype = getattr(torch, args.dtype)
+
+    print(
+        f"{'model':<14}{'spikes':>10}{'mismatch':>10}{'grad dev':>12}"
+        f"{'loop (ms)':>12}{'fixed (ms)':>12}"
+    )
+    failed = []
+    for model_type in args.model_type:
+        errors, spikes, dev, t_loop, t_fixed = compare(model_type, args, dtype)
+        print(
+            f"{model_type:<14}{int(spikes):>10}{errors:>10}{dev:>12.2e}"
+            f"{1e3 * t_loop:>12.1f}{1e3 * t_fixed:>12.1f}"
+        )
+        if errors or dev > args.rtol:
+            failed.append(model_type)
+
+    if failed:
+        raise SystemExit(f"Fixed-point solver differs from the loop: {failed}")
+
+
+if __name__ == "__main__":
+    main()
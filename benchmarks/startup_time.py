@@ -0,0 +1,93 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is the script used to measure the startup time of the entry point and
+of the sparch modules, each in a fresh interpreter, and to list the imports
+that take the most time.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = {
+    "run_exp.py -h": ["run_exp.py", "-h"],
+    "sparch.sweep": ["-c", "import sparch.sweep"],
+    "sparch.exp": ["-c", "import sparch.exp"],
+    "sparch.models.snns": ["-c", "import sparch.models.snns"],
+    "sparch.dataloaders.spiking_datasets": [
+        "-c",
+        "import sparch.dataloaders.spiking_datasets",
+    ],
+}
+
+
+def startup_time(args, repeats):
+    """Returns the median wall time of a fresh interpreter running args."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable] + args,
+            cwd=ROOT,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def slowest_imports(args, top):
+    """Returns the top-level imports of args with the largest cumulative time."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime"] + args,
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        # Nested imports are indented, their time is in their parent's
+        if not name.startswith("  "):
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time of sparch.")
+    parser.add_argument("--command", nargs="+", default=list(COMMANDS))
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--top", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'command':<40}{'startup (ms)':>14}")
+    for name in args.command:
+        t = startup_time(COMMANDS[name], args.repeats)
+        print(f"{name:<40}{1e3 * t:>14.1f}")
+
+    if args.top:
+        for name in args.command:
+            print(f"\nSlowest imports of {name}:")
+            for cumulative, module in slowest_imports(COMMANDS[name], args.top):
+                print(f"  {module:<38}{cumulative / 1e3:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
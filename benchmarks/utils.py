@@ -0,0 +1,84 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is where the helpers shared by the benchmark scripts are defined.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from sparch.parsers.model_config import add_model_options  # noqa: E402
+from sparch.parsers.training_config import add_training_options  # noqa: E402
+
+SNN_TYPES = ["LIF", "adLIF", "RLIF", "RadLIF", "LIFcomplex", "RLIFcomplex", "BRF"]
+ANN_TYPES = ["MLP", "RNN", "LiGRU", "GRU"]
+
+
+def default_config():
+    """
+    Returns the default experiment configuration of the parsers, where
+    options given as lists are replaced by their first value like in
+    the debug mode of run_exp.py.
+    """
+    parser = argparse.ArgumentParser()
+    parser = add_model_options(parser)
+    parser = add_training_options(parser)
+    config = vars(parser.parse_args([]))
+    return {k: v[0] if isinstance(v, list) else v for k, v in config.items()}
+
+
+def build_model(model_type, nb_inputs=700, nb_hiddens=128, nb_outputs=20,
+                nb_layers=3, batch_size=32, **overrides):
+    """
+    Builds an SNN or ANN with the default configuration and the
+    given overrides of the extra features.
+    """
+    from sparch.models.anns import ANN
+    from sparch.models.snns import SNN
+
+    config = default_config()
+    config.update(overrides)
+    input_shape = (batch_size, None, nb_inputs)
+    layer_sizes = [nb_hiddens] * (nb_layers - 1) + [nb_outputs]
+
+    if model_type in ANN_TYPES:
+        return ANN(
+            input_shape=input_shape,
+            layer_sizes=layer_sizes,
+            ann_type=model_type,
+            dropout=config["pdrop"],
+            normalization=config["normalization"],
+            use_bias=config["use_bias"],
+            bidirectional=config["bidirectional"],
+            use_readout_layer=True,
+        )
+    return SNN(
+        input_shape=input_shape,
+        layer_sizes=layer_sizes,
+        neuron_type=model_type,
+        dropout=config["pdrop"],
+        normalization=config["normalization"],
+        use_bias=config["use_bias"],
+        bidirectional=config["bidirectional"],
+        extra_features=config,
+    )
+
+
+def timeit(fn, repeats=10, warmup=2):
+    """Returns the mean wall time of fn in seconds after warmup calls."""
+    for _ in range(warmup):
+        fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
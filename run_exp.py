@@ -11,17 +11,21 @@
 This is the script used to run experiments.
 """
 import argparse
+import functools
 import logging
+import os
 
-from sparch.exp import Experiment
 from sparch.parsers.model_config import add_model_options
 from sparch.parsers.training_config import add_training_options
-import torch
-
-import wandb
 
 logger = logging.getLogger(__name__)
 
+# Options of the sweep engines, which are not part of the trial configs
+SWEEP_OPTIONS = [
+    "local_sweep", "sweep_dir", "sweep_workers", "cores_per_trial", "sweep_count",
+    "asha", "asha_min_epochs", "asha_eta",
+]
+
 
 def parse_args():
 
@@ -35,41 +39,108 @@ def parse_args():
     return args
 
 
-args = parse_args()
-
-DEBUG = args.debug
-
-if args.gpu_device:
-    DEVICE = args.gpu_device
-    delattr(args, 'gpu_device')
-else:
-    DEVICE = 0
-
-def main(debug_config=None):
+def main(
+    debug_config=None,
+    sweep_config=None,
+    sweep_dir=None,
+    debug=False,
+    distributed=False,
+    offline=False,
+    device=0,
+):
     """
     Runs model training/testing using the configuration specified
     by the parser arguments. Run `python run_exp.py -h` for details.
+    Debug, distributed and offline runs use the debug config, other
+    runs get theirs from wandb. With early stopping, a debug run is
+    stopped at the rungs where it does worse than the previous runs
+    of the sweep folder.
     """
-
-    if DEBUG:
+    if debug or distributed or offline:
         config = debug_config
     else:
+        import wandb
+
+        from sparch.exp_cache import find_completed
+
         wandb.init()
         config = wandb.config
 
-    # Instantiate class for the desired experiment
-    experiment = Experiment(config, DEVICE)
+        # Sweeps only train configs that are new
+        completed = find_completed(config)
+        if completed is not None:
+            logging.info(f"Config already trained in {completed['exp_folder']}")
+            wandb.log(
+                {
+                    "best valid acc": completed["best valid acc"],
+                    "test acc": completed["test acc"],
+                    "cached": True,
+                }
+            )
+            return completed
+
+    # Instantiate class for the desired experiment, imported only now with
+    # torch and the modules of the chosen dataset and model
+    if config.get("ensemble"):
+        from sparch.ensemble_exp import EnsembleExperiment
+
+        experiment = EnsembleExperiment(config, device)
+    else:
+        from sparch.exp import Experiment
+
+        experiment = Experiment(config, device)
+
+    # Report epochs of debug run to the sweep folder for early stopping
+    trial_id = None
+    if debug and sweep_config is not None and "early_terminate" in sweep_config:
+        from sparch.sweep import RUNNING
+        from sparch.sweep import SuccessiveHalving
+        from sparch.sweep import SweepStore
+        from sparch.sweep import track_trial
+
+        store = SweepStore(sweep_dir)
+        trial_id = store.new_trial_id()
+        store.add_trial(trial_id, dict(config), sweep_config["metric"], status=RUNNING)
+        scheduler = SuccessiveHalving.from_config(store, sweep_config)
+        track_trial(experiment, store, trial_id, scheduler)
 
     # Run experiment
     experiment.forward()
 
+    if trial_id is not None:
+        from sparch.sweep import finish_trial
+
+        finish_trial(experiment, store, trial_id)
+
 
 if __name__ == "__main__":
 
     # Get experiment configuration from parser
+    args = parse_args()
 
-    if args.sweep_id and not DEBUG:
-        wandb.agent("maximes_crew/" + args.sweep_id, function=main)
+    DEBUG = args.debug
+
+    # Offline runs log metrics to their experiment folder only
+    OFFLINE = args.log_backend == "offline"
+
+    # Processes launched with torchrun all run the configuration of the parser
+    DISTRIBUTED = int(os.environ.get("WORLD_SIZE", 1)) > 1
+
+    if args.gpu_device:
+        DEVICE = args.gpu_device
+        delattr(args, 'gpu_device')
+    else:
+        DEVICE = 0
+
+    # Runs of this process, also called by wandb agents
+    run = functools.partial(
+        main, debug=DEBUG, distributed=DISTRIBUTED, offline=OFFLINE, device=DEVICE
+    )
+
+    if args.sweep_id and not DEBUG and not DISTRIBUTED and not OFFLINE:
+        import wandb
+
+        wandb.agent("maximes_crew/" + args.sweep_id, function=run)
     else:
         sweep_config = {
             'method': args.method,  # Method (grid or bayes) is set separately here
@@ -84,6 +155,18 @@ if __name__ == "__main__":
             sweep_config['name'] = args.sweep_name
         delattr(args, 'sweep_name')
 
+        sweep_options = {key: getattr(args, key) for key in SWEEP_OPTIONS}
+        for key in SWEEP_OPTIONS:
+            delattr(args, key)
+
+        # Early stopping by successive halving, also used by wandb sweeps
+        if sweep_options["asha"]:
+            sweep_config['early_terminate'] = {
+                'type': 'hyperband',
+                'min_iter': sweep_options["asha_min_epochs"],
+                'eta': sweep_options["asha_eta"],
+            }
+
         debug_config = {'seed': 42}
 
         # Handle lif_feature separately
@@ -125,18 +208,48 @@ if __name__ == "__main__":
                     debug_config[arg] = value
 
 
+        if args.dataset_name == "shd":
+            project_name="S3_SHD_runs"
+        elif args.dataset_name == "ssc":
+            project_name="S3_SSC_runs"
+        elif args.dataset_name == "sc":
+            project_name="S3_SC_runs"
+        elif args.dataset_name == "hd":
+            project_name="S3_HD_runs"
+
+        sweep_dir = sweep_options["sweep_dir"] or os.path.join(
+            "exp", "sweeps", sweep_config.get("name", project_name)
+        )
+
         if DEBUG:
-            main(debug_config)
+            run(debug_config, sweep_config, sweep_dir)
+        elif DISTRIBUTED:
+            # Single run whose main process logs to wandb
+            if int(os.environ.get("RANK", 0)) == 0 and not OFFLINE:
+                import wandb
+
+                wandb.init(entity="maximes_crew", project=project_name, config=debug_config)
+            run(debug_config)
+        elif sweep_options["local_sweep"]:
+            # Trials run in local processes and write to the sweep folder
+            from sparch.sweep import LocalSweep
+
+            logging.basicConfig(level=logging.INFO, format="%(message)s")
+            sweep = LocalSweep(
+                sweep_config,
+                sweep_dir,
+                workers=sweep_options["sweep_workers"],
+                cores_per_trial=sweep_options["cores_per_trial"],
+                count=sweep_options["sweep_count"],
+            )
+            best = sweep.run()
+            if best is not None:
+                print(f"Best trial {best['id']}: {best['value']}\n{best['config']}")
+        elif OFFLINE:
+            # Single run with the first values, without wandb
+            run(debug_config)
         else:
-            if args.dataset_name == "shd":
-                project_name="S3_SHD_runs"
-            elif args.dataset_name == "ssc":
-                project_name="S3_SSC_runs"
-            elif args.dataset_name == "sc":
-                project_name="S3_SC_runs"
-            elif args.dataset_name == "hd":
-                project_name="S3_HD_runs"
-
+            import wandb
 
             sweep_id = wandb.sweep(sweep_config,
                                 entity="maximes_crew", 
@@ -144,4 +257,4 @@ if __name__ == "__main__":
 
             print('SWEEP ID: '+sweep_id)
             # Run the sweep
-            wandb.agent(sweep_id, function=main)
+            wandb.agent(sweep_id, function=run)
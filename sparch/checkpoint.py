@@ -0,0 +1,118 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is where the checkpoints of the full training state are defined.
+
+A checkpoint bundles the state dicts of the model, optimizer, scheduler
+and gradient scaler, the random number generator states and the epoch and
+best-so-far metrics, so that an interrupted training continues on the same
+trajectory. The training state is first copied to CPU, then written on a
+background thread, to a temporary file renamed once complete, so that the
+training loop does not wait for the disk and a crash never leaves a
+partial checkpoint. Only the last checkpoints are kept.
+"""
+import glob
+import logging
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def cpu_snapshot(state):
+    """Copies the tensors of a nested state to CPU."""
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {k: cpu_snapshot(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(cpu_snapshot(v) for v in state)
+    return state
+
+
+def rng_state():
+    """States of all random number generators."""
+    state = {
+        "torch": torch.get_rng_state(),
+        "numpy": np.random.get_state(),
+        "python": random.getstate(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """Restores the states of all random number generators."""
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["python"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+class CheckpointManager:
+    """
+    Writes training states to checkpoint_<epoch>.pt files in the background
+    and keeps the last ones.
+
+    Arguments
+    ---------
+    checkpoint_dir : str
+        Folder of the checkpoints.
+    keep : int
+        Number of checkpoints kept.
+    """
+
+    def __init__(self, checkpoint_dir, keep=3):
+        self.checkpoint_dir = checkpoint_dir
+        self.keep = keep
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def paths(self):
+        """Paths of the complete checkpoints, oldest first."""
+        return sorted(glob.glob(os.path.join(self.checkpoint_dir, "checkpoint_*.pt")))
+
+    def save(self, state, epoch):
+        """
+        Snapshots the state on CPU and writes it on the background thread.
+        The previous write must be complete, so that its errors are raised.
+        """
+        self.wait()
+        snapshot = cpu_snapshot(state)
+        path = os.path.join(self.checkpoint_dir, f"checkpoint_{epoch:04d}.pt")
+        self.pending = self.executor.submit(self._write, snapshot, path)
+
+    def _write(self, snapshot, path):
+        tmp = path + ".tmp"
+        torch.save(snapshot, tmp)
+        os.replace(tmp, path)
+        for old in self.paths()[: -self.keep]:
+            os.remove(old)
+
+    def wait(self):
+        """Waits for the pending write, if any."""
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def load_latest(self, map_location="cpu"):
+        """Returns the state of the last complete checkpoint, or None."""
+        self.wait()
+        paths = self.paths()
+        if not paths:
+            return None
+        logging.info(f"Resuming from checkpoint {paths[-1]}")
+        return torch.load(paths[-1], map_location=map_location, weights_only=False)
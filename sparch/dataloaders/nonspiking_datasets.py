@@ -18,6 +18,9 @@ import torch
 import torchaudio
 from torch.utils.data import DataLoader
 from torch.utils.data import Dataset
+
+from sparch.distributed import shard_sampler
+
 # from torchaudio_augmentations import ComposeMany
 # from torchaudio_augmentations import Gain
 # from torchaudio_augmentations import Noise
@@ -280,11 +283,15 @@ def load_hd_or_sc(
 
     logging.info(f"Number of examples in {dataset_name} {split} set: {len(dataset)}")
 
+    # Shard of dataset of current process in distributed training
+    sampler = shard_sampler(dataset, shuffle)
+
     loader = DataLoader(
         dataset,
         batch_size=batch_size,
         collate_fn=dataset.generateBatch,
-        shuffle=shuffle,
+        shuffle=shuffle and sampler is None,
+        sampler=sampler,
         num_workers=workers,
         pin_memory=True,
     )
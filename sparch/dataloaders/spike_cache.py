@@ -0,0 +1,160 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is where the cache of the output spikes of frozen layers is defined.
+
+The frozen lower layers of an SNN are run once over a split of the dataset
+and their binary output spikes are packed 8 per byte along the feature
+axis into a flat file, with the number of time steps and label of every
+example in a JSON file next to it,
+
+    spike_cache/train.bin
+    spike_cache/train.json
+
+Training then reads the examples from the memory-mapped file, so that the
+cost of an epoch only depends on the trainable upper layers.
+
+The frozen layers draw their random initial states once, when the cache is
+built, so that every epoch sees the same draw for an example, whereas a run
+without cache draws new initial states at every epoch. This removes a
+source of noise from the training of the upper layers, which can change
+the results slightly.
+"""
+import json
+import logging
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from torch.utils.data import Dataset
+
+from sparch.distributed import shard_sampler
+from sparch.models.precision import autocast
+
+logger = logging.getLogger(__name__)
+
+
+def build_spike_cache(prefix, loader, path, device, precision="fp32"):
+    """
+    Runs the frozen prefix over the examples of a loader, in order, and
+    writes their output spikes to path.bin and path.json.
+    """
+    # All examples of the split, also in distributed training
+    loader = DataLoader(
+        loader.dataset,
+        batch_size=loader.batch_size,
+        collate_fn=loader.collate_fn,
+        shuffle=False,
+        num_workers=loader.num_workers,
+        pin_memory=True,
+    )
+
+    prefix.eval()
+    steps = []
+    labels = []
+    nb_features = None
+    with torch.no_grad(), open(path + ".bin.tmp", "wb") as f:
+        for x, _, y in loader:
+            with autocast(device, precision):
+                spikes = prefix(x.to(device))
+
+            spikes = spikes.float()
+            if not torch.all((spikes == 0) | (spikes == 1)):
+                raise ValueError("Outputs of frozen layers are not binary spikes")
+            nb_features = spikes.shape[2]
+
+            packed = np.packbits(spikes.cpu().numpy().astype(bool), axis=2)
+            f.write(packed.tobytes())
+            steps += [spikes.shape[1]] * spikes.shape[0]
+            labels += y.tolist()
+
+    with open(path + ".json.tmp", "w") as f:
+        json.dump({"nb_features": nb_features, "steps": steps, "labels": labels}, f)
+
+    # Binary file first, so that a complete index always has its data
+    os.replace(path + ".bin.tmp", path + ".bin")
+    os.replace(path + ".json.tmp", path + ".json")
+
+    size = os.path.getsize(path + ".bin") / 1e6
+    logging.info(
+        f"Cached spikes of {len(labels)} examples in {path}.bin ({size:.1f}MB)"
+    )
+
+
+class SpikeCache(Dataset):
+    """
+    Dataset of the cached output spikes of frozen layers.
+
+    Arguments
+    ---------
+    path : str
+        Path of the cache, without the .bin and .json extensions.
+    """
+
+    def __init__(self, path):
+        with open(path + ".json") as f:
+            index = json.load(f)
+        self.nb_features = index["nb_features"]
+        self.row_bytes = (self.nb_features + 7) // 8
+        self.steps = np.array(index["steps"], dtype=np.int64)
+        self.labels = index["labels"]
+        self.offsets = np.concatenate([[0], np.cumsum(self.steps * self.row_bytes)])
+        self.data = np.memmap(path + ".bin", dtype=np.uint8, mode="r")
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        packed = self.data[start:end].reshape(self.steps[index], self.row_bytes)
+        x = np.unpackbits(packed, axis=1, count=self.nb_features)
+        return torch.from_numpy(x), self.labels[index]
+
+    def generateBatch(self, batch):
+
+        xs, ys = zip(*batch)
+        xlens = torch.tensor([x.shape[0] for x in xs])
+        xs = torch.nn.utils.rnn.pad_sequence(xs, batch_first=True).float()
+        ys = torch.LongTensor(ys)
+
+        return xs, xlens, ys
+
+
+def load_spike_cache(path, batch_size, shuffle=True, workers=0):
+    """
+    This function creates a dataloader of the cached output spikes of
+    frozen layers.
+
+    Arguments
+    ---------
+    path : str
+        Path of the cache, without the .bin and .json extensions.
+    batch_size : int
+        Number of examples in a single generated batch.
+    shuffle : bool
+        Whether to shuffle examples or not.
+    workers : int
+        Number of workers.
+    """
+    dataset = SpikeCache(path)
+
+    # Shard of dataset of current process in distributed training
+    sampler = shard_sampler(dataset, shuffle)
+
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        collate_fn=dataset.generateBatch,
+        shuffle=shuffle and sampler is None,
+        sampler=sampler,
+        num_workers=workers,
+        pin_memory=True,
+    )
@@ -18,6 +18,8 @@ import torch
 from torch.utils.data import DataLoader
 from torch.utils.data import Dataset
 
+from sparch.distributed import shard_sampler
+
 logger = logging.getLogger(__name__)
 
 
@@ -142,11 +144,15 @@ def load_shd_or_ssc(
     dataset = SpikingDataset(dataset_name, data_folder, split, nb_steps, max_time, spatial_bin)
     logging.info(f"Number of examples in {split} set: {len(dataset)}")
 
+    # Shard of dataset of current process in distributed training
+    sampler = shard_sampler(dataset, shuffle)
+
     loader = DataLoader(
         dataset,
         batch_size=batch_size,
         collate_fn=dataset.generateBatch,
-        shuffle=shuffle,
+        shuffle=shuffle and sampler is None,
+        sampler=sampler,
         num_workers=workers,
         pin_memory=True,
     )
@@ -0,0 +1,596 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is where trained models are exported to TorchScript and ONNX for
+inference without the training code.
+
+The exported modules are streaming versions of the SNN, ANN and S4Model
+classes. Their forward takes an input chunk of shape (batch, time, feats)
+and the packed state of all layers with shape (batch, state_size), and
+returns the outputs together with the new state, so that a long sequence
+can be processed chunk by chunk. The time loops are kept as loops, which
+become prim::Loop in TorchScript and Loop nodes in ONNX.
+
+Complex-valued states are stored as (real, imaginary) pairs, and batch
+normalization is folded into the feedforward weights.
+"""
+import logging
+from typing import List
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from sparch.deploy.fold import ann_constants
+from sparch.deploy.fold import fold_norm
+from sparch.deploy.fold import snn_constants
+from sparch.deploy.fold import snn_layer_constants
+
+logger = logging.getLogger(__name__)
+
+
+class StreamingLIF(nn.Module):
+    """
+    LIF and RLIF dynamics with state (ut, st).
+    """
+
+    __constants__ = ["recurrent"]
+
+    def __init__(self, c, start):
+        super().__init__()
+        self.kind = "LIF"
+        self.hidden_size = c["weight"].shape[0]
+        self.recurrent = "V" in c
+        self.threshold = c["threshold"]
+        self.start = start
+        self.end = start + 2 * self.hidden_size
+        self.register_buffer("weight", c["weight"])
+        self.register_buffer("bias", c["bias"])
+        self.register_buffer("alpha", c["alpha"])
+        self.register_buffer("V", c.get("V", torch.zeros(0, 0)))
+
+    def forward(self, x, state):
+        H = self.hidden_size
+        ut, st = state[:, :H], state[:, H:]
+        Wx = torch.matmul(x, self.weight.t()) + self.bias
+        s: List[torch.Tensor] = []
+        for t in range(Wx.shape[1]):
+            It = Wx[:, t]
+            if self.recurrent:
+                It = It + torch.matmul(st, self.V)
+            ut = self.alpha * (ut - st) + (1 - self.alpha) * It
+            st = (ut - self.threshold > 0).to(ut.dtype)
+            s.append(st)
+        return torch.stack(s, dim=1), torch.cat([ut, st], dim=1)
+
+
+class StreamingAdLIF(nn.Module):
+    """
+    adLIF and RadLIF dynamics with state (ut, wt, st).
+    """
+
+    __constants__ = ["recurrent"]
+
+    def __init__(self, c, start):
+        super().__init__()
+        self.kind = "adLIF"
+        self.hidden_size = c["weight"].shape[0]
+        self.recurrent = "V" in c
+        self.threshold = c["threshold"]
+        self.reset_factor = c["reset_factor"]
+        self.start = start
+        self.end = start + 3 * self.hidden_size
+        for name in ["weight", "bias", "alpha", "beta", "a", "b"]:
+            self.register_buffer(name, c[name])
+        self.register_buffer("V", c.get("V", torch.zeros(0, 0)))
+
+    def forward(self, x, state):
+        H = self.hidden_size
+        ut, wt, st = state[:, :H], state[:, H : 2 * H], state[:, 2 * H :]
+        Wx = torch.matmul(x, self.weight.t()) + self.bias
+        s: List[torch.Tensor] = []
+        for t in range(Wx.shape[1]):
+            It = Wx[:, t]
+            if self.recurrent:
+                It = It + torch.matmul(st, self.V)
+            reset = self.reset_factor * st
+            wt = self.beta * wt + self.a * ut + self.b * reset
+            ut = self.alpha * (ut - reset) + (1 - self.alpha) * (It - wt)
+            st = (ut - self.threshold > 0).to(ut.dtype)
+            s.append(st)
+        return torch.stack(s, dim=1), torch.cat([ut, wt, st], dim=1)
+
+
+class StreamingLIFcomplex(nn.Module):
+    """
+    LIFcomplex and ResonateFire dynamics with state (Re(ut), Im(ut), st).
+    """
+
+    __constants__ = ["recurrent"]
+
+    def __init__(self, c, start):
+        super().__init__()
+        self.kind = "LIFcomplex"
+        self.hidden_size = c["weight"].shape[0]
+        self.recurrent = "V" in c
+        self.threshold = c["threshold"]
+        self.reset_factor = c["reset_factor"]
+        self.spike_scale = c["spike_scale"]
+        self.start = start
+        self.end = start + 3 * self.hidden_size
+        for name in ["weight", "bias", "alpha_re", "alpha_im", "gain"]:
+            self.register_buffer(name, c[name])
+        self.register_buffer("V", c.get("V", torch.zeros(0, 0)))
+
+    def forward(self, x, state):
+        H = self.hidden_size
+        ur, ui, st = state[:, :H], state[:, H : 2 * H], state[:, 2 * H :]
+        Wx = torch.matmul(x, self.weight.t()) + self.bias
+        s: List[torch.Tensor] = []
+        for t in range(Wx.shape[1]):
+            It = Wx[:, t]
+            if self.recurrent:
+                It = It + torch.matmul(st, self.V)
+            vr = ur - self.reset_factor * st
+            ur = self.alpha_re * vr - self.alpha_im * ui + self.gain * It
+            ui = self.alpha_re * ui + self.alpha_im * vr
+            st = (self.spike_scale * ur - self.threshold > 0).to(ur.dtype)
+            s.append(st)
+        return torch.stack(s, dim=1), torch.cat([ur, ui, st], dim=1)
+
+
+class StreamingReadout(nn.Module):
+    """
+    Non-spiking LIF readout with state (ut, out, step). The output is the
+    sum of the softmax of the potential over all steps since the beginning
+    of the sequence, skipping the first time_offset steps.
+    """
+
+    def __init__(self, c, start):
+        super().__init__()
+        self.kind = "readout"
+        self.hidden_size = c["weight"].shape[0]
+        self.time_offset = c["time_offset"]
+        self.start = start
+        self.end = start + 2 * self.hidden_size + 1
+        for name in ["weight", "bias", "alpha"]:
+            self.register_buffer(name, c[name])
+
+    def forward(self, x, state):
+        H = self.hidden_size
+        ut, out, step = state[:, :H], state[:, H : 2 * H], state[:, 2 * H :]
+        Wx = torch.matmul(x, self.weight.t()) + self.bias
+        for t in range(Wx.shape[1]):
+            active = (step + t >= self.time_offset).to(ut.dtype)
+            ut = ut + active * (1 - self.alpha) * (Wx[:, t] - ut)
+            out = out + active * F.softmax(ut, dim=1)
+        step = step + Wx.shape[1]
+        return out, torch.cat([ut, out, step], dim=1)
+
+
+class StreamingMLP(nn.Module):
+    """
+    Feedforward MLP layer without state.
+    """
+
+    def __init__(self, c, start):
+        super().__init__()
+        self.kind = "MLP"
+        self.start = start
+        self.end = start
+        self.register_buffer("weight", c["weight"])
+        self.register_buffer("bias", c["bias"])
+
+    def forward(self, x, state):
+        y = torch.sigmoid(torch.matmul(x, self.weight.t()) + self.bias)
+        return y, state
+
+
+class StreamingRNN(nn.Module):
+    """
+    RNN, LiGRU and GRU dynamics with state yt. Unused gate weights are
+    empty tensors.
+    """
+
+    __constants__ = ["cell"]
+
+    def __init__(self, c, start):
+        super().__init__()
+        self.kind = c["kind"]
+        self.cell = c["kind"]
+        self.hidden_size = c["weight"].shape[0]
+        self.start = start
+        self.end = start + self.hidden_size
+        empty = torch.zeros(0, 0)
+        for name in ["weight", "bias", "V"]:
+            self.register_buffer(name, c[name])
+        for gate in ["z", "r"]:
+            for name in ["weight_", "bias_", "V_"]:
+                self.register_buffer(name + gate, c.get(name + gate, empty))
+
+    def forward(self, x, state):
+        yt = state
+        Wx = torch.matmul(x, self.weight.t()) + self.bias
+        if self.cell != "RNN":
+            Wzx = torch.matmul(x, self.weight_z.t()) + self.bias_z
+        else:
+            Wzx = Wx
+        if self.cell == "GRU":
+            Wrx = torch.matmul(x, self.weight_r.t()) + self.bias_r
+        else:
+            Wrx = Wx
+        y: List[torch.Tensor] = []
+        for t in range(Wx.shape[1]):
+            if self.cell == "RNN":
+                yt = torch.sigmoid(Wx[:, t] + torch.matmul(yt, self.V.t()))
+            elif self.cell == "LiGRU":
+                zt = torch.sigmoid(Wzx[:, t] + torch.matmul(yt, self.V_z.t()))
+                ct = torch.relu(Wx[:, t] + torch.matmul(yt, self.V.t()))
+                yt = zt * yt + (1 - zt) * ct
+            else:
+                zt = torch.sigmoid(Wzx[:, t] + torch.matmul(yt, self.V_z.t()))
+                rt = torch.sigmoid(Wrx[:, t] + torch.matmul(yt, self.V_r.t()))
+                ct = torch.tanh(Wx[:, t] + torch.matmul(rt * yt, self.V.t()))
+                yt = zt * yt + (1 - zt) * ct
+            y.append(yt)
+        return torch.stack(y, dim=1), yt
+
+
+class StreamingReadoutANN(nn.Module):
+    """
+    ANN readout with state (sum of softmax of the inputs). The affine
+    transformation is applied to the running sum at every call.
+    """
+
+    def __init__(self, c, start):
+        super().__init__()
+        self.kind = "readout_ann"
+        self.start = start
+        self.end = start + c["weight"].shape[1]
+        self.register_buffer("weight", c["weight"])
+        self.register_buffer("bias", c["bias"])
+
+    def forward(self, x, state):
+        y = state + F.softmax(x, dim=-1).sum(dim=1)
+        return torch.matmul(y, self.weight.t()) + self.bias, y
+
+
+class StreamingMeanDecoder(nn.Module):
+    """
+    Linear decoder applied to the mean over time of the inputs, with state
+    (sum, step).
+    """
+
+    def __init__(self, linear, start):
+        super().__init__()
+        self.kind = "mean_decoder"
+        self.input_size = linear.weight.shape[1]
+        self.start = start
+        self.end = start + self.input_size + 1
+        W, b = fold_norm(linear)
+        self.register_buffer("weight", W)
+        self.register_buffer("bias", b)
+
+    def forward(self, x, state):
+        total = state[:, : self.input_size] + x.sum(dim=1)
+        step = state[:, self.input_size :] + x.shape[1]
+        out = torch.matmul(total / step, self.weight.t()) + self.bias
+        return out, torch.cat([total, step], dim=1)
+
+
+class StreamingS4Block(nn.Module):
+    """
+    One residual block of S4Model in recurrent form. The convolution kernel
+    K[l] = 2*Re(sum_n C'[n]*exp(dtA[n]*l)) of the diagonal SSM is replaced
+    by the equivalent recurrence h[t] = exp(dtA)*h[t-1] + u[t] and
+    y[t] = 2*Re(sum_n C'[n]*h[t, n]), with state (Re(h), Im(h)).
+    """
+
+    __constants__ = [
+        "premix", "glu", "prenorm", "norm_type", "residual1", "residual2", "gelu"
+    ]
+
+    def __init__(self, model, layer, norm, start):
+        super().__init__()
+        self.kind = "S4"
+        self.premix = bool(model.premix)
+        self.glu = model.mix == "GLU"
+        self.prenorm = bool(model.prenorm)
+        self.norm_type = model.normalization
+        self.residual1 = bool(layer.residual1)
+        self.residual2 = bool(model.residual2)
+        self.gelu = isinstance(layer.activation, nn.GELU)
+
+        with torch.no_grad():
+            kernel = layer.kernel
+            dt = torch.exp(kernel.log_dt)
+            C = torch.view_as_complex(kernel.C.contiguous())
+            A = -torch.exp(kernel.log_A_real) + 1j * kernel.A_imag
+            dtA = A * dt.unsqueeze(-1)
+            C = C * (torch.exp(dtA) - 1.0) / A
+            decay = torch.exp(dtA)
+
+        self.h = layer.h
+        self.n = C.shape[1]
+        self.start = start
+        self.end = start + 2 * self.h * self.n
+        self.register_buffer("decay_re", decay.real.clone())
+        self.register_buffer("decay_im", decay.imag.clone())
+        self.register_buffer("C_re", C.real.clone())
+        self.register_buffer("C_im", C.imag.clone())
+        self.register_buffer("D", layer.D.detach().clone())
+
+        # Position-wise mixing of the model and of the layer
+        self.register_buffer("model_mix_w", _mix_weight(model.output_linear[0])[0])
+        self.register_buffer("model_mix_b", _mix_weight(model.output_linear[0])[1])
+        self.register_buffer("layer_mix_w", _mix_weight(layer.output_linear[0])[0])
+        self.register_buffer("layer_mix_b", _mix_weight(layer.output_linear[0])[1])
+
+        # Normalization, batchnorm is stored as an affine transformation
+        self.eps = 0.0
+        if self.norm_type == "batchnorm":
+            with torch.no_grad():
+                scale = norm.weight / torch.sqrt(norm.running_var + norm.eps)
+                shift = norm.bias - norm.running_mean * scale
+        else:
+            scale, shift = norm.weight.detach(), norm.bias.detach()
+            self.eps = float(norm.eps)
+        self.register_buffer("norm_w", scale.clone())
+        self.register_buffer("norm_b", shift.clone())
+
+    def _mix(self, x, w, b):
+        y = torch.matmul(x, w.t()) + b
+        if self.glu:
+            y = y[..., : self.h] * torch.sigmoid(y[..., self.h :])
+        return y
+
+    def _norm(self, x):
+        if self.norm_type == "batchnorm":
+            return x * self.norm_w + self.norm_b
+        return F.layer_norm(x, [self.h], self.norm_w, self.norm_b, self.eps)
+
+    def forward(self, x, state):
+        z = x
+        if not self.premix:
+            z = self._mix(z, self.model_mix_w, self.model_mix_b)
+        if self.prenorm:
+            z = self._norm(z)
+
+        # Diagonal SSM recurrence
+        B = x.shape[0]
+        size = self.h * self.n
+        hr = state[:, :size].reshape(B, self.h, self.n)
+        hi = state[:, size:].reshape(B, self.h, self.n)
+        ys: List[torch.Tensor] = []
+        for t in range(z.shape[1]):
+            hr, hi = (
+                self.decay_re * hr - self.decay_im * hi + z[:, t].unsqueeze(-1),
+                self.decay_re * hi + self.decay_im * hr,
+            )
+            ys.append(2 * (self.C_re * hr - self.C_im * hi).sum(dim=-1))
+        y = torch.stack(ys, dim=1)
+
+        if self.residual1:
+            y = y + z * self.D
+        if self.gelu:
+            y = F.gelu(y)
+        else:
+            y = (y > 0).to(y.dtype)
+        if not self.premix:
+            y = self._mix(y, self.layer_mix_w, self.layer_mix_b)
+
+        if self.residual2:
+            x = y + x
+        else:
+            x = y
+        if not self.prenorm:
+            x = self._norm(x)
+
+        return x, torch.cat([hr.reshape(B, size), hi.reshape(B, size)], dim=1)
+
+
+def _mix_weight(linear):
+    """Weight and bias of a Conv1d with kernel size 1 or of a Linear."""
+    W = linear.weight.detach()
+    if W.dim() == 3:
+        W = W.squeeze(-1)
+    return W.clone(), linear.bias.detach().clone()
+
+
+class StreamingNet(nn.Module):
+    """
+    Chain of streaming layers, optionally preceded by a linear encoder, with
+    the states of all layers packed in a single tensor.
+
+    Arguments
+    ---------
+    layers : list of nn.Module
+        Streaming layers, each with attributes start and end that give the
+        position of its state in the packed state.
+    state_size : int
+        Total size of the packed state.
+    encoder : nn.Linear
+        Linear encoder applied to the inputs, if any.
+    """
+
+    __constants__ = ["encode"]
+
+    def __init__(self, layers, state_size, encoder=None):
+        super().__init__()
+        self.layers = nn.ModuleList(layers)
+        self.state_size = state_size
+        self.encode = encoder is not None
+        if encoder is not None:
+            W, b = fold_norm(encoder)
+        else:
+            W, b = torch.zeros(0, 0), torch.zeros(0)
+        self.register_buffer("encoder_weight", W)
+        self.register_buffer("encoder_bias", b)
+
+    def forward(self, x, state):
+        if self.encode:
+            x = torch.matmul(x, self.encoder_weight.t()) + self.encoder_bias
+        new_state: List[torch.Tensor] = []
+        for layer in self.layers:
+            x, layer_state = layer(x, state[:, layer.start : layer.end])
+            new_state.append(layer_state)
+        return x, torch.cat(new_state, dim=1)
+
+    @torch.jit.export
+    def initial_state(self, batch_size: int):
+        """Returns a zero state for a new sequence."""
+        return torch.zeros(
+            batch_size, self.state_size, device=self.encoder_bias.device
+        )
+
+
+SNN_STREAMING_LAYERS = {
+    "LIF": StreamingLIF,
+    "adLIF": StreamingAdLIF,
+    "LIFcomplex": StreamingLIFcomplex,
+    "readout": StreamingReadout,
+}
+ANN_STREAMING_LAYERS = {
+    "MLP": StreamingMLP,
+    "RNN": StreamingRNN,
+    "LiGRU": StreamingRNN,
+    "GRU": StreamingRNN,
+    "readout_ann": StreamingReadoutANN,
+}
+
+
+def to_streaming(net):
+    """
+    Returns the streaming version of a trained SNN, ANN or S4Model, with
+    the same weights and in eval mode.
+    """
+    net = getattr(net, "_orig_mod", net)
+    name = type(net).__name__
+    start = 0
+    layers = []
+    encoder = None
+
+    if name == "SNN":
+        for c in snn_constants(net):
+            layers.append(SNN_STREAMING_LAYERS[c["kind"]](c, start))
+            start = layers[-1].end
+
+    elif name == "ANN":
+        for c in ann_constants(net):
+            layers.append(ANN_STREAMING_LAYERS[c["kind"]](c, start))
+            start = layers[-1].end
+
+    elif name == "S4Model":
+        encoder = net.encoder
+        for layer, norm in zip(net.s4_layers, net.norms):
+            layers.append(StreamingS4Block(net, layer, norm, start))
+            start = layers[-1].end
+        if net.extra_features["use_readout_layer"]:
+            c = snn_layer_constants(net.decoder)
+            layers.append(StreamingReadout(c, start))
+        else:
+            layers.append(StreamingMeanDecoder(net.decoder, start))
+        start = layers[-1].end
+
+    else:
+        raise NotImplementedError(f"Streaming export of {name} is not supported")
+
+    device = next(net.parameters()).device
+    return StreamingNet(layers, start, encoder).to(device).eval()
+
+
+@torch.no_grad()
+def eager_initial_state(streaming, batch_size):
+    """
+    Draws the random initial state that the eager model draws at the
+    beginning of its forward pass, in the same order, so that exported and
+    eager outputs can be compared under the same seed. ANN and S4 layers
+    start from zero.
+    """
+    device = streaming.encoder_bias.device
+    states = []
+    for layer in streaming.layers:
+        size = layer.end - layer.start
+        if layer.kind in ["LIF", "adLIF"]:
+            H = layer.hidden_size
+            states += [torch.rand(batch_size, H).to(device) for _ in range(size // H)]
+        elif layer.kind == "LIFcomplex":
+            H = layer.hidden_size
+            ut = torch.rand(batch_size, H, dtype=torch.cfloat).to(device)
+            st = torch.rand(batch_size, H).to(device)
+            states += [ut.real, ut.imag, st]
+        elif layer.kind == "readout":
+            H = layer.hidden_size
+            ut = torch.rand(batch_size, H).to(device)
+            states += [ut, torch.zeros(batch_size, H + 1, device=device)]
+        else:
+            states.append(torch.zeros(batch_size, size, device=device))
+
+    # adLIF draws ut, wt, st in that order, which matches the state layout
+    return torch.cat(states, dim=1)
+
+
+def export_model(net, path, fmt="torchscript", batch_size=1, nb_steps=100):
+    """
+    Exports the streaming version of a trained model.
+
+    Arguments
+    ---------
+    net : nn.Module
+        Trained SNN, ANN or S4Model.
+    path : str
+        Path of the exported file.
+    fmt : str
+        Either 'torchscript', loadable with torch.jit.load, or 'onnx',
+        loadable with onnxruntime. Both take inputs (x, state) and return
+        (out, new_state).
+    batch_size : int
+        Batch size of the example inputs used for tracing the ONNX graph.
+        The batch and time dimensions are exported as dynamic axes.
+    nb_steps : int
+        Number of time steps of the example inputs.
+    """
+    if fmt not in ["torchscript", "onnx"]:
+        raise ValueError(f"Invalid export format {fmt}")
+
+    scripted = torch.jit.script(to_streaming(net))
+
+    if fmt == "torchscript":
+        scripted.save(path)
+    else:
+        device = scripted.encoder_bias.device
+        input_size = _input_size(net)
+        x = torch.zeros(batch_size, nb_steps, input_size, device=device)
+        state = scripted.initial_state(batch_size)
+        torch.onnx.export(
+            scripted,
+            (x, state),
+            path,
+            input_names=["x", "state"],
+            output_names=["out", "new_state"],
+            dynamic_axes={
+                "x": {0: "batch", 1: "time"},
+                "state": {0: "batch"},
+                "out": {0: "batch"},
+                "new_state": {0: "batch"},
+            },
+            opset_version=17,
+        )
+
+    logger.info(f"Exported {type(net).__name__} to {path} ({fmt})")
+    return scripted
+
+
+def _input_size(net):
+    net = getattr(net, "_orig_mod", net)
+    if type(net).__name__ == "S4Model":
+        return net.encoder.weight.shape[1]
+    layers = net.snn if hasattr(net, "snn") else net.ann
+    return layers[0].W.weight.shape[1]
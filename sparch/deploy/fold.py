@@ -0,0 +1,167 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is where the constants of trained models are extracted for deployment.
+Neuron parameters are bounded to the same ranges as in the forward pass and
+batch normalization is folded into the feedforward weights.
+"""
+import torch
+import torch.nn as nn
+
+# Layer classes that can be deployed and the dynamics they follow
+SNN_LAYER_KINDS = {
+    "LIFLayer": "LIF",
+    "RLIFLayer": "LIF",
+    "adLIFLayer": "adLIF",
+    "RadLIFLayer": "adLIF",
+    "LIFcomplexLayer": "LIFcomplex",
+    "ResonateFireLayer": "LIFcomplex",
+    "ReadoutLayer": "readout",
+}
+ANN_LAYER_KINDS = {
+    "MLPLayer": "MLP",
+    "RNNLayer": "RNN",
+    "LiGRULayer": "LiGRU",
+    "GRULayer": "GRU",
+    "ReadoutLayerANN": "readout_ann",
+}
+
+
+def fold_norm(linear, norm=None):
+    """
+    Returns the weight and bias of a linear layer followed by an optional
+    batch normalization (in eval mode) as a single affine transformation.
+
+    Arguments
+    ---------
+    linear : nn.Linear
+        Feedforward weights of the layer.
+    norm : nn.BatchNorm1d
+        Normalization applied to the outputs of linear, if any.
+    """
+    W = linear.weight.detach().clone()
+    if linear.bias is not None:
+        b = linear.bias.detach().clone()
+    else:
+        b = torch.zeros(W.shape[0], dtype=W.dtype, device=W.device)
+
+    if norm is None:
+        return W, b
+    if not isinstance(norm, nn.BatchNorm1d):
+        raise NotImplementedError(f"Cannot fold {type(norm).__name__} into weights")
+
+    scale = norm.weight.detach() / torch.sqrt(norm.running_var + norm.eps)
+    return W * scale[:, None], (b - norm.running_mean) * scale + norm.bias.detach()
+
+
+def _norm(layer, name="norm"):
+    return getattr(layer, name) if layer.normalize else None
+
+
+@torch.no_grad()
+def snn_layer_constants(layer):
+    """
+    Returns a dict with the folded affine transformation ('weight', 'bias')
+    and the bounded neuron constants of a single SNN layer.
+    """
+    name = type(layer).__name__
+    if name not in SNN_LAYER_KINDS:
+        raise NotImplementedError(f"Deployment of {name} is not supported")
+    if getattr(layer, "bidirectional", False):
+        raise NotImplementedError("Bidirectional layers cannot be deployed")
+
+    kind = SNN_LAYER_KINDS[name]
+    W, b = fold_norm(layer.W, _norm(layer))
+    c = {"kind": kind, "weight": W, "bias": b}
+
+    # Complex neurons spike when spike_scale*Re(ut) crosses the threshold
+    if name == "LIFcomplexLayer":
+        alpha = torch.exp(
+            (-torch.exp(layer.log_log_alpha) + 1j * layer.alpha_img)
+            * torch.exp(layer.log_dt)
+        )
+        c["gain"] = layer.b.detach().clone()
+        c["reset_factor"] = float(layer.reset_factor)
+        c["spike_scale"] = 2.0
+    elif name == "ResonateFireLayer":
+        alpha_real = torch.clamp(layer.alpha_real, max=-0.1)
+        alpha = 1 + (alpha_real + 1j * layer.alpha_im) * layer.dt
+        c["gain"] = torch.ones_like(layer.alpha_im)
+        c["reset_factor"] = 1.0
+        c["spike_scale"] = 1.0
+
+    if kind == "LIFcomplex":
+        c["alpha_re"] = alpha.real.clone()
+        c["alpha_im"] = alpha.imag.clone()
+    else:
+        c["alpha"] = torch.clamp(
+            layer.alpha, min=layer.alpha_lim[0], max=layer.alpha_lim[1]
+        )
+
+    if kind == "adLIF":
+        c["beta"] = torch.clamp(layer.beta, min=layer.beta_lim[0], max=layer.beta_lim[1])
+        c["a"] = torch.clamp(layer.a, min=layer.a_lim[0], max=layer.a_lim[1])
+        c["b"] = torch.clamp(layer.b, min=layer.b_lim[0], max=layer.b_lim[1])
+        c["reset_factor"] = float(getattr(layer, "reset_factor", 1))
+
+    if kind == "readout":
+        c["time_offset"] = int(layer.time_offset)
+    else:
+        c["threshold"] = float(layer.threshold)
+
+    # Recurrent weights without self-connections, used as st @ V
+    if hasattr(layer, "V"):
+        c["V"] = layer.V.weight.detach().clone().fill_diagonal_(0)
+
+    return c
+
+
+def snn_constants(net):
+    """Returns the constants of all layers of a trained SNN."""
+    extra_features = net.extra_features or {}
+    if extra_features.get("residual", False):
+        raise NotImplementedError("Residual SNNs cannot be deployed")
+    return [snn_layer_constants(layer) for layer in net.snn]
+
+
+@torch.no_grad()
+def ann_layer_constants(layer):
+    """
+    Returns a dict with the folded affine transformations and recurrent
+    weights of a single ANN layer.
+    """
+    name = type(layer).__name__
+    if name not in ANN_LAYER_KINDS:
+        raise NotImplementedError(f"Deployment of {name} is not supported")
+    if getattr(layer, "bidirectional", False):
+        raise NotImplementedError("Bidirectional layers cannot be deployed")
+
+    kind = ANN_LAYER_KINDS[name]
+    W, b = fold_norm(layer.W, _norm(layer))
+    c = {"kind": kind, "weight": W, "bias": b}
+
+    # Gates of LiGRU and GRU have their own weights and normalization
+    for gate in ["z", "r"]:
+        if hasattr(layer, "W" + gate):
+            W, b = fold_norm(getattr(layer, "W" + gate), _norm(layer, "norm" + gate))
+            c["weight_" + gate] = W
+            c["bias_" + gate] = b
+            c["V_" + gate] = getattr(layer, "V" + gate).weight.detach().clone()
+
+    # Recurrent weights, used as nn.Linear i.e. yt @ V.T
+    if hasattr(layer, "V"):
+        c["V"] = layer.V.weight.detach().clone()
+
+    return c
+
+
+def ann_constants(net):
+    """Returns the constants of all layers of a trained ANN."""
+    return [ann_layer_constants(layer) for layer in net.ann]
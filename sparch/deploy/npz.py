@@ -0,0 +1,73 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is where trained SNNs are converted to .npz files for the NumPy
+inference runtime defined in sparch/deploy/runtime.py.
+
+Usage: python -m sparch.deploy.npz path/to/best_model.pth path/to/model.npz
+"""
+import argparse
+import logging
+
+import numpy as np
+import torch
+
+from sparch.deploy.fold import snn_constants
+from sparch.models.weights import load_model
+
+logger = logging.getLogger(__name__)
+
+
+def snn_to_npz(net, path, compress=True):
+    """
+    Saves the folded constants of a trained SNN to a .npz file. The arrays
+    of layer i are stored under the keys 'layer{i}.{name}', scalars as 0-d
+    arrays, and the layer kinds under the key 'kinds'.
+
+    Arguments
+    ---------
+    net : SNN
+        Trained SNN, possibly wrapped by torch.compile.
+    path : str
+        Path of the .npz file.
+    compress : bool
+        If True, the arrays are compressed with zlib.
+    """
+    layers = snn_constants(getattr(net, "_orig_mod", net))
+    arrays = {"kinds": np.array([c["kind"] for c in layers])}
+    for i, c in enumerate(layers):
+        for name, value in c.items():
+            if name == "kind":
+                continue
+            if isinstance(value, torch.Tensor):
+                value = value.detach().cpu().numpy()
+            arrays[f"layer{i}.{name}"] = np.asarray(value, dtype=np.float32)
+
+    if compress:
+        np.savez_compressed(path, **arrays)
+    else:
+        np.savez(path, **arrays)
+    logger.info(f"Saved {len(layers)} layers to {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a trained SNN to .npz.")
+    parser.add_argument("model_path", type=str, help="Path of the saved model.")
+    parser.add_argument("output", type=str, help="Path of the .npz file.")
+    parser.add_argument("--no_compress", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    net = load_model(args.model_path, map_location="cpu")
+    snn_to_npz(net, args.output, compress=not args.no_compress)
+
+
+if __name__ == "__main__":
+    main()
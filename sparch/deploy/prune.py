@@ -0,0 +1,468 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is where the pruning of the inactive neurons of trained SNNs is defined.
+
+The mean firing rate of every hidden neuron is measured over a dataset.
+Neurons that never spike (dead) or spike at every step (saturated) carry no
+information and are removed from their layer: their rows of W, their rows
+and columns of V, their entries of the batch normalization and of the
+per-neuron parameters (alpha, beta, log_dt, alpha_img, ...), and their
+columns of W in the next layer. The constant input that a removed neuron
+sent to the next layer, and to its own layer through V, is folded into the
+bias of the batch normalization or of W, so that in eval mode the outputs
+only change through the random initial states. With looser thresholds,
+neurons that rarely or almost always spike are replaced by their mean rate.
+The RLIFcomplex1MinAlpha neurons scale their recurrent input differently
+from Wx, so only their silent neurons are removed.
+
+To check the folding, the outputs of the model before and after pruning
+are compared on the test set with zero initial states, which are the only
+random part of the neurons in eval mode.
+
+The compacted model is saved as weight files with the new layer sizes, see
+sparch/models/weights.py, with a report of the accuracy and latency before
+and after pruning.
+
+Usage: python -m sparch.deploy.prune best_model.json pruned --data_folder SHD
+"""
+import argparse
+import contextlib
+import copy
+import json
+import logging
+import os
+import time
+
+import torch
+import torch.nn as nn
+
+from sparch.models.weights import load_model
+from sparch.models.weights import save_weights
+
+logger = logging.getLogger(__name__)
+
+# Layers whose projections mix the neurons of the layer
+UNSUPPORTED = ["LIFcomplexDiscr", "LIFcomplex_gatedB", "LIFcomplex_gatedDt"]
+
+# Layers whose recurrent input is not added to Wx, only silent neurons are removed
+UNFOLDED_RECURRENT = ["RLIFcomplex1MinAlpha"]
+
+# Submodules of a layer that are pruned, the others must have no parameters
+PRUNED_MODULES = ["W", "V", "norm", "drop", "output_linear"]
+
+
+def check_prunable(net):
+    """Returns the SNN to prune, or raises an error if it cannot be pruned."""
+    net = getattr(net, "_orig_mod", net)
+    if not getattr(net, "is_snn", False) or not hasattr(net, "snn"):
+        raise ValueError("Pruning is only implemented for SNN models")
+    if net.extra_features.get("residual"):
+        raise ValueError("Pruning does not support residual connections")
+    if net.normalization == "layernorm":
+        raise ValueError("Pruning does not support layernorm")
+    if net.neuron_type in UNSUPPORTED:
+        raise ValueError(f"Pruning does not support {net.neuron_type} neurons")
+    return net
+
+
+@torch.no_grad()
+def activity_stats(net, loader, device, max_batches=None):
+    """
+    Returns the mean firing rate of the outputs of every spiking layer of an
+    SNN over the examples of a loader, as a list of tensors of shape
+    (hidden_size * (1 + bidirectional)), forward neurons first.
+    """
+    net = check_prunable(net)
+    track_firing_rates = net.track_firing_rates
+    net.track_firing_rates = True
+    net.eval()
+
+    total = None
+    count = 0
+    try:
+        for step, (x, _, _) in enumerate(loader):
+            if max_batches is not None and step >= max_batches:
+                break
+            _, rates = net(x.to(device))
+            rates = rates.double() * x.shape[0]
+            total = rates if total is None else total + rates
+            count += x.shape[0]
+    finally:
+        net.track_firing_rates = track_firing_rates
+
+    if count == 0:
+        raise ValueError("No examples to measure the activity of the neurons")
+
+    # One rate per output of the spiking layers, in order
+    nb_spiking = net.num_layers - 1 if net.use_readout_layer else net.num_layers
+    sizes = [
+        layer.hidden_size * (1 + net.bidirectional) for layer in net.snn[:nb_spiking]
+    ]
+    return list((total / count).float().cpu().split(sizes))
+
+
+def _select(module, name, index, dim=0):
+    """Keeps the entries of a parameter or buffer at index along dim."""
+    tensor = getattr(module, name)
+    if tensor is None:
+        return
+    data = tensor.data.index_select(dim, index.to(tensor.device))
+    if isinstance(tensor, nn.Parameter):
+        param = nn.Parameter(data, requires_grad=tensor.requires_grad)
+        # Keep attributes such as the learning rate in _optim
+        param.__dict__.update(tensor.__dict__)
+        module._parameters[name] = param
+    else:
+        module._buffers[name] = data
+
+
+def _can_shift(layer):
+    return layer.normalize or layer.W.bias is not None
+
+
+def _shift_input(layer, shift, normalized):
+    """
+    Adds a constant to the input currents of the neurons of a layer, after
+    the normalization if normalized is True and before it otherwise.
+    """
+    if layer.normalize:
+        norm = layer.norm
+        if not normalized:
+            # Batch normalization in eval mode is affine
+            shift = shift * norm.weight / torch.sqrt(norm.running_var + norm.eps)
+        norm.bias.data += shift
+    else:
+        layer.W.bias.data += shift
+
+
+def _recurrent_shift(layer, index, rates):
+    """
+    Constant recurrent input of the neurons of a layer coming from the
+    neurons at index, which fire at the given mean rates.
+    """
+    V = getattr(layer, "V", None)
+    if isinstance(V, nn.Linear):
+        # Recurrent input st @ V.weight
+        return rates @ V.weight[index, :]
+    if isinstance(V, nn.Parameter):
+        # Recurrent input F.linear(st, V)
+        return V[:, index] @ rates
+    return None
+
+
+def prune_neurons(layer, keep):
+    """Keeps the neurons of a spiking layer at index keep."""
+    hidden_size = layer.hidden_size
+    for name, module in layer.named_children():
+        if name not in PRUNED_MODULES and any(True for _ in module.parameters()):
+            raise ValueError(f"Cannot prune the {name} module of {type(layer)}")
+
+    _select(layer.W, "weight", keep, 0)
+    _select(layer.W, "bias", keep, 0)
+    layer.W.out_features = len(keep)
+
+    V = getattr(layer, "V", None)
+    if isinstance(V, nn.Linear):
+        _select(V, "weight", keep, 0)
+        _select(V, "weight", keep, 1)
+        V.in_features = V.out_features = len(keep)
+    elif isinstance(V, nn.Parameter):
+        _select(layer, "V", keep, 0)
+        _select(layer, "V", keep, 1)
+
+    if layer.normalize:
+        for name in ["weight", "bias", "running_mean", "running_var"]:
+            _select(layer.norm, name, keep, 0)
+        layer.norm.num_features = len(keep)
+
+    # Unused 1x1 convolution followed by a GLU of the complex layers
+    output_linear = getattr(layer, "output_linear", None)
+    if output_linear is not None:
+        conv = output_linear[0]
+        _select(conv, "weight", torch.cat([keep, keep + hidden_size]), 0)
+        _select(conv, "weight", keep, 1)
+        _select(conv, "bias", torch.cat([keep, keep + hidden_size]), 0)
+        conv.in_channels = len(keep)
+        conv.out_channels = 2 * len(keep)
+
+    # Per-neuron parameters, e.g. alpha, beta, log_dt or alpha_img
+    tensors = list(layer._parameters.items()) + list(layer._buffers.items())
+    for name, tensor in tensors:
+        if name == "V" or tensor is None or tensor.dim() == 0:
+            continue
+        if tensor.shape[0] == hidden_size:
+            _select(layer, name, keep, 0)
+
+    layer.hidden_size = len(keep)
+
+
+def prune_inputs(layer, keep, nb_inputs, bidirectional):
+    """
+    Keeps the inputs of a layer coming from the neurons at index keep of a
+    previous layer with nb_inputs neurons.
+    """
+    directions = 1 + bidirectional
+    cols = torch.cat([keep + d * nb_inputs for d in range(directions)])
+    _select(layer.W, "weight", cols, 1)
+    layer.W.in_features = len(cols)
+    layer.input_size = len(cols)
+
+
+@torch.no_grad()
+def prune_snn(net, rates, dead_rate=0.0, saturated_rate=1.0):
+    """
+    Removes the dead and saturated neurons of the hidden layers of an SNN in
+    place and returns the number of neurons removed from each layer.
+
+    Arguments
+    ---------
+    net : SNN
+        Trained SNN, possibly wrapped by torch.compile.
+    rates : list of tensors
+        Mean firing rates of the spiking layers, see activity_stats.
+    dead_rate : float
+        Neurons firing at most at this rate are dead.
+    saturated_rate : float
+        Neurons firing at least at this rate are saturated.
+    """
+    net = check_prunable(net)
+    net.eval()
+    net.layer_sizes = list(net.layer_sizes)
+    directions = 1 + net.bidirectional
+
+    # The outputs of the last layer are the classes
+    report = []
+    for i in range(net.num_layers - 1):
+        layer, next_layer = net.snn[i], net.snn[i + 1]
+        hidden_size = layer.hidden_size
+        r = rates[i].to(layer.W.weight.device).view(directions, hidden_size)
+
+        # Neurons with constant outputs in all directions
+        removable = ((r <= dead_rate) | (r >= saturated_rate)).all(0)
+        recurrent = getattr(layer, "V", None) is not None
+        foldable = _can_shift(layer) and net.neuron_type not in UNFOLDED_RECURRENT
+        if not _can_shift(next_layer) or (recurrent and not foldable):
+            # No bias to hold the constant inputs, only silent neurons
+            removable &= (r == 0).all(0)
+        if removable.all():
+            removable[0] = False
+
+        removed = removable.nonzero().flatten()
+        keep = (~removable).nonzero().flatten()
+        dead = int(((r <= dead_rate).all(0) & removable).sum())
+        report.append(
+            {
+                "layer": i,
+                "neurons": hidden_size,
+                "dead": dead,
+                "saturated": len(removed) - dead,
+                "kept": len(keep),
+            }
+        )
+        if len(removed) == 0:
+            continue
+
+        # Inputs of the next layer from the removed neurons
+        cols = torch.cat([removed + d * hidden_size for d in range(directions)])
+        shift = next_layer.W.weight[:, cols] @ r[:, removed].flatten()
+        if shift.any():
+            _shift_input(next_layer, shift, normalized=False)
+
+        # Shared recurrent weights, mean rate of both directions
+        shift = _recurrent_shift(layer, removed, r[:, removed].mean(0))
+        if shift is not None and shift.any():
+            _shift_input(layer, shift, normalized=True)
+
+        prune_neurons(layer, keep)
+        prune_inputs(next_layer, keep, hidden_size, net.bidirectional)
+        net.layer_sizes[i] = len(keep)
+
+    return report
+
+
+@torch.no_grad()
+def evaluate(net, loader, device):
+    """
+    Returns the accuracy of an SNN over the examples of a loader and its
+    mean latency per batch in seconds, without the firing rates.
+    """
+    track_firing_rates = net.track_firing_rates
+    net.track_firing_rates = False
+    net.eval()
+
+    correct, total, elapsed, nb_batches = 0, 0, 0.0, 0
+    try:
+        for step, (x, _, y) in enumerate(loader):
+            x = x.to(device)
+            torch.manual_seed(step)
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            start = time.perf_counter()
+            output, _ = net(x)
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            elapsed += time.perf_counter() - start
+            correct += (output.argmax(1).cpu() == y).sum().item()
+            total += y.numel()
+            nb_batches += 1
+    finally:
+        net.track_firing_rates = track_firing_rates
+
+    return correct / total, elapsed / nb_batches
+
+
+@contextlib.contextmanager
+def zero_initial_states():
+    """Starts the neurons from zero states instead of uniform random ones."""
+    rand = torch.rand
+    torch.rand = lambda *size, **kwargs: torch.zeros(*size, **kwargs)
+    try:
+        yield
+    finally:
+        torch.rand = rand
+
+
+@torch.no_grad()
+def compare_outputs(net, pruned, loader, device, max_batches=None):
+    """
+    Returns the largest absolute difference between the outputs of an SNN
+    and of its pruned version over the examples of a loader, and the
+    fraction of examples on which they predict the same class. Both models
+    run in eval mode with zero initial states, so that a pruning that keeps
+    the outputs of the layers gives the same outputs up to rounding.
+    """
+    models = [check_prunable(net), check_prunable(pruned)]
+    track_firing_rates = [model.track_firing_rates for model in models]
+    for model in models:
+        model.track_firing_rates = False
+        model.eval()
+
+    deviation, agree, total = 0.0, 0, 0
+    try:
+        for step, (x, _, _) in enumerate(loader):
+            if max_batches is not None and step >= max_batches:
+                break
+            x = x.to(device)
+            with zero_initial_states():
+                output, _ = models[0](x)
+                pruned_output, _ = models[1](x)
+            deviation = max(deviation, (output - pruned_output).abs().max().item())
+            agree += (output.argmax(1) == pruned_output.argmax(1)).sum().item()
+            total += x.shape[0]
+    finally:
+        for model, track in zip(models, track_firing_rates):
+            model.track_firing_rates = track
+
+    return deviation, agree / total
+
+
+def count_parameters(net):
+    """Number of parameters of a model."""
+    return sum(p.numel() for p in net.parameters())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prune inactive SNN neurons.")
+    parser.add_argument("model_path", type=str, help="Path of the saved model.")
+    parser.add_argument("output", type=str, help="Path of the pruned model.")
+    parser.add_argument("--dataset_name", type=str, default="shd")
+    parser.add_argument("--data_folder", type=str, default="SHD")
+    parser.add_argument("--nb_steps", type=int, default=100)
+    parser.add_argument("--max_time", type=float, default=1.4)
+    parser.add_argument("--spatial_bin", type=int, default=1)
+    parser.add_argument("--batch_size", type=int, default=128)
+    parser.add_argument(
+        "--stats_split",
+        type=str,
+        default="train",
+        help="Split on which the firing rates of the neurons are measured.",
+    )
+    parser.add_argument(
+        "--max_batches",
+        type=int,
+        default=None,
+        help="Maximum number of batches on which the rates are measured.",
+    )
+    parser.add_argument("--dead_rate", type=float, default=0.0)
+    parser.add_argument("--saturated_rate", type=float, default=1.0)
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    from sparch.dataloaders.spiking_datasets import load_shd_or_ssc
+
+    logging.basicConfig(level=logging.INFO)
+    device = torch.device(args.device)
+    net = check_prunable(load_model(args.model_path, map_location=device))
+
+    def loader(split):
+        return load_shd_or_ssc(
+            dataset_name=args.dataset_name,
+            data_folder=args.data_folder,
+            split=split,
+            batch_size=args.batch_size,
+            nb_steps=args.nb_steps,
+            max_time=args.max_time,
+            spatial_bin=args.spatial_bin,
+            shuffle=False,
+        )
+
+    rates = activity_stats(net, loader(args.stats_split), device, args.max_batches)
+    test_loader = loader("test")
+    acc, latency = evaluate(net, test_loader, device)
+    params = count_parameters(net)
+    original = copy.deepcopy(net)
+
+    layers = prune_snn(net, rates, args.dead_rate, args.saturated_rate)
+    pruned_acc, pruned_latency = evaluate(net, test_loader, device)
+    deviation, agreement = compare_outputs(original, net, test_loader, device)
+    pruned_params = count_parameters(net)
+    save_weights(net, args.output)
+
+    report = {
+        "model_path": args.model_path,
+        "stats_split": args.stats_split,
+        "dead_rate": args.dead_rate,
+        "saturated_rate": args.saturated_rate,
+        "layers": layers,
+        "layer_sizes": list(net.layer_sizes),
+        "parameters": [params, pruned_params],
+        "test_acc": [acc, pruned_acc],
+        "latency": [latency, pruned_latency],
+        "speedup": latency / pruned_latency,
+        "output_deviation": deviation,
+        "prediction_agreement": agreement,
+    }
+    report_path = os.path.splitext(args.output)[0] + "_report.json"
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for layer in layers:
+        logger.info(
+            f"Layer {layer['layer']}: removed {layer['dead']} dead and "
+            f"{layer['saturated']} saturated of {layer['neurons']} neurons"
+        )
+    logger.info(f"Parameters: {params} -> {pruned_params}")
+    logger.info(
+        f"Test accuracy: {acc:.4f} -> {pruned_acc:.4f} ({pruned_acc - acc:+.4f})"
+    )
+    logger.info(
+        f"Latency per batch: {1e3 * latency:.1f} ms -> {1e3 * pruned_latency:.1f} "
+        f"ms ({report['speedup']:.2f}x)"
+    )
+    logger.info(
+        f"Outputs with zero initial states: max deviation {deviation:.2e}, "
+        f"same prediction on {100 * agreement:.2f}% of the test examples"
+    )
+    logger.info(f"Saved pruned model to {args.output}, report to {report_path}")
+
+
+if __name__ == "__main__":
+    main()
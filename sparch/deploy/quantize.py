@@ -0,0 +1,269 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is where the post-training quantization of SNNs is defined.
+
+The feedforward weights (with batch normalization folded in) and the
+recurrent weights are quantized symmetrically per output channel to int8
+or int16. Since the inputs of every layer are binary spikes, the input
+currents are integer accumulations of weight rows. They are converted to
+the fixed-point format of the membrane potentials with a per-channel
+integer multiplier and right shift, and the membrane updates only use
+integer operations, with the decay factors in Q15. The only floating-point
+operation left is the softmax accumulated by the readout layer.
+
+Supported layers are LIF, adLIF, RLIF, RadLIF and ReadoutLayer. Inputs of
+the first layer are assumed to be binary, as for the SHD and SSC datasets.
+"""
+from typing import List
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from sparch.deploy.fold import snn_constants
+
+# Number of fractional bits of the decay factors
+DECAY_BITS = 15
+
+
+def quantize_per_channel(W, bits, dim):
+    """
+    Symmetric quantization of W with one scale per index of dimension dim.
+    Returns the integer weights and the scales.
+    """
+    reduce_dim = 1 - dim
+    scale = W.abs().amax(dim=reduce_dim) / (2 ** (bits - 1) - 1)
+    scale = torch.where(scale > 0, scale, torch.ones_like(scale))
+    q = torch.round(W / scale.unsqueeze(reduce_dim))
+    return q.to(torch.int8 if bits <= 8 else torch.int16), scale
+
+
+def fixed_point_multiplier(scale):
+    """
+    Returns the per-channel integer multiplier m and right shift n such that
+    x * scale is approximated by (x * m + 2^(n-1)) >> n for integers x, with
+    m between 2^30 and 2^31.
+    """
+    scale = scale.double()
+    shift = (30 - torch.floor(torch.log2(scale))).to(torch.int64)
+    m = torch.round(scale * torch.pow(2.0, shift.double())).to(torch.int64)
+    return m, shift
+
+
+def _rescale(x, m, shift, half):
+    return (x * m + half) >> shift
+
+
+def _decay(q, x):
+    return (q * x + (1 << (DECAY_BITS - 1))) >> DECAY_BITS
+
+
+def _q15(x):
+    return torch.round(x.double() * 2**DECAY_BITS).to(torch.int64)
+
+
+class QuantizedLIF(nn.Module):
+    """
+    Fixed-point LIF, RLIF, adLIF and RadLIF dynamics with the same state
+    layout as the streaming modules of sparch/deploy/export.py.
+    """
+
+    __constants__ = ["recurrent", "adaptive"]
+
+    def __init__(self, c, start, weight_bits, state_bits):
+        super().__init__()
+        self.kind = c["kind"]
+        self.hidden_size = c["weight"].shape[0]
+        self.recurrent = "V" in c
+        self.adaptive = c["kind"] == "adLIF"
+        self.frac_bits = state_bits - 5
+        self.state_min = -(2 ** (state_bits - 1))
+        self.state_max = 2 ** (state_bits - 1) - 1
+        self.start = start
+        self.end = start + (3 if self.adaptive else 2) * self.hidden_size
+        self.exact_dtype = torch.float32 if weight_bits <= 8 else torch.float64
+        one = 2**self.frac_bits
+        alpha = c["alpha"].double()
+
+        # Input currents in units of the membrane potential, including 1-alpha
+        Wq, sw = quantize_per_channel(c["weight"], weight_bits, dim=0)
+        self.register_buffer("weight", Wq)
+        self.register_buffer("bias", torch.round(c["bias"] / sw).to(torch.int64))
+        m, n = fixed_point_multiplier((1 - alpha) * sw * one)
+        self.register_buffer("w_mult", m)
+        self.register_buffer("w_shift", n)
+        self.register_buffer("w_half", torch.pow(2, n - 1))
+
+        if self.recurrent:
+            Vq, sv = quantize_per_channel(c["V"], weight_bits, dim=1)
+            m, n = fixed_point_multiplier((1 - alpha) * sv * one)
+        else:
+            Vq = torch.zeros(0, 0, dtype=Wq.dtype)
+            m = n = torch.zeros(0, dtype=torch.int64)
+        self.register_buffer("V", Vq)
+        self.register_buffer("v_mult", m)
+        self.register_buffer("v_shift", n)
+        self.register_buffer("v_half", torch.pow(2, n - 1))
+
+        reset_factor = c.get("reset_factor", 1.0)
+        self.threshold = int(round(c["threshold"] * one))
+        self.reset = int(round(reset_factor * one))
+        self.register_buffer("alpha", _q15(alpha))
+        if self.adaptive:
+            self.register_buffer("beta", _q15(c["beta"]))
+            self.register_buffer("a", _q15(c["a"]))
+            self.register_buffer("one_minus_alpha", _q15(1 - alpha))
+            self.register_buffer(
+                "b_reset", torch.round(c["b"].double() * reset_factor * one).to(torch.int64)
+            )
+        else:
+            empty = torch.zeros(0, dtype=torch.int64)
+            for name in ["beta", "a", "one_minus_alpha", "b_reset"]:
+                self.register_buffer(name, empty)
+
+    def forward(self, x, state):
+        H = self.hidden_size
+        one = 2.0**self.frac_bits
+        ut = torch.round(state[:, :H] * one).to(torch.int64)
+        wt = torch.round(state[:, H : 2 * H] * one).to(torch.int64)
+        st = state[:, -H:].round().to(torch.int64)
+
+        # Integer accumulation of weight rows, exact in floating point
+        acc = torch.matmul(x.to(self.exact_dtype), self.weight.t().to(self.exact_dtype))
+        acc = acc.round().to(torch.int64) + self.bias
+        cur = _rescale(acc, self.w_mult, self.w_shift, self.w_half)
+        V = self.V.to(self.exact_dtype)
+
+        s: List[torch.Tensor] = []
+        for t in range(cur.shape[1]):
+            It = cur[:, t]
+            if self.recurrent:
+                rec = torch.matmul(st.to(self.exact_dtype), V).round().to(torch.int64)
+                It = It + _rescale(rec, self.v_mult, self.v_shift, self.v_half)
+            if self.adaptive:
+                wt = _decay(self.beta, wt) + _decay(self.a, ut) + self.b_reset * st
+                It = It - _decay(self.one_minus_alpha, wt)
+                wt = wt.clamp(self.state_min, self.state_max)
+            ut = _decay(self.alpha, ut - self.reset * st) + It
+            ut = ut.clamp(self.state_min, self.state_max)
+            st = (ut > self.threshold).to(torch.int64)
+            s.append(st)
+
+        states = [ut.float() / one]
+        if self.adaptive:
+            states.append(wt.float() / one)
+        states.append(st.float())
+        return torch.stack(s, dim=1).float(), torch.cat(states, dim=1)
+
+
+class QuantizedReadout(nn.Module):
+    """
+    Fixed-point non-spiking LIF readout. The softmax of the potential is
+    accumulated in floating point.
+    """
+
+    def __init__(self, c, start, weight_bits, state_bits):
+        super().__init__()
+        self.kind = "readout"
+        self.hidden_size = c["weight"].shape[0]
+        self.time_offset = c["time_offset"]
+        self.frac_bits = state_bits - 5
+        self.state_min = -(2 ** (state_bits - 1))
+        self.state_max = 2 ** (state_bits - 1) - 1
+        self.start = start
+        self.end = start + 2 * self.hidden_size + 1
+        self.exact_dtype = torch.float32 if weight_bits <= 8 else torch.float64
+        alpha = c["alpha"].double()
+
+        Wq, sw = quantize_per_channel(c["weight"], weight_bits, dim=0)
+        self.register_buffer("weight", Wq)
+        self.register_buffer("bias", torch.round(c["bias"] / sw).to(torch.int64))
+        m, n = fixed_point_multiplier((1 - alpha) * sw * 2**self.frac_bits)
+        self.register_buffer("w_mult", m)
+        self.register_buffer("w_shift", n)
+        self.register_buffer("w_half", torch.pow(2, n - 1))
+        self.register_buffer("alpha", _q15(alpha))
+
+    def forward(self, x, state):
+        H = self.hidden_size
+        one = 2.0**self.frac_bits
+        ut = torch.round(state[:, :H] * one).to(torch.int64)
+        out, step = state[:, H : 2 * H], state[:, 2 * H :]
+
+        acc = torch.matmul(x.to(self.exact_dtype), self.weight.t().to(self.exact_dtype))
+        acc = acc.round().to(torch.int64) + self.bias
+        cur = _rescale(acc, self.w_mult, self.w_shift, self.w_half)
+
+        for t in range(cur.shape[1]):
+            active = (step + t >= self.time_offset).to(torch.int64)
+            ut_new = (_decay(self.alpha, ut) + cur[:, t]).clamp(self.state_min, self.state_max)
+            ut = active * ut_new + (1 - active) * ut
+            out = out + active * F.softmax(ut.float() / one, dim=1)
+        step = step + cur.shape[1]
+        return out, torch.cat([ut.float() / one, out, step], dim=1)
+
+
+class QuantizedSNN(nn.Module):
+    """
+    Chain of quantized layers. The forward takes an input chunk and the
+    packed floating-point state of sparch/deploy/export.py, which is
+    converted to fixed point on entry and back on exit.
+    """
+
+    def __init__(self, layers, state_size):
+        super().__init__()
+        self.layers = nn.ModuleList(layers)
+        self.state_size = state_size
+
+    def forward(self, x, state):
+        new_state: List[torch.Tensor] = []
+        for layer in self.layers:
+            x, layer_state = layer(x, state[:, layer.start : layer.end])
+            new_state.append(layer_state)
+        return x, torch.cat(new_state, dim=1)
+
+    def initial_state(self, batch_size: int):
+        """Returns a zero state for a new sequence."""
+        return torch.zeros(batch_size, self.state_size)
+
+
+@torch.no_grad()
+def quantize_snn(net, weight_bits=8, state_bits=16):
+    """
+    Returns the quantized version of a trained SNN.
+
+    Arguments
+    ---------
+    net : SNN
+        Trained SNN with LIF, adLIF, RLIF or RadLIF layers and a readout.
+    weight_bits : int
+        Number of bits of the weights, either 8 or 16.
+    state_bits : int
+        Number of bits of the membrane potentials and adaptation variables,
+        of which state_bits-5 are fractional bits.
+    """
+    if weight_bits not in [8, 16]:
+        raise ValueError(f"Invalid number of weight bits {weight_bits}")
+    if state_bits not in [16, 32]:
+        raise ValueError(f"Invalid number of state bits {state_bits}")
+
+    layers = []
+    start = 0
+    for c in snn_constants(getattr(net, "_orig_mod", net)):
+        if c["kind"] in ["LIF", "adLIF"]:
+            layers.append(QuantizedLIF(c, start, weight_bits, state_bits))
+        elif c["kind"] == "readout":
+            layers.append(QuantizedReadout(c, start, weight_bits, state_bits))
+        else:
+            raise NotImplementedError(f"Quantization of {c['kind']} is not supported")
+        start = layers[-1].end
+
+    return QuantizedSNN(layers, start).cpu().eval()
@@ -0,0 +1,150 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is where the NumPy inference runtime for trained SNNs is defined.
+
+It only depends on numpy, so that it can be used on machines without torch,
+and loads the .npz files written by sparch/deploy/npz.py. The layer dynamics
+are the same as in sparch/models/snns.py in eval mode, with the feedforward
+projections computed for all steps at once and the neuron states updated
+for the whole batch at every step.
+
+The state of all layers is packed in a single (batch, state_size) array with
+the same layout as the streaming modules of sparch/deploy/export.py, so that
+long sequences can be processed chunk by chunk.
+"""
+import numpy as np
+
+
+def _softmax(x):
+    e = np.exp(x - x.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+
+def _lif(c, x, state):
+    H = c["weight"].shape[0]
+    ut, st = state[:, :H], state[:, H:]
+    Wx = x @ c["weight"].T + c["bias"]
+    alpha, V = c["alpha"], c.get("V")
+    s = np.empty_like(Wx)
+    for t in range(Wx.shape[1]):
+        It = Wx[:, t] if V is None else Wx[:, t] + st @ V
+        ut = alpha * (ut - st) + (1 - alpha) * It
+        st = (ut - c["threshold"] > 0).astype(Wx.dtype)
+        s[:, t] = st
+    return s, np.concatenate([ut, st], axis=1)
+
+
+def _adlif(c, x, state):
+    H = c["weight"].shape[0]
+    ut, wt, st = state[:, :H], state[:, H : 2 * H], state[:, 2 * H :]
+    Wx = x @ c["weight"].T + c["bias"]
+    alpha, beta, a, b, V = c["alpha"], c["beta"], c["a"], c["b"], c.get("V")
+    s = np.empty_like(Wx)
+    for t in range(Wx.shape[1]):
+        It = Wx[:, t] if V is None else Wx[:, t] + st @ V
+        reset = c["reset_factor"] * st
+        wt = beta * wt + a * ut + b * reset
+        ut = alpha * (ut - reset) + (1 - alpha) * (It - wt)
+        st = (ut - c["threshold"] > 0).astype(Wx.dtype)
+        s[:, t] = st
+    return s, np.concatenate([ut, wt, st], axis=1)
+
+
+def _lif_complex(c, x, state):
+    H = c["weight"].shape[0]
+    ut = state[:, :H] + 1j * state[:, H : 2 * H]
+    st = state[:, 2 * H :]
+    Wx = x @ c["weight"].T + c["bias"]
+    alpha = (c["alpha_re"] + 1j * c["alpha_im"]).astype(np.complex64)
+    gain, V = c["gain"], c.get("V")
+    s = np.empty_like(Wx)
+    for t in range(Wx.shape[1]):
+        It = Wx[:, t] if V is None else Wx[:, t] + st @ V
+        ut = alpha * (ut - c["reset_factor"] * st) + gain * It
+        st = (c["spike_scale"] * ut.real - c["threshold"] > 0).astype(Wx.dtype)
+        s[:, t] = st
+    return s, np.concatenate([ut.real, ut.imag, st], axis=1).astype(Wx.dtype)
+
+
+def _readout(c, x, state):
+    H = c["weight"].shape[0]
+    ut, out = state[:, :H], state[:, H : 2 * H]
+    step = int(state[0, 2 * H]) if state.shape[0] > 0 else 0
+    Wx = x @ c["weight"].T + c["bias"]
+    alpha = c["alpha"]
+    for t in range(max(c["time_offset"] - step, 0), Wx.shape[1]):
+        ut = alpha * ut + (1 - alpha) * Wx[:, t]
+        out = out + _softmax(ut)
+    steps = np.full((x.shape[0], 1), step + Wx.shape[1], dtype=Wx.dtype)
+    return out, np.concatenate([ut, out, steps], axis=1)
+
+
+_LAYERS = {
+    "LIF": (_lif, 2),
+    "adLIF": (_adlif, 3),
+    "LIFcomplex": (_lif_complex, 3),
+    "readout": (_readout, 2),
+}
+
+
+class NumpySNN:
+    """
+    SNN inference with numpy only.
+
+    Arguments
+    ---------
+    path : str
+        Path of the .npz file written by sparch.deploy.npz.snn_to_npz.
+    """
+
+    def __init__(self, path):
+        self.layers = []
+        with np.load(path) as data:
+            for i, kind in enumerate(data["kinds"]):
+                prefix = f"layer{i}."
+                c = {"kind": str(kind)}
+                for key in data.files:
+                    if key.startswith(prefix):
+                        value = data[key]
+                        c[key[len(prefix) :]] = value.item() if value.ndim == 0 else value
+                if "time_offset" in c:
+                    c["time_offset"] = int(c["time_offset"])
+                self.layers.append(c)
+
+        # Size of the state of each layer in the packed state
+        self.state_sizes = []
+        for c in self.layers:
+            size = _LAYERS[c["kind"]][1] * c["weight"].shape[0]
+            self.state_sizes.append(size + (c["kind"] == "readout"))
+        self.state_size = sum(self.state_sizes)
+
+    def initial_state(self, batch_size):
+        """Returns a zero state for a new sequence."""
+        return np.zeros((batch_size, self.state_size), dtype=np.float32)
+
+    def __call__(self, x, state=None):
+        """
+        Processes a chunk of inputs with shape (batch, time, feats), starting
+        from the given state or from a zero state, and returns the outputs of
+        the last layer together with the new state.
+        """
+        x = np.asarray(x, dtype=np.float32)
+        if state is None:
+            state = self.initial_state(x.shape[0])
+
+        start = 0
+        new_state = []
+        for c, size in zip(self.layers, self.state_sizes):
+            x, layer_state = _LAYERS[c["kind"]][0](c, x, state[:, start : start + size])
+            new_state.append(layer_state)
+            start += size
+
+        return x, np.concatenate(new_state, axis=1)
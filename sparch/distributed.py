@@ -0,0 +1,75 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is where the helpers of data parallel training with torch.distributed
+are defined.
+
+Processes are started with torchrun, which sets the RANK, LOCAL_RANK,
+WORLD_SIZE and LOCAL_WORLD_SIZE environment variables, e.g. to use all
+cores of a CPU node with 8 processes,
+
+    torchrun --nproc_per_node 8 run_exp.py --debug ...
+
+and with --nnodes and --rdzv_endpoint to scale across nodes.
+"""
+import os
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import DistributedSampler
+
+
+def world_size():
+    """Number of processes, 1 when not launched with torchrun."""
+    return int(os.environ.get("WORLD_SIZE", 1))
+
+
+def init_distributed(backend="gloo"):
+    """
+    Initializes the default process group when launched with several
+    processes and returns the rank and local rank of the current process.
+    On CPU, the threads of the node are shared between its processes.
+    """
+    if world_size() == 1:
+        return 0, 0
+
+    if not dist.is_initialized():
+        dist.init_process_group(backend)
+
+    local_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+    if not torch.cuda.is_available():
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_size))
+
+    return dist.get_rank(), int(os.environ.get("LOCAL_RANK", 0))
+
+
+def is_main_process():
+    """Whether the current process logs and saves checkpoints."""
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def barrier():
+    """Waits for all processes, if any."""
+    if dist.is_initialized():
+        dist.barrier()
+
+
+def shard_sampler(dataset, shuffle):
+    """
+    Returns the sampler of the shard of the dataset of the current process,
+    or None when not distributed. Shuffled shards are padded to the same
+    length like DistributedSampler, others are strided without padding so
+    that evaluation metrics are exact once summed over processes.
+    """
+    if not dist.is_initialized():
+        return None
+    if shuffle:
+        return DistributedSampler(dataset, shuffle=True)
+    return list(range(dist.get_rank(), len(dataset), dist.get_world_size()))
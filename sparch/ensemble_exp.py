@@ -0,0 +1,356 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is to define the experiment class used to train and test ensembles of
+models in a single process, e.g. several seeds of the same configuration.
+
+The members are stacked with sparch.models.ensemble.Ensemble and trained
+on the same batches, with their own initialization, random states,
+learning rate and scheduler, threshold and extra config. Their metrics are
+logged separately, and the best epoch of every member is kept.
+"""
+import copy
+import json
+import logging
+import time
+from datetime import timedelta
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DistributedSampler
+
+from sparch.distributed import is_main_process
+from sparch.exp import Experiment
+from sparch.metrics import EpochMetrics
+from sparch.models.ensemble import Ensemble
+from sparch.models.ensemble import MemberLearningRates
+from sparch.models.ensemble import ensemble_loss
+from sparch.models.ensemble import member_losses
+from sparch.models.precision import autocast
+from sparch.models.precision import grad_scaler
+from sparch.models.weights import save_weights
+
+logger = logging.getLogger(__name__)
+
+
+def parse_members(ensemble, seed):
+    """
+    Returns the per-member overrides of an ensemble given either as a number
+    K of members, which then only differ by their seed, or as a JSON list
+    of dicts.
+    """
+    spec = json.loads(ensemble) if isinstance(ensemble, str) else ensemble
+    if isinstance(spec, int):
+        spec = [{} for _ in range(spec)]
+    if not isinstance(spec, list) or len(spec) < 1:
+        raise ValueError(f"Invalid ensemble {ensemble}")
+    return [{"seed": seed + k, **overrides} for k, overrides in enumerate(spec)]
+
+
+class EnsembleExperiment(Experiment):
+    """
+    Class for training and testing ensembles of models (SNNs or S4 models)
+    on all four datasets for speech command recognition.
+    """
+
+    def __init__(self, config, device):
+        config = {k: v for k, v in config.items()}
+        self.members = parse_members(config["ensemble"], config["seed"])
+
+        if config["compile"] or config["count_synops"] or config["profile"]:
+            raise ValueError(
+                "Ensembles do not support compile, count_synops and profile"
+            )
+        if config["micro_batch_size"] or config["find_batch_size"]:
+            raise ValueError("Ensembles do not support micro-batches")
+        if config["sync_batchnorm"]:
+            raise ValueError("Ensembles do not support synchronized BatchNorm")
+        if config.get("spike_solver", "loop") != "loop":
+            raise ValueError("Ensembles only support the loop spike solver")
+        if config["frozen_layers"]:
+            raise ValueError("Ensembles do not support frozen layers")
+
+        super().__init__(config, device)
+
+    def init_model(self):
+        """
+        This function builds the models of all members, each from its own
+        seed and overrides, and stacks them into an ensemble.
+        """
+        if self.model_type in ["MLP", "RNN", "LiGRU", "GRU"]:
+            raise ValueError("Ensembles are only implemented for SNN and S4 models")
+
+        nets = []
+        for overrides in self.members:
+            torch.manual_seed(overrides["seed"])
+            extra_config = {
+                **self.extra_config,
+                **{
+                    key: value
+                    for key, value in overrides.items()
+                    if key not in ["seed", "lr", "threshold"]
+                },
+            }
+            nets.append(
+                self.build_net(
+                    extra_config=extra_config,
+                    threshold=float(overrides.get("threshold", 1.0)),
+                )
+            )
+        self.net = Ensemble(nets).to(self.device)
+        self.set_seed()
+
+        logging.info(f"\nCreated ensemble of {self.net.size} models:\n {nets[0]}\n")
+        for k, overrides in enumerate(self.members):
+            logging.info(f"Member {k}: {overrides}")
+
+        self.wrap_model()
+
+        self.nb_params = sum(
+            p.numel() for p in self.net.parameters() if p.requires_grad
+        )
+        logging.info(f"Total number of trainable parameters is {self.nb_params}")
+
+    def init_optimizer(self):
+        """
+        This function defines a single optimizer of the stacked parameters,
+        whose updates are rescaled by the learning rate of each member, with
+        a learning rate scheduler per member.
+        """
+        self.opt = torch.optim.Adam(self.net.parameters(), lr=1.0)
+        self.scaler = grad_scaler(self.device, self.precision)
+        self.member_lrs = MemberLearningRates(
+            self.net,
+            [float(m.get("lr", self.lr)) for m in self.members],
+            mode="max",
+            factor=self.scheduler_factor,
+            patience=self.scheduler_patience,
+            min_lr=1e-6,
+        )
+        self.scheduler = self.member_lrs
+        self.loss_fn = ensemble_loss
+
+        # Weights of the best epoch of every member
+        self.best_net = copy.deepcopy(self.net)
+        self.best_accs = [0] * self.net.size
+
+    def training_state(self):
+        """
+        This function adds the best weights and accuracies of the members
+        to the training state.
+        """
+        return {
+            **super().training_state(),
+            "best_net": self.best_net.state_dict(),
+            "best_accs": self.best_accs,
+        }
+
+    def load_training_state(self, state):
+        """
+        This function restores the training state of a checkpoint.
+        """
+        super().load_training_state(state)
+        self.best_net.load_state_dict(state["best_net"])
+        self.best_accs = state["best_accs"]
+
+    def train_one_epoch(self, e):
+        """
+        This function trains all members with a single pass over the
+        training split of the dataset.
+        """
+        start = time.time()
+        with self.telemetry:
+            self.net.train()
+            metrics = [EpochMetrics(self.device) for _ in range(self.net.size)]
+
+            # Reshuffle shards of processes
+            if isinstance(self.train_loader.sampler, DistributedSampler):
+                self.train_loader.sampler.set_epoch(e)
+
+            # Loop over batches from train set
+            for x, _, y in self.telemetry.wrap(self.train_loader):
+
+                # Dataloader uses cpu to allow pin memory
+                x = x.to(self.device)
+                y = y.to(self.device)
+
+                # Forward pass through all members
+                with autocast(self.device, self.precision):
+                    output, firing_rates = self.model(x)
+                    losses = member_losses(output, y)
+
+                # Compute loss, accuracy and spike activity of members on device
+                for k, m in enumerate(metrics):
+                    rates = firing_rates[k] if firing_rates is not None else None
+                    m.update(losses[k], output[k], y, rates)
+
+                # Members are independent, so the sum of losses gives their gradients
+                loss_val = losses.sum()
+
+                # Spike activity regularization
+                if self.net.is_snn and firing_rates is not None:
+
+                    if self.use_regularizers:
+                        reg_quiet = F.relu(self.reg_fmin - firing_rates).sum()
+                        reg_burst = F.relu(firing_rates - self.reg_fmax).sum()
+                        loss_val += self.reg_factor * (reg_quiet + reg_burst)
+
+                # Backpropagate and update members with their own learning rates
+                self.opt.zero_grad()
+                self.scaler.scale(loss_val).backward()
+                self.member_lrs.step(self.opt, self.scaler)
+                self.scaler.update()
+
+            results = [m.compute() for m in metrics]
+            self.epoch_metrics.update(self.mean_metrics("train", results))
+
+            # Throughput of whole epoch
+            telemetry = self.telemetry.stop()
+        self.telemetry.write(telemetry, e, "train")
+
+        for k, (train_loss, train_acc, spike_rate) in enumerate(results):
+            logging.info(
+                f"Epoch {e}: member {k} lr={self.member_lrs.lrs[k]}, "
+                f"train loss={train_loss}, train acc={train_acc}"
+                + (f", train mean act rate={spike_rate}" if self.net.is_snn else "")
+            )
+
+        end = time.time()
+        elapsed = str(timedelta(seconds=end - start))
+        logging.info(f"Epoch {e}: train elapsed time={elapsed}")
+        logging.info(
+            f"Epoch {e}: train samples/sec={telemetry['samples_per_sec']:.1f} "
+            f"for {self.net.size} members"
+        )
+
+        self.run_logger.log(
+            {
+                **self.member_metrics("train", results),
+                "train samples/sec": telemetry["samples_per_sec"],
+            },
+            commit=False,
+        )
+
+    def valid_one_epoch(self, e, best_epoch, best_acc):
+        """
+        This function tests all members with a single pass over the
+        validation split of the dataset, and keeps the best epoch of every
+        member. The returned best accuracy is the mean over members.
+        """
+        results = self.evaluate(self.valid_loader)
+        self.epoch_metrics.update(self.mean_metrics("valid", results))
+
+        for k, (valid_loss, valid_acc, spike_rate) in enumerate(results):
+            logging.info(
+                f"Epoch {e}: member {k} valid loss={valid_loss}, valid acc={valid_acc}"
+                + (f", valid mean act rate={spike_rate}" if self.net.is_snn else "")
+            )
+
+        self.run_logger.log(self.member_metrics("valid", results), commit=True)
+
+        # Update learning rate of each member
+        valid_accs = [acc for _, acc, _ in results]
+        self.member_lrs.scheduler_step(valid_accs)
+
+        # Update best epoch and weights of each member
+        improved = False
+        for k, valid_acc in enumerate(valid_accs):
+            if valid_acc > self.best_accs[k]:
+                self.best_accs[k] = valid_acc
+                self.best_net.copy_member(k, self.net)
+                improved = True
+
+                # Save best member, from main process only
+                if self.save_best and is_main_process():
+                    save_weights(
+                        self.net.member(k), f"{self.checkpoint_dir}/best_member{k}"
+                    )
+                    logging.info(f"Best member {k} saved with valid acc={valid_acc}")
+
+        if improved:
+            best_epoch = e
+            if self.save_best and is_main_process():
+                save_weights(self.best_net, f"{self.checkpoint_dir}/best_model")
+
+        logging.info(f"Epoch {e}: best valid acc of members={self.best_accs}")
+        logging.info("\n-----------------------------\n")
+
+        return best_epoch, sum(self.best_accs) / len(self.best_accs)
+
+    def test_one_epoch(self, test_loader):
+        """
+        This function tests all members with a single pass over the
+        testing split of the dataset.
+        """
+        logging.info("\n------ Begin Testing ------\n")
+
+        results = self.evaluate(test_loader)
+        self.epoch_metrics.update(self.mean_metrics("test", results))
+
+        for k, (test_loss, test_acc, spike_rate) in enumerate(results):
+            logging.info(
+                f"Member {k} test loss={test_loss}, test acc={test_acc}"
+                + (f", test mean act rate={spike_rate}" if self.net.is_snn else "")
+            )
+        test_accs = [acc for _, acc, _ in results]
+        logging.info(f"Test acc of members: mean={sum(test_accs) / len(test_accs)}")
+
+        self.run_logger.log(self.member_metrics("test", results), commit=False)
+
+        logging.info("\n-----------------------------\n")
+
+    def evaluate(self, loader):
+        """
+        This function returns the loss, accuracy and spike rate of every
+        member over a split of the dataset.
+        """
+        with torch.no_grad():
+
+            self.net.eval()
+            metrics = [EpochMetrics(self.device) for _ in range(self.net.size)]
+
+            for x, _, y in loader:
+
+                # Dataloader uses cpu to allow pin memory
+                x = x.to(self.device)
+                y = y.to(self.device)
+
+                # Forward pass through all members
+                with autocast(self.device, self.precision):
+                    output, firing_rates = self.model(x)
+                    losses = member_losses(output, y)
+
+                for k, m in enumerate(metrics):
+                    rates = firing_rates[k] if firing_rates is not None else None
+                    m.update(losses[k], output[k], y, rates)
+
+            return [m.compute() for m in metrics]
+
+    def member_metrics(self, split, results):
+        """
+        This function returns the wandb metrics of every member and their
+        means over the ensemble.
+        """
+        logs = self.mean_metrics(split, results)
+        for k, (loss, acc, rate) in enumerate(results):
+            logs[f"member{k} {split} loss"] = loss
+            logs[f"member{k} {split} acc"] = acc
+        logs[f"{split} sparsity"] = 1 - sum(r[2] for r in results) / len(results)
+        return logs
+
+    def mean_metrics(self, split, results):
+        """
+        This function returns the loss and accuracy averaged over members.
+        """
+        size = len(results)
+        return {
+            f"{split} loss": sum(r[0] for r in results) / size,
+            f"{split} acc": sum(r[1] for r in results) / size,
+        }
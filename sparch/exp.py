@@ -15,6 +15,7 @@ import errno
 import logging
 import os
 import time
+from contextlib import nullcontext
 from datetime import timedelta
 import copy
 
@@ -22,17 +23,45 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim.lr_scheduler import ReduceLROnPlateau
-
-from sparch.dataloaders.nonspiking_datasets import load_hd_or_sc
-from sparch.dataloaders.spiking_datasets import load_shd_or_ssc
-from sparch.models.anns import ANN
-from sparch.models.snns import SNN
-from sparch.models.snns import S4Model
+from torch.utils.data import DistributedSampler
+
+from sparch.checkpoint import CheckpointManager
+from sparch.checkpoint import rng_state
+from sparch.checkpoint import set_rng_state
+from sparch.dataloaders.spike_cache import build_spike_cache
+from sparch.dataloaders.spike_cache import load_spike_cache
+from sparch.distributed import barrier
+from sparch.distributed import init_distributed
+from sparch.distributed import is_main_process
+from sparch.distributed import world_size
+from sparch.exp_cache import experiment_folder
+from sparch.exp_cache import write_json
+from sparch.metrics import EpochMetrics
+from sparch.models.frozen import FrozenPrefix
+from sparch.models.frozen import SNNSuffix
+from sparch.models.frozen import freeze_layers
+from sparch.models.norm import accumulate_moments
+from sparch.models.norm import convert_sync_batchnorm
+from sparch.models.precision import autocast
+from sparch.models.precision import grad_scaler
+from sparch.models.profiler import LayerProfiler
+from sparch.models.synops import OPS
+from sparch.models.synops import SynOpCounter
+from sparch.models.weights import has_weights
+from sparch.models.weights import load_model
+from sparch.models.weights import load_weights
+from sparch.models.weights import save_weights
 from sparch.parsers.model_config import print_model_options
 from sparch.parsers.training_config import print_training_options
-
-import wandb
+from sparch.preflight import BatchSizeFinder
+from sparch.preflight import available_memory
+from sparch.results import ResultsStore
+from sparch.run_logger import JsonlBackend
+from sparch.run_logger import RunLogger
+from sparch.run_logger import WandbBackend
+from sparch.telemetry import EpochTelemetry
 
 import json
 
@@ -40,6 +69,13 @@ import json
 logger = logging.getLogger(__name__)
 
 
+class StopTraining(Exception):
+    """
+    Raised by a callback of an experiment to stop training after the
+    current epoch, e.g. by the early stopping of a sweep.
+    """
+
+
 class Experiment:
     """
     Class for training and testing models (ANNs and SNNs) on all four
@@ -50,6 +86,7 @@ class Experiment:
 
         # Put wandb config objects into a standard dict
         config = {k: v for k, v in config.items()}
+        self.config = dict(config)
 
         print_model_options(config)
         print_training_options(config)
@@ -78,16 +115,34 @@ class Experiment:
         self.log_tofile = config.pop('log_tofile')
         self.save_best = config.pop('save_best')
         self.batch_size = config.pop('batch_size')
+        self.micro_batch_size = config.pop('micro_batch_size')
+        self.find_batch_size = config.pop('find_batch_size')
+        self.memory_budget = config.pop('memory_budget')
         self.nb_epochs = config.pop('nb_epochs')
         self.start_epoch = config.pop('start_epoch')
         self.lr = config.pop('lr')
         self.scheduler_patience = config.pop('scheduler_patience')
         self.scheduler_factor = config.pop('scheduler_factor')
+        self.track_firing_rates = config.pop('track_firing_rates')
         self.use_regularizers = config.pop('use_regularizers')
         self.reg_factor = config.pop('reg_factor')
         self.reg_fmin = config.pop('reg_fmin')
         self.reg_fmax = config.pop('reg_fmax')
         self.use_augm = config.pop('use_augm')
+        self.compile = config.pop('compile')
+        self.count_synops = config.pop('count_synops')
+        self.profile = config.pop('profile')
+        self.telemetry_file = config.pop('telemetry_file')
+        self.precision = config.pop('precision')
+        self.dist_backend = config.pop('dist_backend')
+        self.sync_batchnorm = config.pop('sync_batchnorm')
+        self.ensemble = config.pop('ensemble')
+        self.resume = config.pop('resume')
+        self.checkpoint_every = config.pop('checkpoint_every')
+        self.keep_checkpoints = config.pop('keep_checkpoints')
+        self.results_db = config.pop('results_db')
+        self.log_backend = config.pop('log_backend')
+        self.frozen_layers = config.pop('frozen_layers')
 
         self.nb_steps = config.pop('nb_steps')
         self.max_time = config.pop('max_time')
@@ -100,14 +155,80 @@ class Experiment:
 
         self.extra_config = config
 
+        # Set up data parallel training when launched with torchrun
+        self.rank, local_rank = init_distributed(self.dist_backend)
+        self.world_size = world_size()
+        self.distributed = self.world_size > 1
+        self.use_wandb = (
+            not self.debug and is_main_process() and self.log_backend == "wandb"
+        )
+
+        # Batch size is split between processes
+        if self.batch_size % self.world_size != 0:
+            raise ValueError(
+                f"Batch size {self.batch_size} is not divisible by the "
+                f"number of processes {self.world_size}"
+            )
+        self.local_batch_size = self.batch_size // self.world_size
+
+        # Regularizers act on the firing rates returned by the SNN
+        if self.use_regularizers and not self.track_firing_rates:
+            raise ValueError("Regularizers need track_firing_rates")
+
+        # Batch size probes run the full model on synthetic inputs
+        if self.frozen_layers and self.find_batch_size:
+            raise ValueError("Frozen layers do not support find_batch_size")
 
         # Initialize logging and output folders
         self.init_exp_folders()
         self.init_logging()
 
-        # Set device
-        self.device = torch.device(f"cuda:{device}") #torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        # Periodic checkpoints of full training state, written in background
+        self.checkpoints = CheckpointManager(self.checkpoint_dir, self.keep_checkpoints)
+
+        # Last checkpoint of interrupted training, restored by forward
+        self.resume_state = None
+        if self.resume:
+            self.resume_state = self.checkpoints.load_latest()
+        log_step = 0
+        if self.resume_state is not None:
+            log_step = self.resume_state.get("log_step", 0)
+
+        # Metrics written in background to the experiment folder, and wandb
+        # for online runs, from main process only. Resumed runs continue the
+        # steps of their checkpoint, other runs start a new metrics file.
+        backends = []
+        if is_main_process():
+            path = self.exp_folder + "/metrics.jsonl"
+            backends.append(JsonlBackend(path, start_step=log_step))
+            if self.use_wandb:
+                backends.append(WandbBackend())
+        self.run_logger = RunLogger(backends, step=log_step)
+
+        # Set device, GPU of the process or CPU
+        if torch.cuda.is_available():
+            index = local_rank if self.distributed else device
+            self.device = torch.device(f"cuda:{index}")
+        else:
+            self.device = torch.device("cpu")
         logging.info(f"\nDevice is set to {self.device}\n")
+        if self.distributed:
+            logging.info(
+                f"Distributed training on {self.world_size} processes "
+                f"({self.dist_backend}), {self.local_batch_size} samples each\n"
+            )
+
+        # Throughput metrics of training epochs, written by main process only
+        self.telemetry = EpochTelemetry(
+            self.device, self.telemetry_file if is_main_process() else None
+        )
+
+        # Metrics of the last epoch, passed to the callbacks after each
+        # validation, e.g. to report them to a local sweep
+        self.epoch_metrics = {}
+        self.history = []
+        self.callbacks = []
+        self.stopped_epoch = None
 
         
 
@@ -115,19 +236,15 @@ class Experiment:
         self.init_dataset()
         self.init_model()
 
-        # Define optimizer
-        self.opt = torch.optim.Adam(self.net.parameters(), self.lr)
+        # Train upper layers from the cached spikes of frozen lower layers
+        if self.frozen_layers:
+            self.init_spike_cache()
 
-        # Define learning rate scheduler
-        self.scheduler = ReduceLROnPlateau(
-            optimizer=self.opt,
-            mode="max",
-            factor=self.scheduler_factor,
-            patience=self.scheduler_patience,
-            min_lr=1e-6,
-        )
-        # Define loss function
-        self.loss_fn = nn.CrossEntropyLoss()
+        self.init_optimizer()
+
+        # Find largest batch size that fits memory budget
+        if self.find_batch_size:
+            self.preflight()
 
         self.best_val_acc = 0
 
@@ -138,57 +255,157 @@ class Experiment:
         This function performs model training with the configuration
         specified by the class initialization.
         """
-        if not self.only_do_testing:
-
-            # Initialize best accuracy
-            if self.use_pretrained_model:
-                logging.info("\n------ Using pretrained model ------\n")
-                best_epoch, best_acc = self.valid_one_epoch(self.start_epoch, 0, 0)
+        # Metrics still buffered are written, also if training fails
+        try:
+            if not self.only_do_testing:
+
+                # Initialize best accuracy
+                if self.use_pretrained_model:
+                    logging.info("\n------ Using pretrained model ------\n")
+                    best_epoch, best_acc = self.valid_one_epoch(self.start_epoch, 0, 0)
+                else:
+                    best_epoch, best_acc = 0, 0
+                first_epoch = best_epoch + 1
+                last_epoch = best_epoch + self.nb_epochs
+
+                # Continue interrupted training from last checkpoint
+                if self.resume:
+                    state, self.resume_state = self.resume_state, None
+                    if state is not None:
+                        self.load_training_state(state)
+                        first_epoch = state["epoch"] + 1
+                        last_epoch = state["last_epoch"]
+                        best_epoch, best_acc = state["best_epoch"], state["best_acc"]
+                        self.history = state["history"]
+                        logging.info(f"\n------ Resuming at epoch {first_epoch} ------\n")
+
+                # Loop over epochs (training + validation)
+                logging.info("\n------ Begin training ------\n")
+
+                for e in range(first_epoch, last_epoch + 1):
+                    self.train_one_epoch(e)
+                    best_epoch, new_best_acc = self.valid_one_epoch(e, best_epoch, best_acc)
+                    if self.dataset_name in ["sc", "ssc"]:
+                        if best_acc > 0.92 and new_best_acc>best_acc:
+                            self.test_one_epoch(self.test_loader)
+                    best_acc = new_best_acc
+
+                    # Report metrics of epoch, callbacks may stop training
+                    metrics = {**self.epoch_metrics, "best valid acc": best_acc}
+                    self.history.append({"epoch": e, **metrics})
+                    try:
+                        for callback in self.callbacks:
+                            callback(e, metrics)
+                    except StopTraining as stop:
+                        logging.info(f"\nTraining stopped at epoch {e}: {stop}\n")
+                        self.stopped_epoch = e
+                        break
+
+                    # Save full training state, from main process only
+                    save = self.checkpoint_every and e % self.checkpoint_every == 0
+                    if (save or e == last_epoch) and is_main_process():
+                        self.checkpoints.save(
+                            {
+                                **self.training_state(),
+                                "epoch": e,
+                                "last_epoch": last_epoch,
+                                "best_epoch": best_epoch,
+                                "best_acc": best_acc,
+                                "history": self.history,
+                                "log_step": self.run_logger.step,
+                            },
+                            e,
+                        )
+
+                self.checkpoints.wait()
+
+                logging.info(f"\nBest valid acc at epoch {best_epoch}: {best_acc}\n")
+                logging.info("\n------ Training finished ------\n")
+
+                self.run_logger.log({"best valid acc":best_acc}, commit=False)
+                self.best_val_acc = best_acc
+
+                # Loading best model, once saved by main process
+                if self.save_best:
+                    barrier()
+                    self.net = load_weights(
+                        f"{self.checkpoint_dir}/best_model", map_location=self.device
+                    )
+                    if self.distributed and self.sync_batchnorm:
+                        convert_sync_batchnorm(self.net)
+                    self.wrap_model()
+                    logging.info(
+                        f"Loading best model, epoch={best_epoch}, valid acc={best_acc}"
+                    )
+                else:
+                    logging.info(
+                        "Cannot load best model because save_best option is "
+                        "disabled. Model from last epoch is used for testing."
+                    )
+
+            # Test trained model
+            if self.dataset_name in ["sc", "ssc"]:
+                self.test_one_epoch(self.test_loader)
             else:
-                best_epoch, best_acc = 0, 0
-
-            # Loop over epochs (training + validation)
-            logging.info("\n------ Begin training ------\n")
-
-            for e in range(best_epoch + 1, best_epoch + self.nb_epochs + 1):
-                self.train_one_epoch(e)
-                best_epoch, new_best_acc = self.valid_one_epoch(e, best_epoch, best_acc)
-                if self.dataset_name in ["sc", "ssc"]:
-                    if best_acc > 0.92 and new_best_acc>best_acc:
-                        self.test_one_epoch(self.test_loader)
-                best_acc = new_best_acc
-
-
-
-            logging.info(f"\nBest valid acc at epoch {best_epoch}: {best_acc}\n")
-            logging.info("\n------ Training finished ------\n")
-
-            if not self.debug:
-                wandb.log({"best valid acc":best_acc}, commit=False)
-            self.best_val_acc = best_acc
-
-            # Loading best model
-            if self.save_best:
-                self.net = torch.load(
-                    f"{self.checkpoint_dir}/best_model.pth", map_location=self.device
-                )
+                self.test_one_epoch(self.valid_loader)
                 logging.info(
-                    f"Loading best model, epoch={best_epoch}, valid acc={best_acc}"
+                    "\nThis dataset uses the same split for validation and testing.\n"
                 )
-            else:
-                logging.info(
-                    "Cannot load best model because save_best option is "
-                    "disabled. Model from last epoch is used for testing."
+
+            # Results of completed training, found again for the same config,
+            # the folder of a pretrained model keeps its own results
+            if is_main_process() and not self.use_pretrained_model:
+                write_json(
+                    self.exp_folder + "/results.json",
+                    {
+                        "completed": not self.only_do_testing and self.stopped_epoch is None,
+                        "best valid acc": self.best_val_acc,
+                        "test acc": self.epoch_metrics.get("test acc"),
+                        "test loss": self.epoch_metrics.get("test loss"),
+                        "stopped epoch": self.stopped_epoch,
+                        "history": self.history,
+                    },
                 )
 
-        # Test trained model
-        if self.dataset_name in ["sc", "ssc"]:
-            self.test_one_epoch(self.test_loader)
-        else:
-            self.test_one_epoch(self.valid_loader)
-            logging.info(
-                "\nThis dataset uses the same split for validation and testing.\n"
-            )
+            # Final results, once the model is tested after training
+            if self.results_db and is_main_process():
+                self.save_results(
+                    {
+                        "dataset_name": self.dataset_name,
+                        "test_acc": self.epoch_metrics.get("test acc"),
+                        "number_layers": self.nb_layers,
+                        "number_neurons": self.nb_hiddens,
+                        "model_type": self.model_type,
+                        "best_val_acc": self.best_val_acc,
+                        "exp_folder": self.exp_folder,
+                        "seed": self.seed,
+                    }
+                )
+        finally:
+            self.run_logger.close()
+
+    def training_state(self):
+        """
+        This function returns the state dicts of everything that changes
+        during training, for checkpoints.
+        """
+        return {
+            "model": self.net.state_dict(),
+            "optimizer": self.opt.state_dict(),
+            "scheduler": self.scheduler.state_dict(),
+            "scaler": self.scaler.state_dict(),
+            "rng": rng_state(),
+        }
+
+    def load_training_state(self, state):
+        """
+        This function restores the training state of a checkpoint.
+        """
+        self.net.load_state_dict(state["model"])
+        self.opt.load_state_dict(state["optimizer"])
+        self.scheduler.load_state_dict(state["scheduler"])
+        self.scaler.load_state_dict(state["scaler"])
+        set_rng_state(state["rng"])
 
     def init_exp_folders(self):
         """
@@ -197,7 +414,10 @@ class Experiment:
         # Check if path exists for loading pretrained model
         if self.use_pretrained_model:
             exp_folder = self.load_exp_folder
-            self.load_path = exp_folder + "/checkpoints/best_model.pth"
+            # Weight files, or pickled module of older experiments
+            self.load_path = exp_folder + "/checkpoints/best_model.json"
+            if not has_weights(self.load_path):
+                self.load_path = exp_folder + "/checkpoints/best_model.pth"
             if not os.path.exists(self.load_path):
                 raise FileNotFoundError(
                     errno.ENOENT, os.strerror(errno.ENOENT), self.load_path
@@ -207,23 +427,9 @@ class Experiment:
         elif self.new_exp_folder is not None:
             exp_folder = self.new_exp_folder
 
-        # Generate a path for new model from chosen config
+        # Generate a path for new model from hash of whole config
         else:
-            outname = self.dataset_name + "_" + self.model_type + "_"
-            outname += str(self.nb_layers) + "lay" + str(self.nb_hiddens)
-            #outname += "_drop" + str(self.pdrop) + "_" + str(self.normalization)
-            #outname += "_bias" if self.use_bias else "_nobias"
-            # outname += "_bdir" if self.bidirectional else "_udir"
-            # outname += "_reg" if self.use_regularizers else "_noreg"
-            # outname += "_lr" + str(self.lr)
-
-            # Add extra parameters from self.extra_config
-            #for key, value in self.extra_config.items():
-            #    outname += f"_{key}{value}"
-
-            outname += "_"  # + '_'.join(self.lif_feature.keys())
-            exp_folder = "exp/final/" + outname.replace(".", "_")
-
+            exp_folder = experiment_folder(self.config)
 
         # # For a new model check that out path does not exist
         # if not self.use_pretrained_model and os.path.exists(exp_folder):
@@ -233,17 +439,27 @@ class Experiment:
         self.log_dir = exp_folder + "/log/"
         self.checkpoint_dir = exp_folder + "/checkpoints/"
         if not os.path.exists(self.log_dir):
-            os.makedirs(self.log_dir)
+            os.makedirs(self.log_dir, exist_ok=True)
         if not os.path.exists(self.checkpoint_dir):
-            os.makedirs(self.checkpoint_dir)
+            os.makedirs(self.checkpoint_dir, exist_ok=True)
 
         self.exp_folder = exp_folder
 
+        # Keep resolved config next to results, the folder of a pretrained
+        # model keeps the config it was trained with
+        if is_main_process() and not self.use_pretrained_model:
+            write_json(exp_folder + "/config.json", self.config)
+
     def init_logging(self):
         """
         This function sets the experimental log to be written either to
         a dedicated log file, or to the terminal.
         """
+        # Only main process logs in distributed training
+        if not is_main_process():
+            logging.basicConfig(level=logging.WARNING, format="%(message)s")
+            return
+
         if self.log_tofile:
             logging.FileHandler(
                 filename=self.log_dir + "exp.log",
@@ -266,8 +482,10 @@ class Experiment:
         """
         This function prepares dataloaders for the desired dataset.
         """
-        # For the spiking datasets
+        # Dataloaders are imported for the chosen dataset only, the
+        # non-spiking ones depend on torchaudio
         if self.dataset_name in ["shd", "ssc"]:
+            from sparch.dataloaders.spiking_datasets import load_shd_or_ssc
 
             self.nb_inputs = 700//self.spatial_bin
             self.nb_outputs = 20 if self.dataset_name == "shd" else 35
@@ -276,7 +494,7 @@ class Experiment:
                 dataset_name=self.dataset_name,
                 data_folder=self.data_folder,
                 split="train",
-                batch_size=self.batch_size,
+                batch_size=self.local_batch_size,
                 nb_steps=self.nb_steps,
                 max_time = self.max_time,
                 spatial_bin = self.spatial_bin,
@@ -287,7 +505,7 @@ class Experiment:
                 dataset_name=self.dataset_name,
                 data_folder=self.data_folder,
                 split="valid",
-                batch_size=self.batch_size,
+                batch_size=self.local_batch_size,
                 nb_steps=self.nb_steps,
                 max_time = self.max_time,
                 spatial_bin = self.spatial_bin,
@@ -299,7 +517,7 @@ class Experiment:
                     dataset_name=self.dataset_name,
                     data_folder=self.data_folder,
                     split="test",
-                    batch_size=self.batch_size,
+                    batch_size=self.local_batch_size,
                     nb_steps=self.nb_steps,
                     max_time = self.max_time,
                     shuffle=False,
@@ -312,6 +530,7 @@ class Experiment:
 
         # For the non-spiking datasets
         elif self.dataset_name in ["hd", "sc"]:
+            from sparch.dataloaders.nonspiking_datasets import load_hd_or_sc
 
             self.nb_inputs = 40
             self.nb_outputs = 20 if self.dataset_name == "hd" else 35
@@ -320,7 +539,7 @@ class Experiment:
                 dataset_name=self.dataset_name,
                 data_folder=self.data_folder,
                 split="train",
-                batch_size=self.batch_size,
+                batch_size=self.local_batch_size,
                 use_augm=self.use_augm,
                 shuffle=True,
                 workers=8,
@@ -329,7 +548,7 @@ class Experiment:
                 dataset_name=self.dataset_name,
                 data_folder=self.data_folder,
                 split="valid",
-                batch_size=self.batch_size,
+                batch_size=self.local_batch_size,
                 use_augm=self.use_augm,
                 shuffle=False,
                 workers=8,
@@ -339,7 +558,7 @@ class Experiment:
                     dataset_name=self.dataset_name,
                     data_folder=self.data_folder,
                     split="test",
-                    batch_size=self.batch_size,
+                    batch_size=self.local_batch_size,
                     use_augm=self.use_augm,
                     shuffle=False,
                     workers=8,
@@ -355,15 +574,54 @@ class Experiment:
         This function either loads pretrained model or builds a
         new model (ANN or SNN) depending on chosen config.
         """
-        input_shape = (self.batch_size, None, self.nb_inputs)
-        layer_sizes = [self.nb_hiddens] * (self.nb_layers - 1) + [self.nb_outputs]
-
         if self.use_pretrained_model:
-            self.net = torch.load(self.load_path, map_location=self.device)
+            self.net = load_model(self.load_path, map_location=self.device)
             logging.info(f"\nLoaded model at: {self.load_path}\n {self.net}\n")
+
+            # Firing rates as configured, whatever the saved model did
+            if self.net.is_snn:
+                net = getattr(self.net, "base", self.net)
+                net.track_firing_rates = self.track_firing_rates
+
+        else:
+            self.net = self.build_net().to(self.device)
+            if self.net.is_snn:
+                logging.info(f"\nCreated new spiking model:\n {self.net}\n")
+            else:
+                logging.info(f"\nCreated new non-spiking model:\n {self.net}\n")
+
+        # Synchronize BatchNorm statistics between processes
+        if self.distributed and self.sync_batchnorm:
+            convert_sync_batchnorm(self.net)
+
+        # Lower layers are not trained, their spikes are cached
+        if self.frozen_layers:
+            freeze_layers(self.net, self.frozen_layers)
+            logging.info(f"Lower {self.frozen_layers} layers are frozen")
+
+        self.wrap_model()
+
+        self.nb_params = sum(
+            p.numel() for p in self.net.parameters() if p.requires_grad
+        )
+        logging.info(f"Total number of trainable parameters is {self.nb_params}")
         
+
+    def build_net(self, extra_config=None, threshold=1.0):
+        """
+        This function builds a new model (ANN or SNN) depending on chosen
+        config, with optional overrides of the extra config and of the
+        threshold of the spiking neurons.
+        """
+        if extra_config is None:
+            extra_config = self.extra_config
+        input_shape = (self.batch_size, None, self.nb_inputs)
+        layer_sizes = [self.nb_hiddens] * (self.nb_layers - 1) + [self.nb_outputs]
+
         if self.s4:
-            self.net = S4Model(
+            from sparch.models.snns import S4Model
+
+            return S4Model(
             d_input=self.nb_inputs,
             d_output=self.nb_outputs,
             d_model=self.nb_hiddens, 
@@ -374,28 +632,29 @@ class Experiment:
             lr = self.lr,
             batch_size = self.batch_size,
             normalization=self.normalization,
-            extra_features = self.extra_config
-            ).to(self.device)
-            
+            extra_features = extra_config
+            )
 
         elif self.model_type in ["LIF", "LIFfeature", "adLIFnoClamp", "LIFfeatureDim", "adLIF", "CadLIF", "RSEadLIF", "adLIFclamp", "RLIF", "RadLIF", "LIFcomplex","LIFrealcomplex", "ReLULIFcomplex", "RLIFcomplex","RLIFcomplex1MinAlphaNoB","RLIFcomplex1MinAlpha", "LIFcomplex_gatedB", "LIFcomplex_gatedDt", "LIFcomplexDiscr",  "BRF", "ResonateFire"]:
+            from sparch.models.snns import SNN
 
-            self.net = SNN(
+            return SNN(
                 input_shape=input_shape,
                 layer_sizes=layer_sizes,
                 neuron_type=self.model_type,
+                threshold=threshold,
                 dropout=self.pdrop,
                 normalization=self.normalization,
                 use_bias=self.use_bias,
                 bidirectional=self.bidirectional,
-                extra_features = self.extra_config
-            ).to(self.device)
-
-            logging.info(f"\nCreated new spiking model:\n {self.net}\n")
+                extra_features = extra_config,
+                track_firing_rates=self.track_firing_rates,
+            )
 
         elif self.model_type in ["MLP", "RNN", "LiGRU", "GRU"]:
+            from sparch.models.anns import ANN
 
-            self.net = ANN(
+            return ANN(
                 input_shape=input_shape,
                 layer_sizes=layer_sizes,
                 ann_type=self.model_type,
@@ -404,22 +663,183 @@ class Experiment:
                 use_bias=self.use_bias,
                 bidirectional=self.bidirectional,
                 use_readout_layer=True,
-            ).to(self.device)
-
-            logging.info(f"\nCreated new non-spiking model:\n {self.net}\n")
+            )
 
         else:
             raise ValueError(f"Invalid model type {self.model_type}")
 
-        # if 'LIFcomplex' not in self.model_type:
-        #     torch.set_float32_matmul_precision('high')
-        #     self.net = torch.compile(self.net)
+    def init_optimizer(self):
+        """
+        This function defines the optimizer, gradient scaler, learning
+        rate scheduler and loss function.
+        """
+        # Define optimizer
+        self.opt = torch.optim.Adam(self.net.parameters(), self.lr)
 
-        self.nb_params = sum(
-            p.numel() for p in self.net.parameters() if p.requires_grad
+        # Define gradient scaler, only active with fp16
+        self.scaler = grad_scaler(self.device, self.precision)
+
+        # Define learning rate scheduler
+        self.scheduler = ReduceLROnPlateau(
+            optimizer=self.opt,
+            mode="max",
+            factor=self.scheduler_factor,
+            patience=self.scheduler_patience,
+            min_lr=1e-6,
         )
-        logging.info(f"Total number of trainable parameters is {self.nb_params}")
-        
+        # Define loss function
+        self.loss_fn = nn.CrossEntropyLoss()
+
+    def init_spike_cache(self):
+        """
+        This function runs the frozen lower layers once over every split of
+        the dataset, from main process only, and replaces the dataloaders
+        with loaders of their cached output spikes.
+        """
+        cache_dir = self.exp_folder + "/spike_cache/"
+        if is_main_process() and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        prefix = FrozenPrefix(self.net, self.frozen_layers)
+        for split in ["train", "valid", "test"]:
+            loader = getattr(self, f"{split}_loader", None)
+            if loader is None:
+                continue
+            path = cache_dir + split
+            if is_main_process():
+                start = time.time()
+                build_spike_cache(prefix, loader, path, self.device, self.precision)
+                elapsed = str(timedelta(seconds=time.time() - start))
+                logging.info(f"Spikes of {split} split cached in {elapsed}")
+            barrier()
+            setattr(
+                self,
+                f"{split}_loader",
+                load_spike_cache(
+                    path,
+                    batch_size=self.local_batch_size,
+                    shuffle=split == "train",
+                    workers=loader.num_workers,
+                ),
+            )
+
+    def wrap_model(self):
+        """
+        This function wraps the model for data parallel training and
+        compilation, and attaches the optional layer instrumentation.
+        The wrapped model is used for forward passes, while self.net
+        remains the plain model.
+        """
+        self.model = self.net
+        self.ddp = None
+
+        # Only upper layers are run, on the cached spikes of frozen layers
+        if self.frozen_layers:
+            self.model = SNNSuffix(self.net, self.frozen_layers)
+
+        # Average gradients between processes
+        if self.distributed:
+            self.ddp = DistributedDataParallel(
+                self.model,
+                device_ids=[self.device.index] if self.device.type == "cuda" else None,
+                find_unused_parameters=True,
+            )
+            self.model = self.ddp
+
+        # Compile model graph, time loops are unrolled for fixed nb_steps
+        if self.compile:
+            torch.set_float32_matmul_precision('high')
+            self.model = torch.compile(self.model)
+            logging.info("\nModel compiled with torch.compile\n")
+
+        # Count operations of every layer with forward hooks, batches are
+        # counted on the module that is called, e.g. the suffix of the SNN
+        self.synops = None
+        if self.count_synops:
+            self.synops = SynOpCounter(self.net, root=self.model)
+
+        # Profile phases of every layer with forward hooks
+        self.profiler = LayerProfiler(self.net) if self.profile else None
+
+    def preflight(self):
+        """
+        This function probes training steps on synthetic inputs to find the
+        largest batch size that fits the memory budget, uses micro-batches
+        of that size if the configured batch size does not fit, and
+        estimates the training time.
+        """
+        if self.memory_budget is not None:
+            budget = int(self.memory_budget * 1e6)
+        else:
+            budget = available_memory(self.device)
+
+        finder = BatchSizeFinder(
+            self.net,
+            self.loss_fn,
+            self.device,
+            nb_steps=self.nb_steps,
+            nb_inputs=self.nb_inputs,
+            nb_outputs=self.nb_outputs,
+            spiking=self.dataset_name in ["shd", "ssc"],
+            precision=self.precision,
+        )
+        result = finder.search(self.local_batch_size, budget)
+        max_batch_size = result["batch_size"]
+
+        if max_batch_size == 0:
+            raise MemoryError(
+                f"A single sample does not fit the budget of {budget / 1e6:.0f}MB"
+            )
+
+        # Split batches into micro-batches if needed
+        if max_batch_size < self.local_batch_size:
+            self.micro_batch_size = min(
+                self.micro_batch_size or max_batch_size, max_batch_size
+            )
+            logging.info(
+                f"Batch size {self.local_batch_size} does not fit, using micro-batches "
+                f"of {self.micro_batch_size}"
+            )
+        micro_batch_size = self.micro_batch_size or self.local_batch_size
+
+        # Estimate training time from step time of used micro-batch size
+        if micro_batch_size in result["probes"]:
+            step_time = result["probes"][micro_batch_size]["step_time"]
+        else:
+            with finder.preserved_state():
+                _, step_time = finder.probe(micro_batch_size, repeats=3)
+        nb_train = -(-len(self.train_loader.dataset) // self.world_size)
+        epoch_time = step_time * -(-nb_train // micro_batch_size)
+        result.update(
+            {
+                "micro_batch_size": micro_batch_size,
+                "epoch_time": epoch_time,
+                "run_time": epoch_time * self.nb_epochs,
+            }
+        )
+
+        logging.info(
+            f"Largest batch size within {budget / 1e6:.0f}MB: {max_batch_size} "
+            f"({result['memory'] / 1e6:.1f}MB, {1e3 * result['step_time']:.1f}ms/step)"
+        )
+        logging.info(
+            f"Estimated training time: {timedelta(seconds=epoch_time)} per epoch, "
+            f"{timedelta(seconds=result['run_time'])} in total\n"
+        )
+        with open(self.exp_folder + "/preflight.json", "w") as f:
+            json.dump(result, f, indent=4)
+
+        self.run_logger.log(
+            {
+                "max batch size": max_batch_size,
+                "max batch memory": result["memory"] / 1e6,
+                "max batch step time": result["step_time"],
+                "estimated epoch time": epoch_time,
+            },
+            commit=False,
+        )
+
+        return result
 
     def set_seed(self):
         seed = self.seed
@@ -436,66 +856,129 @@ class Experiment:
         training split of the dataset.
         """
         start = time.time()
-        self.net.train()
-        losses, accs = [], []
-        epoch_spike_rate = 0
-
-        # Loop over batches from train set
-        for step, (x, _, y) in enumerate(self.train_loader):
-
-            # Dataloader uses cpu to allow pin memory
-            x = x.to(self.device)
-            y = y.to(self.device)
-
-            # Forward pass through network
-            output, firing_rates = self.net(x)
-
-            # Compute loss
-            loss_val = self.loss_fn(output, y)
-            losses.append(loss_val.item())
+        with self.telemetry:
+            self.net.train()
+            metrics = EpochMetrics(self.device)
+            if self.synops is not None:
+                self.synops.reset()
+            if self.profiler is not None:
+                self.profiler.reset()
 
-            # Spike activity
-            if self.net.is_snn:
-                epoch_spike_rate += torch.mean(firing_rates)
+            # Reshuffle shards of processes
+            if isinstance(self.train_loader.sampler, DistributedSampler):
+                self.train_loader.sampler.set_epoch(e)
 
-                if self.use_regularizers:
-                    reg_quiet = F.relu(self.reg_fmin - firing_rates).sum()
-                    reg_burst = F.relu(firing_rates - self.reg_fmax).sum()
-                    loss_val += self.reg_factor * (reg_quiet + reg_burst)
+            # Loop over batches from train set
+            for x, _, y in self.telemetry.wrap(self.train_loader):
 
-            # Backpropagate
-            self.opt.zero_grad()
-            loss_val.backward()
-            self.opt.step()
+                # Dataloader uses cpu to allow pin memory
+                x = x.to(self.device)
+                y = y.to(self.device)
 
-            # Compute accuracy with labels
-            pred = torch.argmax(output, dim=1)
-            acc = np.mean((y == pred).detach().cpu().numpy())
-            accs.append(acc)
+                # Split logical batch into micro-batches, BatchNorm layers then
+                # update their running stats once with the moments of all of them
+                chunk = self.micro_batch_size or x.shape[0]
+                if chunk < x.shape[0]:
+                    moments = accumulate_moments(self.net)
+                else:
+                    moments = nullcontext()
+                self.opt.zero_grad()
+
+                with moments:
+                    micro_batches = list(zip(x.split(chunk), y.split(chunk)))
+                    for i, (xm, ym) in enumerate(micro_batches):
+
+                        # Average gradients between processes after last one only
+                        if self.ddp is not None and i < len(micro_batches) - 1:
+                            no_sync = self.ddp.no_sync()
+                        else:
+                            no_sync = nullcontext()
+
+                        # Avoid recompilations on the last partial batch
+                        if self.compile:
+                            torch._dynamo.mark_dynamic(xm, 0)
+
+                        with no_sync:
+
+                            # Forward pass through network
+                            with autocast(self.device, self.precision):
+                                output, firing_rates = self.model(xm)
+                                loss_val = self.loss_fn(output, ym)
+
+                            # Compute loss, accuracy and spike activity on device
+                            metrics.update(loss_val, output, ym, firing_rates)
+
+                            # Spike activity regularization
+                            if self.net.is_snn:
+
+                                if self.use_regularizers:
+                                    reg_quiet = F.relu(self.reg_fmin - firing_rates).sum()
+                                    reg_burst = F.relu(firing_rates - self.reg_fmax).sum()
+                                    loss_val += self.reg_factor * (reg_quiet + reg_burst)
+
+                            # Backpropagate, weighted by share of the batch. With
+                            # several micro-batches, BatchNorm statistics and the
+                            # regularizer are per micro-batch, so the gradient is
+                            # not exactly the one of the full batch.
+                            weight = ym.shape[0] / y.shape[0]
+                            self.scaler.scale(loss_val * weight).backward()
+
+                # Single optimizer step per logical batch
+                self.scaler.step(self.opt)
+                self.scaler.update()
+
+            # Read metrics of whole epoch at once
+            train_loss, train_acc, epoch_spike_rate = metrics.compute()
+            self.epoch_metrics.update({"train loss": train_loss, "train acc": train_acc})
+
+            # Throughput of whole epoch
+            telemetry = self.telemetry.stop()
+        self.telemetry.write(telemetry, e, "train")
 
         # Learning rate of whole epoch
         current_lr = self.opt.param_groups[-1]["lr"]
         logging.info(f"Epoch {e}: lr={current_lr}")
 
         # Train loss of whole epoch
-        train_loss = np.mean(losses)
         logging.info(f"Epoch {e}: train loss={train_loss}")
 
         # Train accuracy of whole epoch
-        train_acc = np.mean(accs)
         logging.info(f"Epoch {e}: train acc={train_acc}")
 
         # Train spike activity of whole epoch
         if self.net.is_snn:
-            epoch_spike_rate /= step
             logging.info(f"Epoch {e}: train mean act rate={epoch_spike_rate}")
 
         end = time.time()
         elapsed = str(timedelta(seconds=end - start))
         logging.info(f"Epoch {e}: train elapsed time={elapsed}")
-
-        if not self.debug:
-            wandb.log({"train_loss":train_loss, "train_acc":train_acc, "train sparsity": 1-epoch_spike_rate}, commit=False)
+        logging.info(
+            f"Epoch {e}: train samples/sec={telemetry['samples_per_sec']:.1f}, "
+            f"loader wait={telemetry['loader_wait']:.2f}s, "
+            f"compute={telemetry['compute']:.2f}s, "
+            f"peak memory ({telemetry['peak_memory_scope']})="
+            f"{telemetry['peak_memory_mb']:.1f}MB, "
+            f"host syncs={telemetry['host_syncs']}"
+        )
+        # Peak memory of the epoch on CUDA, of the whole process on CPU
+        if telemetry["peak_memory_scope"] == "epoch":
+            memory_key = "train peak memory"
+        else:
+            memory_key = "train process peak memory"
+        throughput = {
+            "train samples/sec": telemetry["samples_per_sec"],
+            "train loader wait": telemetry["loader_wait"],
+            "train compute time": telemetry["compute"],
+            memory_key: telemetry["peak_memory_mb"],
+        }
+        if telemetry["host_syncs"] is not None:
+            throughput["train host syncs"] = telemetry["host_syncs"]
+
+        # Operations per sample of whole epoch
+        synops = self.log_synops(f"Epoch {e}: train", "train")
+        self.log_profile(f"epoch{e}_train")
+
+        self.run_logger.log({"train_loss":train_loss, "train_acc":train_acc, "train sparsity": 1-epoch_spike_rate, **synops, **throughput}, commit=False)
 
     def valid_one_epoch(self, e, best_epoch, best_acc):
         """
@@ -505,48 +988,51 @@ class Experiment:
         with torch.no_grad():
 
             self.net.eval()
-            losses, accs = [], []
-            epoch_spike_rate = 0
+            metrics = EpochMetrics(self.device)
+            if self.synops is not None:
+                self.synops.reset()
+            if self.profiler is not None:
+                self.profiler.reset()
 
             # Loop over batches from validation set
-            for step, (x, _, y) in enumerate(self.valid_loader):
+            for x, _, y in self.valid_loader:
 
                 # Dataloader uses cpu to allow pin memory
                 x = x.to(self.device)
                 y = y.to(self.device)
 
-                # Forward pass through network
-                output, firing_rates = self.net(x)
+                # Avoid recompilations on the last partial batch
+                if self.compile:
+                    torch._dynamo.mark_dynamic(x, 0)
 
-                # Compute loss
-                loss_val = self.loss_fn(output, y)
-                losses.append(loss_val.item())
+                # Forward pass through network
+                with autocast(self.device, self.precision):
+                    output, firing_rates = self.model(x)
+                    loss_val = self.loss_fn(output, y)
 
-                # Compute accuracy with labels
-                pred = torch.argmax(output, dim=1)
-                acc = np.mean((y == pred).detach().cpu().numpy())
-                accs.append(acc)
+                # Compute loss, accuracy and spike activity on device
+                metrics.update(loss_val, output, y, firing_rates)
 
-                # Spike activity
-                if self.net.is_snn:
-                    epoch_spike_rate += torch.mean(firing_rates)
+            # Read metrics of whole epoch at once
+            valid_loss, valid_acc, epoch_spike_rate = metrics.compute()
+            self.epoch_metrics.update({"valid loss": valid_loss, "valid acc": valid_acc})
 
             # Validation loss of whole epoch
-            valid_loss = np.mean(losses)
             logging.info(f"Epoch {e}: valid loss={valid_loss}")
 
             # Validation accuracy of whole epoch
-            valid_acc = np.mean(accs)
             logging.info(f"Epoch {e}: valid acc={valid_acc}")
 
             # Validation spike activity of whole epoch
             if self.net.is_snn:
-                epoch_spike_rate /= step
                 logging.info(f"Epoch {e}: valid mean act rate={epoch_spike_rate}")
 
 
-            if not self.debug:
-                wandb.log({"valid loss":valid_loss, "valid acc":valid_acc, "valid sparsity": 1-epoch_spike_rate}, commit=True)
+            # Validation operations per sample of whole epoch
+            synops = self.log_synops(f"Epoch {e}: valid", "valid")
+            self.log_profile(f"epoch{e}_valid")
+
+            self.run_logger.log({"valid loss":valid_loss, "valid acc":valid_acc, "valid sparsity": 1-epoch_spike_rate, **synops}, commit=True)
 
             # Update learning rate
             self.scheduler.step(valid_acc)
@@ -556,9 +1042,9 @@ class Experiment:
                 best_acc = valid_acc
                 best_epoch = e
 
-                # Save best model
-                if self.save_best:
-                    torch.save(self.net, f"{self.checkpoint_dir}/best_model.pth")
+                # Save best model, from main process only
+                if self.save_best and is_main_process():
+                    save_weights(self.net, f"{self.checkpoint_dir}/best_model")
                     logging.info(f"\nBest model saved with valid acc={valid_acc}")
 
             logging.info("\n-----------------------------\n")
@@ -573,77 +1059,91 @@ class Experiment:
         with torch.no_grad():
 
             self.net.eval()
-            losses, accs = [], []
-            epoch_spike_rate = 0
+            metrics = EpochMetrics(self.device)
+            if self.synops is not None:
+                self.synops.reset()
+            if self.profiler is not None:
+                self.profiler.reset()
 
             logging.info("\n------ Begin Testing ------\n")
 
             # Loop over batches from test set
-            for step, (x, _, y) in enumerate(test_loader):
+            for x, _, y in test_loader:
 
                 # Dataloader uses cpu to allow pin memory
                 x = x.to(self.device)
                 y = y.to(self.device)
 
-                # Forward pass through network
-                output, firing_rates = self.net(x)
+                # Avoid recompilations on the last partial batch
+                if self.compile:
+                    torch._dynamo.mark_dynamic(x, 0)
 
-                # Compute loss
-                loss_val = self.loss_fn(output, y)
-                losses.append(loss_val.item())
+                # Forward pass through network
+                with autocast(self.device, self.precision):
+                    output, firing_rates = self.model(x)
+                    loss_val = self.loss_fn(output, y)
 
-                # Compute accuracy with labels
-                pred = torch.argmax(output, dim=1)
-                acc = np.mean((y == pred).detach().cpu().numpy())
-                accs.append(acc)
+                # Compute loss, accuracy and spike activity on device
+                metrics.update(loss_val, output, y, firing_rates)
 
-                # Spike activity
-                if self.net.is_snn:
-                    epoch_spike_rate += torch.mean(firing_rates)
+            # Read metrics of whole test set at once
+            test_loss, test_acc, epoch_spike_rate = metrics.compute()
+            self.epoch_metrics.update({"test loss": test_loss, "test acc": test_acc})
 
             # Test loss
-            test_loss = np.mean(losses)
             logging.info(f"Test loss={test_loss}")
 
             # Test accuracy
-            test_acc = np.mean(accs)
             logging.info(f"Test acc={test_acc}")
 
 
             # Test spike activity
             if self.net.is_snn:
-                epoch_spike_rate /= step
                 logging.info(f"Test mean act rate={epoch_spike_rate}")
             
-            if not self.debug:
-                wandb.log({"test loss":test_loss, "test acc":test_acc, "test sparsity": 1-epoch_spike_rate}, commit=False)
+            # Test operations per sample
+            synops = self.log_synops("Test", "test")
+            self.log_profile("test")
+
+            self.run_logger.log({"test loss":test_loss, "test acc":test_acc, "test sparsity": 1-epoch_spike_rate, **synops}, commit=False)
             
 
             logging.info("\n-----------------------------\n")
 
-            new_result_entry = {
-            'test_acc': test_acc,
-            'number_layers': self.nb_layers,
-            'number_neurons': self.nb_hiddens,
-            'model_type': self.model_type, 
-            'best_val_acc': self.best_val_acc
-            }
+    def log_synops(self, log_prefix, split):
+        """
+        This function logs the operations per sample counted since the
+        beginning of the epoch and returns them as wandb metrics.
+        """
+        if self.synops is None:
+            return {}
 
-            # self.save_results_to_json(new_result_entry)
+        ops = self.synops.summary()
+        for op in OPS:
+            logging.info(f"{log_prefix} {op} per sample={ops[op]:.4g}")
+        logging.info(f"{log_prefix} energy per sample={ops['energy']:.4g} J")
 
-    def save_results_to_json(self,result_entry):
-        if self.dataset_name == "ssc":
-            filename='resultsSSC.json'
-        if self.dataset_name == "shd":
-            filename='resultsSHD.json'
+        return {f"{split} {key}": value for key, value in ops.items()}
 
-        try:
-            with open(filename, 'r') as file:
-                results = json.load(file)
-        except FileNotFoundError:
-            results = []
+    def log_profile(self, tag):
+        """
+        This function logs the profile of the layers since the beginning of
+        the epoch and saves it as a Chrome trace in the experiment folder.
+        """
+        if self.profiler is None:
+            return
 
-        results.append(result_entry)
-        
-        with open(filename, 'w') as file:
-            json.dump(results, file, indent=4)
+        profile_dir = self.exp_folder + "/profile/"
+        if not os.path.exists(profile_dir):
+            os.makedirs(profile_dir)
+
+        logging.info(f"\nProfile {tag}:\n{self.profiler.summary()}\n")
+        self.profiler.save_trace(f"{profile_dir}{tag}.json")
+
+    def save_results(self, result_entry):
+        """
+        This function appends the final results of the experiment to the
+        results store shared by all experiments.
+        """
+        ResultsStore(self.results_db).add(result_entry)
+        logging.info(f"Results saved to {self.results_db}")
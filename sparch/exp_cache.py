@@ -0,0 +1,130 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is where the cache of experiments keyed by their config is defined.
+
+A new experiment is stored in a folder named after a stable hash of its
+full resolved config: model and training options, extra config and seed.
+Different configs therefore never share a folder. Only the options whose
+value differs from the default of the parsers are hashed, so that adding a
+new option does not change the folders of the former experiments. Completed experiments
+write their results next to their config,
+
+    exp/final/<dataset>_<model>_<layers>lay<hiddens>_<hash>/config.json
+    exp/final/<dataset>_<model>_<layers>lay<hiddens>_<hash>/results.json
+    exp/final/<dataset>_<model>_<layers>lay<hiddens>_<hash>/checkpoints/
+
+and find_completed returns them for an identical config, so that sweeps
+only train the configs that are new.
+"""
+import argparse
+import functools
+import hashlib
+import json
+import os
+
+EXP_ROOT = "exp/final"
+
+# Options that change neither the trained model nor its results
+IGNORED_KEYS = [
+    "debug",
+    "log_tofile",
+    "save_best",
+    "new_exp_folder",
+    "load_exp_folder",
+    "use_pretrained_model",
+    "only_do_testing",
+    "sweep_name",
+    "sweep_id",
+    "method",
+    "gpu_device",
+    "compile",
+    "count_synops",
+    "profile",
+    "telemetry_file",
+    "find_batch_size",
+    "memory_budget",
+    "dist_backend",
+    "resume",
+    "checkpoint_every",
+    "keep_checkpoints",
+    "results_db",
+    "log_backend",
+]
+
+
+@functools.lru_cache(maxsize=None)
+def parser_defaults():
+    """
+    Default values of the options of the parsers, where options given as
+    lists are replaced by their first value.
+    """
+    from sparch.parsers.model_config import add_model_options
+    from sparch.parsers.training_config import add_training_options
+
+    parser = argparse.ArgumentParser()
+    parser = add_model_options(parser)
+    parser = add_training_options(parser)
+    config = vars(parser.parse_args([]))
+    return {k: v[0] if isinstance(v, list) else v for k, v in config.items()}
+
+
+def config_hash(config):
+    """
+    Stable hash of the options of a config that change the results and
+    differ from their default.
+    """
+    defaults = parser_defaults()
+    resolved = {
+        k: v
+        for k, v in config.items()
+        if k not in IGNORED_KEYS and (k not in defaults or v != defaults[k])
+    }
+    text = json.dumps(resolved, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+def experiment_folder(config, root=EXP_ROOT):
+    """Folder of the experiment of a config."""
+    name = f"{config['dataset_name']}_{config['model_type']}_"
+    name += f"{config['nb_layers']}lay{config['nb_hiddens']}_{config_hash(config)}"
+    return os.path.join(root, name.replace(".", "_"))
+
+
+def write_json(path, data):
+    """Writes a json file atomically."""
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=4, default=str)
+    os.replace(tmp, path)
+
+
+def find_completed(config, root=EXP_ROOT):
+    """
+    Returns the results of the completed experiment of an identical config,
+    with its folder and best checkpoint, or None if there is none.
+    """
+    folder = experiment_folder(config, root)
+    path = os.path.join(folder, "results.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        results = json.load(f)
+    if not results.get("completed"):
+        return None
+
+    checkpoint = os.path.join(folder, "checkpoints", "best_model.json")
+    if not os.path.exists(checkpoint):
+        checkpoint = os.path.join(folder, "checkpoints", "best_model.pth")
+    return {
+        **results,
+        "exp_folder": folder,
+        "checkpoint": checkpoint if os.path.exists(checkpoint) else None,
+    }
@@ -0,0 +1,66 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is where the on-device metric accumulators used by the training and
+evaluation loops are defined.
+"""
+import torch
+import torch.distributed as dist
+
+
+class EpochMetrics:
+    """
+    Accumulates the loss, the number of correct predictions and the mean
+    firing rate over an epoch as device tensors, so that the loops do not
+    synchronize with the host at every batch. All metrics are averaged over
+    samples instead of batches, which gives the last partial batch its
+    correct weight.
+
+    Arguments
+    ---------
+    device : torch.device
+        Device of the model outputs.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        """Clears the accumulators, e.g. at the beginning of an epoch."""
+        self.sums = torch.zeros(3, device=self.device)
+        self.samples = 0
+
+    @torch.no_grad()
+    def update(self, loss, output, y, firing_rates=None):
+        """
+        Adds a batch with its mean loss, network outputs, labels and
+        optional firing rates of the spiking neurons.
+        """
+        n = y.shape[0]
+        correct = (torch.argmax(output, dim=1) == y).sum()
+        loss = loss.detach().float()
+        if firing_rates is not None:
+            rate = firing_rates.float().mean()
+        else:
+            rate = loss.new_zeros(())
+        self.sums += torch.stack([loss * n, correct.float(), rate * n])
+        self.samples += n
+
+    def compute(self):
+        """
+        Returns the mean loss, accuracy and firing rate, with a single sync.
+        In distributed training, the sums of all processes are combined.
+        """
+        sums = torch.cat([self.sums, self.sums.new_tensor([self.samples])])
+        if dist.is_initialized():
+            dist.all_reduce(sums)
+        loss, acc, rate = (sums[:3] / sums[3].clamp(min=1)).tolist()
+        return loss, acc, rate
@@ -15,6 +15,9 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from .norm import BatchNorm1d
+from .precision import fp32
+
 
 class ANN(nn.Module):
     """
@@ -198,7 +201,7 @@ class MLPLayer(nn.Module):
         # Initialize normalization
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -209,10 +212,6 @@ class MLPLayer(nn.Module):
 
     def forward(self, x):
 
-        # Change batch size if needed
-        if self.batch_size != x.shape[0]:
-            self.batch_size = x.shape[0]
-
         # Feed-forward affine transformations (all steps in parallel)
         Wx = self.W(x)
 
@@ -283,7 +282,7 @@ class RNNLayer(nn.Module):
         # Initialize normalization
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -299,10 +298,6 @@ class RNNLayer(nn.Module):
             x_flip = x.flip(1)
             x = torch.cat([x, x_flip], dim=0)
 
-        # Change batch size if needed
-        if self.batch_size != x.shape[0]:
-            self.batch_size = x.shape[0]
-
         # Feed-forward affine transformations (all steps in parallel)
         Wx = self.W(x)
 
@@ -398,8 +393,8 @@ class LiGRULayer(nn.Module):
         # Initialize normalization
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
-            self.normz = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.normz = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -416,10 +411,6 @@ class LiGRULayer(nn.Module):
             x_flip = x.flip(1)
             x = torch.cat([x, x_flip], dim=0)
 
-        # Change batch size if needed
-        if self.batch_size != x.shape[0]:
-            self.batch_size = x.shape[0]
-
         # Feed-forward affine transformations (all steps in parallel)
         Wx = self.W(x)
         Wzx = self.Wz(x)
@@ -524,9 +515,9 @@ class GRULayer(nn.Module):
         # Initialize normalization
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
-            self.normz = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
-            self.normr = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.normz = BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.normr = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -544,10 +535,6 @@ class GRULayer(nn.Module):
             x_flip = x.flip(1)
             x = torch.cat([x, x_flip], dim=0)
 
-        # Change batch size if needed
-        if self.batch_size != x.shape[0]:
-            self.batch_size = x.shape[0]
-
         # Feed-forward affine transformations (all steps in parallel)
         Wx = self.W(x)
         Wzx = self.Wz(x)
@@ -635,7 +622,7 @@ class ReadoutLayerANN(nn.Module):
         # Initialize normalization
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.output_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.output_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.output_size)
@@ -655,6 +642,7 @@ class ReadoutLayerANN(nn.Module):
 
         return Wy
 
+    @fp32
     def _readout_cell(self, x):
 
         # Cumulative sum to remove time dim
@@ -0,0 +1,234 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is where the vectorized ensembles of models are defined.
+
+The parameters and buffers of K models of the same architecture (SNN or
+S4Model) are stacked along a leading member dimension, and the K forward
+passes run as a single one with torch.func.vmap. The members see the same
+batches but keep their own initializations, dropout masks and random
+initial states. Hyperparameters that only change float attributes of the
+layers, such as the threshold, become per-member buffers, and per-member
+learning rates are handled by MemberLearningRates.
+"""
+import copy
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.func import functional_call
+from torch.func import stack_module_state
+from torch.func import vmap
+from torch.optim.lr_scheduler import ReduceLROnPlateau
+
+
+class Ensemble(nn.Module):
+    """
+    Stacks K models of the same architecture and runs them in parallel.
+
+    Arguments
+    ---------
+    members : list of nn.Module
+        Models to stack, built with the same architecture. They may differ
+        by their weights, buffers and float attributes.
+    tensorize : list
+        Module names and float attributes turned into per-member buffers
+        even if they are equal, e.g. to rebuild a saved ensemble.
+
+    The forward pass returns the outputs of shape (K, batch, classes) and
+    the firing rates of shape (K, neurons), or None if the members do not
+    return them.
+    """
+
+    def __init__(self, members, tensorize=()):
+        super().__init__()
+
+        self.tensorized = _tensorize_attributes(members, tensorize)
+        params, buffers = stack_module_state(members)
+
+        self.size = len(members)
+        self.is_snn = members[0].is_snn
+        self.param_names = list(params)
+        self.buffer_names = list(buffers)
+        for name, value in params.items():
+            self.register_parameter(_key(name), nn.Parameter(value))
+        for name, value in buffers.items():
+            self.register_buffer(_key(name), value)
+
+        # Stateless copy of a member, only used for its structure
+        self.__dict__["base"] = copy.deepcopy(members[0]).to("cpu")
+
+    def _stacked(self):
+        params = {n: getattr(self, _key(n)) for n in self.param_names}
+        buffers = {n: getattr(self, _key(n)) for n in self.buffer_names}
+        return params, buffers
+
+    def train(self, mode=True):
+        super().train(mode)
+        self.base.train(mode)
+        return self
+
+    def forward(self, x):
+        def run(params, buffers, x):
+            out, rates = functional_call(self.base, (params, buffers), (x,))
+            if rates is None:
+                rates = out.new_zeros(0)
+            return out, rates
+
+        params, buffers = self._stacked()
+        out, rates = vmap(run, in_dims=(0, 0, None), randomness="different")(
+            params, buffers, x
+        )
+        return out, rates if rates.shape[-1] > 0 else None
+
+    def member(self, k):
+        """Returns member k as a standalone model."""
+        net = copy.deepcopy(self.base)
+        params, buffers = self._stacked()
+        with torch.no_grad():
+            for name, value in {**params, **buffers}.items():
+                module_name, _, attr = name.rpartition(".")
+                module = net.get_submodule(module_name)
+                tensor = value[k].detach().clone()
+                if name in params:
+                    tensor = nn.Parameter(tensor)
+                setattr(module, attr, tensor)
+        return net
+
+    @torch.no_grad()
+    def copy_member(self, k, other):
+        """Copies the weights and buffers of member k of another ensemble."""
+        state = self.state_dict()
+        for name, value in other.state_dict().items():
+            state[name][k].copy_(value[k])
+
+
+def member_losses(output, y):
+    """Cross-entropy loss of each member, of shape (K,)."""
+    nb_members = output.shape[0]
+    loss = F.cross_entropy(
+        output.flatten(0, 1), y.repeat(nb_members), reduction="none"
+    )
+    return loss.view(nb_members, -1).mean(1)
+
+
+def ensemble_loss(output, y):
+    """Sum of the cross-entropy losses of the members."""
+    return member_losses(output, y).sum()
+
+
+class MemberLearningRates:
+    """
+    Learning rates of the members of an ensemble, each with its own
+    ReduceLROnPlateau scheduler.
+
+    The optimizer of the stacked parameters must run with lr=1 and have an
+    update proportional to the learning rate, like Adam without weight
+    decay. After each step, the update of every member is rescaled by its
+    learning rate.
+
+    Arguments
+    ---------
+    net : Ensemble
+        Ensemble whose parameters are optimized.
+    lrs : list of float
+        Initial learning rate of each member.
+    **scheduler_kwargs
+        Arguments of the ReduceLROnPlateau schedulers.
+    """
+
+    def __init__(self, net, lrs, **scheduler_kwargs):
+        self.params = [p for p in net.parameters() if p.requires_grad]
+
+        # Schedulers only act on the learning rates of placeholder optimizers
+        self.optimizers = [
+            torch.optim.SGD([torch.zeros(1, requires_grad=True)], lr=lr) for lr in lrs
+        ]
+        self.schedulers = [
+            ReduceLROnPlateau(opt, **scheduler_kwargs) for opt in self.optimizers
+        ]
+
+    @property
+    def lrs(self):
+        return [opt.param_groups[0]["lr"] for opt in self.optimizers]
+
+    def step(self, optimizer, scaler):
+        """Optimizer step with the update of each member rescaled."""
+        previous = [p.detach().clone() for p in self.params]
+        scaler.step(optimizer)
+        with torch.no_grad():
+            lrs = torch.tensor(self.lrs, device=self.params[0].device)
+            for p, p0 in zip(self.params, previous):
+                scale = lrs.view(-1, *[1] * (p.dim() - 1)).to(p.dtype)
+                p.copy_(p0 + (p - p0) * scale)
+
+    def state_dict(self):
+        return {
+            "optimizers": [opt.state_dict() for opt in self.optimizers],
+            "schedulers": [s.state_dict() for s in self.schedulers],
+        }
+
+    def load_state_dict(self, state):
+        for opt, opt_state in zip(self.optimizers, state["optimizers"]):
+            opt.load_state_dict(opt_state)
+        for scheduler, scheduler_state in zip(self.schedulers, state["schedulers"]):
+            scheduler.load_state_dict(scheduler_state)
+
+    def scheduler_step(self, metrics):
+        """Steps the scheduler of each member with its own metric."""
+        for scheduler, metric in zip(self.schedulers, metrics):
+            scheduler.step(metric)
+
+
+def _key(name):
+    # Parameter names cannot contain dots
+    return name.replace(".", "-")
+
+
+def _tensorize_attributes(members, forced=()):
+    """
+    Turns float attributes that differ between members, or are forced, into
+    buffers, so that they are stacked with the weights, and returns their
+    module names and attributes. Other differences cannot be vectorized.
+    """
+    forced = [list(f) for f in forced]
+    tensorized = []
+    modules = [dict(m.named_modules()) for m in members]
+    for name, module in modules[0].items():
+        for attr, value in list(vars(module).items()):
+            if attr.startswith("_") or isinstance(value, (nn.Module, torch.Tensor)):
+                continue
+            values = [vars(m[name]).get(attr) for m in modules]
+            same = all(v == value for v in values) or _init_only(values)
+            if same and [name, attr] not in forced:
+                continue
+            if not all(isinstance(v, float) for v in values):
+                raise ValueError(
+                    f"Members of an ensemble differ by {name}.{attr}, "
+                    f"which is not a float: {values}"
+                )
+            for m, v in zip(modules, values):
+                delattr(m[name], attr)
+                m[name].register_buffer(attr, torch.tensor(v), persistent=False)
+            tensorized.append([name, attr])
+    return tensorized
+
+
+def _init_only(values):
+    # Config dicts such as extra_features may differ by float values, e.g.
+    # dt_min and dt_max, which only set the initialization of the weights
+    if not all(isinstance(v, dict) for v in values):
+        return False
+    keys = set().union(*values)
+    return all(
+        all(v.get(key) == values[0].get(key) for v in values)
+        or all(isinstance(v.get(key), float) for v in values)
+        for key in keys
+    )
@@ -0,0 +1,104 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is where the split of an SNN into frozen lower layers and trainable
+upper layers is defined.
+
+The frozen prefix is run once over the dataset and its output spikes are
+cached, see sparch.dataloaders.spike_cache, then only the suffix is run on
+the cached spikes during training. Both share the layers of the SNN, which
+stays the model that is saved and loaded.
+"""
+import torch
+import torch.nn as nn
+
+
+def freeze_layers(net, nb_layers):
+    """
+    Stops the training of the nb_layers lower layers of an SNN, whose
+    outputs are spike trains that can be cached.
+    """
+    net = getattr(net, "_orig_mod", net)
+    if not getattr(net, "is_snn", False) or not hasattr(net, "snn"):
+        raise ValueError("Frozen layers are only implemented for SNN models")
+    if net.extra_features.get("residual"):
+        raise ValueError("Frozen layers do not support residual connections")
+    if not 0 < nb_layers < len(net.snn):
+        raise ValueError(
+            f"Cannot freeze {nb_layers} layers of a model with {len(net.snn)} "
+            "layers, at least the last one must be trained"
+        )
+
+    for layer in net.snn[:nb_layers]:
+        for param in layer.parameters():
+            param.requires_grad = False
+
+
+class FrozenPrefix(nn.Module):
+    """
+    Runs the frozen lower layers of an SNN and returns their output spikes
+    with shape (batch, time, feats).
+
+    Arguments
+    ---------
+    net : SNN
+        Model whose layers are run.
+    nb_layers : int
+        Number of frozen lower layers.
+    """
+
+    def __init__(self, net, nb_layers):
+        super().__init__()
+        self.net = net
+        self.nb_layers = nb_layers
+
+    def forward(self, x):
+
+        # Reshape input tensors to (batch, time, feats) for 4d inputs
+        if self.net.reshape:
+            x = x.reshape(x.shape[0], x.shape[1], x.shape[2] * x.shape[3])
+
+        for snn_lay in self.net.snn[: self.nb_layers]:
+            x = snn_lay(x)
+        return x
+
+
+class SNNSuffix(nn.Module):
+    """
+    Runs the trainable upper layers of an SNN on the output spikes of its
+    frozen lower layers. Returns the outputs of the SNN and the firing
+    rates of the hidden neurons of the upper layers.
+
+    Arguments
+    ---------
+    net : SNN
+        Model whose layers are run.
+    nb_layers : int
+        Number of frozen lower layers.
+    """
+
+    def __init__(self, net, nb_layers):
+        super().__init__()
+        self.net = net
+        self.nb_layers = nb_layers
+
+    def forward(self, x):
+        net = self.net
+        layer_rates = []
+        for i in range(self.nb_layers, len(net.snn)):
+            x = net.snn[i](x)
+            if net.track_firing_rates and not (
+                net.use_readout_layer and i == net.num_layers - 1
+            ):
+                layer_rates.append(x.mean(dim=(0, 1)))
+
+        if not net.track_firing_rates or not layer_rates:
+            return x, None
+        return x, torch.cat(layer_rates)
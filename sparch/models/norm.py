@@ -0,0 +1,138 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is where the batch normalization used by the SNN, ANN and S4 layers is
+defined.
+
+It behaves like nn.BatchNorm1d, with three additions: it always computes in
+fp32, even under autocast, it can accumulate the moments of several
+micro-batches so that the running statistics are updated once per logical
+batch, exactly as with a single large batch, and it can synchronize the
+statistics across the processes of distributed data parallel training,
+on CPU as well as on GPU. During the accumulation, each micro-batch is
+normalized with its own statistics.
+"""
+import contextlib
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+
+from .precision import fp32
+
+
+class BatchNorm1d(nn.BatchNorm1d):
+    """
+    BatchNorm1d whose statistics and normalization are computed in fp32,
+    with optional accumulation of the moments across micro-batches and
+    optional synchronization across processes. The state dict is the same
+    as the one of nn.BatchNorm1d.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._moments = None
+        self.sync = False
+
+    @fp32
+    def forward(self, x):
+        accumulate = getattr(self, "_moments", None) is not None
+        sync = getattr(self, "sync", False) and dist.is_initialized()
+        if not self.training or not (accumulate or sync):
+            return super().forward(x)
+
+        dims = [d for d in range(x.dim()) if d != 1]
+        if sync:
+            # Differentiable sums over all processes, like nn.SyncBatchNorm
+            from torch.distributed.nn.functional import all_reduce
+
+            count = x.new_full((1,), x.numel() // x.shape[1])
+            stats = all_reduce(torch.cat([x.sum(dims), (x * x).sum(dims), count]))
+            n = int(stats[-1].item())
+            mean = stats[: x.shape[1]] / n
+            var = stats[x.shape[1] : -1] / n - mean**2
+        else:
+            var, mean = torch.var_mean(x, dim=dims, correction=0)
+            n = x.numel() // x.shape[1]
+
+        if accumulate:
+            self._accumulate(n, mean.detach(), var.detach())
+        elif self.track_running_stats:
+            self._update_running_stats(n, mean.detach(), var.detach())
+
+        # Normalize with statistics of (micro-)batch
+        shape = [1, -1] + [1] * (x.dim() - 2)
+        y = (x - mean.view(shape)) * torch.rsqrt(var.view(shape) + self.eps)
+        if self.affine:
+            y = y * self.weight.view(shape) + self.bias.view(shape)
+        return y
+
+    def _accumulate(self, n, mean, var):
+        # Combine moments with previous ones (Chan et al.)
+        count, mean_a, m2_a = self._moments
+        total = count + n
+        delta = mean - mean_a
+        self._moments = (
+            total,
+            mean_a + delta * n / total,
+            m2_a + var * n + delta**2 * count * n / total,
+        )
+
+    @torch.no_grad()
+    def _update_running_stats(self, n, mean, var):
+        if n < 2:
+            return
+        self.num_batches_tracked += 1
+        if self.momentum is None:
+            momentum = 1.0 / float(self.num_batches_tracked)
+        else:
+            momentum = self.momentum
+        self.running_mean.lerp_(mean, momentum)
+        self.running_var.lerp_(var * n / (n - 1), momentum)
+
+    def start_accumulation(self):
+        """Starts accumulating the moments of the next micro-batches."""
+        zeros = torch.zeros(self.num_features, device=self.weight.device)
+        self._moments = (0, zeros, zeros.clone())
+
+    def stop_accumulation(self):
+        """Updates the running statistics with the accumulated moments."""
+        count, mean, m2 = self._moments
+        self._moments = None
+        if self.track_running_stats and count > 0:
+            self._update_running_stats(count, mean, m2 / count)
+
+
+@contextlib.contextmanager
+def accumulate_moments(net):
+    """
+    Context in which the BatchNorm1d layers of the model accumulate the
+    moments of all forward passes, e.g. over the micro-batches of a
+    logical batch, and update their running statistics once on exit.
+    """
+    norms = [m for m in net.modules() if isinstance(m, BatchNorm1d)]
+    for norm in norms:
+        norm.start_accumulation()
+    try:
+        yield
+    finally:
+        for norm in norms:
+            norm.stop_accumulation()
+
+
+def convert_sync_batchnorm(net):
+    """
+    Synchronizes the statistics of the BatchNorm1d layers of the model
+    across the processes of the default process group during training.
+    """
+    for module in net.modules():
+        if isinstance(module, BatchNorm1d):
+            module.sync = True
+    return net
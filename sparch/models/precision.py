@@ -0,0 +1,92 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is where the mixed-precision helpers of the models and experiments are
+defined.
+
+Training and inference can run in fp32, in bf16 with autocast, or in fp16
+with autocast and a gradient scaler. The matrix multiplications of the
+layers then run in the lower precision, while the pieces sensitive to
+rounding are pinned to fp32 with the fp32 decorator: the construction of
+the complex decay factors and the complex recurrences, the recurrences of
+the LIF, adLIF, RLIF and RadLIF layers, whose fixed-point solver chains
+matrix products over time, the BatchNorm statistics, the softmax
+accumulation of the readout layers and the FFT convolution of the S4
+layers.
+"""
+import functools
+
+import torch
+
+PRECISIONS = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def autocast(device, precision):
+    """Returns the autocast context of the given precision on the device."""
+    if precision not in PRECISIONS:
+        raise ValueError(f"Invalid precision {precision}")
+    dtype = PRECISIONS[precision]
+    return torch.autocast(
+        device_type=device.type, dtype=dtype, enabled=dtype is not None
+    )
+
+
+def grad_scaler(device, precision):
+    """
+    Returns the gradient scaler of the given precision on the device, which
+    only scales the loss for fp16 and is a no-op otherwise.
+    """
+    enabled = precision == "fp16"
+    if hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler(device.type, enabled=enabled)
+    if enabled and device.type != "cuda":
+        raise ValueError(
+            f"fp16 training on {device.type} needs torch.amp.GradScaler, "
+            "use bf16 instead"
+        )
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+def fp32(fn):
+    """
+    Decorates a method so that it runs outside of autocast, with its
+    floating point tensor arguments cast to fp32.
+    """
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        tensors = [a for a in args if isinstance(a, torch.Tensor)]
+        device_type = tensors[0].device.type if tensors else "cpu"
+        if not _autocast_enabled(device_type):
+            return fn(*args, **kwargs)
+
+        args = [_to_float(a) for a in args]
+        kwargs = {k: _to_float(v) for k, v in kwargs.items()}
+        with torch.autocast(device_type=device_type, enabled=False):
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def _autocast_enabled(device_type):
+    try:
+        return torch.is_autocast_enabled(device_type)
+    except TypeError:
+        # Older versions have a separate flag for CPU
+        if device_type == "cpu":
+            return torch.is_autocast_cpu_enabled()
+        return torch.is_autocast_enabled()
+
+
+def _to_float(x):
+    if isinstance(x, torch.Tensor) and x.is_floating_point():
+        return x.float()
+    return x
+
@@ -0,0 +1,200 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is where the per-layer profiler of SNNs, ANNs and S4Models is defined.
+
+Each layer is split into phases with forward hooks on its submodules: the
+feedforward projections (W), the normalization (norm), the dropout and,
+for S4 layers, the kernel generation and the output mixing. The rest of the
+layer, i.e. the time loop of the neuron cell (or the FFT convolution), is
+reported as the cell phase. The hooks are only registered when profiling is
+enabled, so that the model runs without any overhead otherwise.
+
+The memory column is the change of allocated CUDA memory. It is left out
+for models on CPU, whose tensors are allocated outside of the Python heap
+seen by tracemalloc and reuse freed blocks, so that neither tracemalloc nor
+the resident set size give a per-phase figure.
+"""
+import json
+import time
+
+import torch
+
+# Submodules of a layer and the phase they belong to
+PHASES = {
+    "W": "W",
+    "Wz": "W",
+    "Wr": "W",
+    "norm": "norm",
+    "normz": "norm",
+    "normr": "norm",
+    "drop": "dropout",
+    "dropout": "dropout",
+    "kernel": "kernel",
+    "output_linear": "mix",
+}
+
+
+class LayerProfiler:
+    """
+    Records the wall time, the change of allocated CUDA memory and the
+    number of calls of every phase of every layer, in total and per time
+    step, and keeps the calls as Chrome trace events. Memory is only
+    recorded for models on CUDA devices.
+
+    Arguments
+    ---------
+    net : nn.Module
+        SNN, ANN or S4Model, possibly wrapped by torch.compile.
+    """
+
+    def __init__(self, net):
+        self.net = getattr(net, "_orig_mod", net)
+        param = next(self.net.parameters(), None)
+        self.device = param.device if param is not None else torch.device("cpu")
+        self.track_memory = self.device.type == "cuda"
+        self.handles = []
+        self.origin = time.perf_counter()
+        for name, layer in self._layers():
+            phases = [
+                (PHASES[child], module)
+                for child, module in layer.named_children()
+                if child in PHASES
+            ]
+            self._register(name, None, layer, phases)
+            for phase, module in phases:
+                self._register(name, phase, module, [])
+        self.reset()
+
+    def _layers(self):
+        net = self.net
+        name = type(net).__name__
+        if name == "SNN":
+            layers = list(net.snn)
+        elif name == "ANN":
+            layers = list(net.ann)
+        elif name == "S4Model":
+            yield "encoder", net.encoder
+            for i, (layer, norm) in enumerate(zip(net.s4_layers, net.norms)):
+                yield f"layer{i}", layer
+                yield f"norm{i}", norm
+            yield "readout", net.decoder
+            return
+        else:
+            raise NotImplementedError(f"Profiling of {name} is not supported")
+
+        for i, layer in enumerate(layers):
+            last = i == len(layers) - 1 and "Readout" in type(layer).__name__
+            yield "readout" if last else f"layer{i}", layer
+
+    def _sync(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def _memory(self):
+        return torch.cuda.memory_allocated(self.device) if self.track_memory else 0
+
+    def _register(self, name, phase, module, children):
+        def pre_hook(module, inputs):
+            self._sync()
+            self.open[(name, phase)] = (time.perf_counter(), self._memory())
+            if phase is None:
+                self.children_time[name] = 0.0
+
+                # Number of time steps, S4 layers take (batch, feats, time)
+                x = inputs[0]
+                if x.dim() == 3:
+                    transposed = type(module).__name__ == "S4D_orig"
+                    self.steps = x.shape[-1] if transposed else x.shape[1]
+
+        def hook(module, inputs, output):
+            self._sync()
+            end = time.perf_counter()
+            start, memory = self.open.pop((name, phase))
+            duration = end - start
+            memory = self._memory() - memory
+            steps = self.steps
+
+            if phase is None:
+                # Time of the layer not spent in any submodule
+                label = "cell" if children else "forward"
+                self._add(name, label, duration - self.children_time[name], 0, steps)
+            else:
+                self.children_time[name] += duration
+                self._add(name, phase, duration, memory, steps)
+
+            args = {"steps": steps}
+            if self.track_memory:
+                args["memory"] = memory
+            self.events.append(
+                {
+                    "name": name if phase is None else f"{name}.{phase}",
+                    "ph": "X",
+                    "ts": 1e6 * (start - self.origin),
+                    "dur": 1e6 * duration,
+                    "pid": 0,
+                    "tid": 0,
+                    "args": args,
+                }
+            )
+
+        self.handles.append(module.register_forward_pre_hook(pre_hook))
+        self.handles.append(module.register_forward_hook(hook))
+
+    def _add(self, name, phase, duration, memory, steps):
+        stats = self.stats.setdefault(
+            (name, phase), {"calls": 0, "time": 0.0, "memory": 0, "steps": 0}
+        )
+        stats["calls"] += 1
+        stats["time"] += duration
+        stats["memory"] += memory
+        stats["steps"] += steps
+
+    def reset(self):
+        """Clears the statistics and events, e.g. at the beginning of an epoch."""
+        self.stats = {}
+        self.events = []
+        self.open = {}
+        self.children_time = {}
+        self.steps = 1
+
+    def summary(self):
+        """
+        Returns the statistics as a formatted table, without the memory
+        column for models on CPU.
+        """
+        header = (
+            f"{'layer':<10}{'phase':<10}{'calls':>8}{'total (s)':>12}"
+            f"{'per step (us)':>15}"
+        )
+        if self.track_memory:
+            header += f"{'memory (MB)':>13}"
+        lines = [header]
+        for (name, phase), stats in self.stats.items():
+            per_step = 1e6 * stats["time"] / max(stats["steps"], 1)
+            line = (
+                f"{name:<10}{phase:<10}{stats['calls']:>8}{stats['time']:>12.3f}"
+                f"{per_step:>15.1f}"
+            )
+            if self.track_memory:
+                line += f"{stats['memory'] / 1e6:>13.1f}"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def save_trace(self, path):
+        """Writes the recorded calls to a Chrome trace JSON file."""
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events}, f)
+
+    def remove(self):
+        """Removes the hooks from the model."""
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
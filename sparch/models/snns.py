@@ -19,6 +19,12 @@ import torch.nn.functional as F
 import math
 from einops import rearrange, repeat
 
+from .norm import BatchNorm1d
+from .precision import fp32
+from .spike_solvers import LIFFixedPoint
+from .spike_solvers import LIFcomplexFixedPoint
+from .spike_solvers import adLIFFixedPoint
+
 
 class SpikeFunctionBoxcar(torch.autograd.Function):
     """
@@ -26,16 +32,20 @@ class SpikeFunctionBoxcar(torch.autograd.Function):
     box-car function similar to DECOLLE, Kaiser et al. (2020).
     """
 
+    generate_vmap_rule = True
+
     @staticmethod
-    def forward(ctx, x):
-        ctx.save_for_backward(x)
+    def forward(x):
         return x.gt(0).float()
 
+    @staticmethod
+    def setup_context(ctx, inputs, output):
+        ctx.save_for_backward(inputs[0])
+
+    @staticmethod
     def backward(ctx, grad_spikes):
         (x,) = ctx.saved_tensors
-        grad_x = grad_spikes.clone()
-        grad_x[x <= -0.5] = 0
-        grad_x[x > 0.5] = 0
+        grad_x = grad_spikes.masked_fill((x <= -0.5) | (x > 0.5), 0)
         return grad_x
 
 class SpikeFunctionSuperSpike(torch.autograd.Function):
@@ -44,11 +54,17 @@ class SpikeFunctionSuperSpike(torch.autograd.Function):
     box-car function similar to DECOLLE, Kaiser et al. (2020).
     """
 
+    generate_vmap_rule = True
+
     @staticmethod
-    def forward(ctx, x):
-        ctx.save_for_backward(x)
+    def forward(x):
         return x.gt(0).float()
 
+    @staticmethod
+    def setup_context(ctx, inputs, output):
+        ctx.save_for_backward(inputs[0])
+
+    @staticmethod
     def backward(ctx, grad_spikes):
         (x,) = ctx.saved_tensors
         grad_x = grad_spikes.clone()
@@ -61,11 +77,17 @@ class SpikeFunctionSLAYER(torch.autograd.Function):
     box-car function similar to DECOLLE, Kaiser et al. (2020).
     """
 
+    generate_vmap_rule = True
+
     @staticmethod
-    def forward(ctx, x):
-        ctx.save_for_backward(x)
+    def forward(x):
         return x.gt(0).float()
 
+    @staticmethod
+    def setup_context(ctx, inputs, output):
+        ctx.save_for_backward(inputs[0])
+
+    @staticmethod
     def backward(ctx, grad_spikes):
         (x,) = ctx.saved_tensors
         grad_x = grad_spikes.clone()
@@ -120,6 +142,11 @@ class SNN(nn.Module):
         shape (batch, labels) with no time dimension. If False, the final layer
         is the same as the hidden layers and outputs spike trains with shape
         (batch, time, labels).
+    track_firing_rates : bool
+        If True, the mean firing rate of every hidden neuron is accumulated
+        layer by layer during the forward pass. If False, no activity
+        statistics are computed and None is returned in their place, which
+        is useful for pure inference.
     """
 
     def __init__(
@@ -133,7 +160,8 @@ class SNN(nn.Module):
         use_bias=False,
         bidirectional=False,
         use_readout_layer=True,
-        extra_features=None
+        extra_features=None,
+        track_firing_rates=True,
     ):
         super().__init__()
 
@@ -151,6 +179,7 @@ class SNN(nn.Module):
         self.use_bias = use_bias
         self.bidirectional = bidirectional
         self.use_readout_layer = use_readout_layer
+        self.track_firing_rates = track_firing_rates
         self.is_snn = True
 
         self.extra_features = extra_features
@@ -225,9 +254,9 @@ class SNN(nn.Module):
             else:
                 raise NotImplementedError
 
-        # Process all layers
-        all_spikes = []
-
+        # Process all layers, keeping only the per-neuron mean firing rate
+        # of each spiking layer instead of its full (batch, time, feats) output
+        layer_rates = []
 
         if self.extra_features['residual']:
             res = 0
@@ -235,17 +264,22 @@ class SNN(nn.Module):
                 if not (self.use_readout_layer and i == self.num_layers - 1):
                     x = snn_lay(x) + res
                     res = x
-                    all_spikes.append(x)  
+                    if self.track_firing_rates:
+                        layer_rates.append(x.mean(dim=(0, 1)))
                 else:
                     x = snn_lay(x)
         else:
             for i, snn_lay in enumerate(self.snn):
                 x = snn_lay(x)
-                if not (self.use_readout_layer and i == self.num_layers - 1):
-                    all_spikes.append(x)
+                if self.track_firing_rates and not (
+                    self.use_readout_layer and i == self.num_layers - 1
+                ):
+                    layer_rates.append(x.mean(dim=(0, 1)))
 
-        # Compute mean firing rate of each spiking neuron
-        firing_rates = torch.cat(all_spikes, dim=2).mean(dim=(0, 1))
+        # Mean firing rate of each spiking neuron (num_layers*feats)
+        if not self.track_firing_rates:
+            return x, None
+        firing_rates = torch.cat(layer_rates)
 
         return x, firing_rates
 
@@ -312,7 +346,7 @@ class LIFLayer(nn.Module):
         # Initialize normalization
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -325,6 +359,12 @@ class LIFLayer(nn.Module):
             self.rst_detach = True
         else:
             self.rst_detach = False
+
+        # Reference time loop or fixed-point parallel solver
+        self.spike_solver = extra_features.get("spike_solver", "loop")
+        if self.spike_solver not in ["loop", "fixed_point"]:
+            raise ValueError(f"Invalid spike solver {self.spike_solver}")
+
     def forward(self, x):
 
         # Concatenate flipped sequence on batch dim
@@ -332,10 +372,6 @@ class LIFLayer(nn.Module):
             x_flip = x.flip(1)
             x = torch.cat([x, x_flip], dim=0)
 
-        # Change batch size if needed
-        if self.batch_size != x.shape[0]:
-            self.batch_size = x.shape[0]
-
         # Feed-forward affine transformations (all steps in parallel)
         Wx = self.W(x)
 
@@ -358,6 +394,7 @@ class LIFLayer(nn.Module):
 
         return s
 
+    @fp32
     def _lif_cell(self, Wx):
 
         # Initializations
@@ -369,6 +406,11 @@ class LIFLayer(nn.Module):
         # Bound values of the neuron parameters to plausible ranges
         alpha = torch.clamp(self.alpha, min=self.alpha_lim[0], max=self.alpha_lim[1])
 
+        if self.spike_solver == "fixed_point":
+            return LIFFixedPoint.apply(
+                Wx, alpha, ut, st, self.threshold, self.spike_fct, self.rst_detach
+            )
+
         # Loop over time axis
         for t in range(Wx.shape[1]):
             
@@ -446,7 +488,6 @@ class LIFfeatureLayer(nn.Module):
         # Trainable parameters
         self.W = nn.Linear(self.input_size, self.hidden_size, bias=use_bias)
         self.extra_features = extra_features
-        device = torch.device("cuda")
         if "1-200_1-5"  in extra_features:
             self.alpha_lim = [np.exp(-1 / 5), np.exp(-1 / 200)]
         else:
@@ -477,10 +518,10 @@ class LIFfeatureLayer(nn.Module):
 
         elif "cont" in extra_features:
             if "A0_5" in extra_features:
-                log_log_alpha = torch.log(0.5 * torch.ones(self.hidden_size)).to(device)
+                log_log_alpha = torch.log(0.5 * torch.ones(self.hidden_size))
                 self.register("log_log_alpha", log_log_alpha, lr=0.01)
             elif "A0_5Const" in extra_features:
-                self.log_log_alpha = torch.log(0.5 * torch.ones(self.hidden_size)).to(device)
+                self.register_buffer("log_log_alpha", torch.log(0.5 * torch.ones(self.hidden_size)), persistent=False)
             else:
                 self.log_log_alpha = nn.Parameter(torch.Tensor(self.hidden_size))
                 nn.init.uniform_(self.log_log_alpha, torch.log(-torch.log(torch.tensor(self.alpha_lim[1]))/self.dt), torch.log(-torch.log(torch.tensor(self.alpha_lim[0]))/self.dt))
@@ -490,19 +531,19 @@ class LIFfeatureLayer(nn.Module):
         else:
             self.alpha = nn.Parameter(torch.Tensor(self.hidden_size))
             nn.init.uniform_(self.alpha, self.alpha_lim[0], self.alpha_lim[1])
-            self.log_log_alpha = torch.ones(self.hidden_size).to(device)
+            self.register_buffer("log_log_alpha", torch.ones(self.hidden_size), persistent=False)
 
         
         
         if "imag" in extra_features:
-            alpha_img =  math.pi * torch.ones(self.hidden_size).to(device) # torch.arange(self.hidden_size)
+            alpha_img =  math.pi * torch.ones(self.hidden_size) # torch.arange(self.hidden_size)
             self.register("alpha_img", alpha_img, lr=0.01)
  
 
         # Initialize normalization
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -523,10 +564,6 @@ class LIFfeatureLayer(nn.Module):
             x_flip = x.flip(1)
             x = torch.cat([x, x_flip], dim=0)
 
-        # Change batch size if needed
-        if self.batch_size != x.shape[0]:
-            self.batch_size = x.shape[0]
-
         # Feed-forward affine transformations (all steps in parallel)
         Wx = self.W(x)
 
@@ -549,6 +586,7 @@ class LIFfeatureLayer(nn.Module):
 
         return s
 
+    @fp32
     def _lif_cell(self, Wx):
 
         # Initializations
@@ -561,14 +599,15 @@ class LIFfeatureLayer(nn.Module):
         else:
             eigenval = -torch.exp(self.log_log_alpha) 
 
+        dt = self.dt
         if "dtLog"  in self.extra_features:
-            self.dt = torch.exp(self.log_dt)
+            dt = torch.exp(self.log_dt)
             
         
         if "logAlpha" in self.extra_features :
             alpha = torch.exp(self.log_alpha)
         elif "cont" in self.extra_features:
-            alpha = torch.exp(self.dt*eigenval)
+            alpha = torch.exp(dt*eigenval)
         else:
             alpha = self.alpha
         if "NoClamp" not in self.extra_features:
@@ -675,7 +714,6 @@ class LIFfeatureDimLayer(nn.Module):
         # Trainable parameters
         self.W = nn.Linear(self.input_size, self.hidden_size, bias=use_bias)
         self.extra_features = extra_features
-        device = torch.device("cuda")
         if "1-200_1-5"  in extra_features:
             self.alpha_lim = [np.exp(-1 / 5), np.exp(-1 / 200)]
         else:
@@ -705,10 +743,10 @@ class LIFfeatureDimLayer(nn.Module):
 
         elif "cont" in extra_features:
             if "A0_5" in extra_features:
-                log_log_alpha = torch.log(0.5 * torch.ones(self.hidden_size)).to(device)
+                log_log_alpha = torch.log(0.5 * torch.ones(self.hidden_size))
                 self.register("log_log_alpha", log_log_alpha, lr=0.01)
             elif "A0_5Const" in extra_features:
-                self.log_log_alpha = torch.log(0.5 * torch.ones(self.hidden_size)).to(device)
+                self.register_buffer("log_log_alpha", torch.log(0.5 * torch.ones(self.hidden_size)), persistent=False)
             else:
                 self.log_log_alpha = nn.Parameter(torch.Tensor(self.hidden_size, self.dim))
                 nn.init.uniform_(self.log_log_alpha, torch.log(-torch.log(torch.tensor(self.alpha_lim[1]))/self.dt), torch.log(-torch.log(torch.tensor(self.alpha_lim[0]))/self.dt))
@@ -718,18 +756,18 @@ class LIFfeatureDimLayer(nn.Module):
         else:
             self.alpha = nn.Parameter(torch.Tensor(self.hidden_size))
             nn.init.uniform_(self.alpha, self.alpha_lim[0], self.alpha_lim[1])
-            self.log_log_alpha = torch.ones(self.hidden_size).to(device)
+            self.register_buffer("log_log_alpha", torch.ones(self.hidden_size), persistent=False)
 
         
         
         if "imag" in extra_features:
-            alpha_img =  math.pi * torch.ones(self.hidden_size).to(device) # torch.arange(self.hidden_size)
+            alpha_img =  math.pi * torch.ones(self.hidden_size) # torch.arange(self.hidden_size)
             self.register("alpha_img", alpha_img, lr=0.01)
 
         # Initialize normalization
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -745,10 +783,6 @@ class LIFfeatureDimLayer(nn.Module):
             x_flip = x.flip(1)
             x = torch.cat([x, x_flip], dim=0)
 
-        # Change batch size if needed
-        if self.batch_size != x.shape[0]:
-            self.batch_size = x.shape[0]
-
         # Feed-forward affine transformations (all steps in parallel)
         Wx = self.W(x)
 
@@ -771,6 +805,7 @@ class LIFfeatureDimLayer(nn.Module):
 
         return s
 
+    @fp32
     def _lif_cell(self, Wx):
 
         # Initializations
@@ -783,14 +818,15 @@ class LIFfeatureDimLayer(nn.Module):
         else:
             eigenval = -torch.exp(self.log_log_alpha) 
 
+        dt = self.dt
         if "dtLog"  in self.extra_features:
-            self.dt = torch.exp(self.log_dt)
+            dt = torch.exp(self.log_dt)
             
         
         if "logAlpha" in self.extra_features :
             alpha = torch.exp(self.log_alpha)
         elif "cont" in self.extra_features:
-            alpha = torch.exp(self.dt*eigenval)
+            alpha = torch.exp(dt*eigenval)
         else:
             alpha = self.alpha
 
@@ -900,7 +936,7 @@ class adLIFLayer(nn.Module):
         # Initialize normalization
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -919,6 +955,11 @@ class adLIFLayer(nn.Module):
         else: 
             self.reset_factor = 1
 
+        # Reference time loop or fixed-point parallel solver
+        self.spike_solver = extra_features.get("spike_solver", "loop")
+        if self.spike_solver not in ["loop", "fixed_point"]:
+            raise ValueError(f"Invalid spike solver {self.spike_solver}")
+
     def forward(self, x):
 
         # Concatenate flipped sequence on batch dim
@@ -926,10 +967,6 @@ class adLIFLayer(nn.Module):
             x_flip = x.flip(1)
             x = torch.cat([x, x_flip], dim=0)
 
-        # Change batch size if needed
-        if self.batch_size != x.shape[0]:
-            self.batch_size = x.shape[0]
-
         # Feed-forward affine transformations (all steps in parallel)
         Wx = self.W(x)
 
@@ -952,6 +989,7 @@ class adLIFLayer(nn.Module):
 
         return s
 
+    @fp32
     def _adlif_cell(self, Wx):
 
         # Initializations
@@ -967,6 +1005,12 @@ class adLIFLayer(nn.Module):
         a = torch.clamp(self.a, min=self.a_lim[0], max=self.a_lim[1])
         b = torch.clamp(self.b, min=self.b_lim[0], max=self.b_lim[1])
 
+        if self.spike_solver == "fixed_point":
+            return adLIFFixedPoint.apply(
+                Wx, alpha, beta, a, b, ut, wt, st, self.threshold,
+                self.spike_fct, self.rst_detach, self.reset_factor,
+            )
+
         # Loop over time axis
         for t in range(Wx.shape[1]):
 
@@ -1059,7 +1103,7 @@ class CadLIFLayer(nn.Module):
         # Initialize normalization
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -1080,10 +1124,6 @@ class CadLIFLayer(nn.Module):
             x_flip = x.flip(1)
             x = torch.cat([x, x_flip], dim=0)
 
-        # Change batch size if needed
-        if self.batch_size != x.shape[0]:
-            self.batch_size = x.shape[0]
-
         # Feed-forward affine transformations (all steps in parallel)
         Wx = self.W(x)
 
@@ -1214,7 +1254,7 @@ class RSEadLIFLayer(nn.Module):
         # Initialize normalization
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -1235,10 +1275,6 @@ class RSEadLIFLayer(nn.Module):
             x_flip = x.flip(1)
             x = torch.cat([x, x_flip], dim=0)
 
-        # Change batch size if needed
-        if self.batch_size != x.shape[0]:
-            self.batch_size = x.shape[0]
-
         # Feed-forward affine transformations (all steps in parallel)
         Wx = self.W(x)
 
@@ -1371,7 +1407,7 @@ class adLIFclampLayer(nn.Module):
         # Initialize normalization
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -1392,15 +1428,6 @@ class adLIFclampLayer(nn.Module):
             x_flip = x.flip(1)
             x = torch.cat([x, x_flip], dim=0)
 
-        # Change batch size if needed
-        if self.batch_size != x.shape[0]:
-            self.batch_size = x.shape[0]
-
-        self.alpha.data.clamp_(self.alpha_lim[0], self.alpha_lim[1])
-        self.beta.data.clamp_(self.beta_lim[0], self.beta_lim[1])
-        self.a.data.clamp_(self.a_lim[0], self.a_lim[1])
-        self.b.data.clamp_(self.b_lim[0], self.b_lim[1])
-
         # Feed-forward affine transformations (all steps in parallel)
         Wx = self.W(x)
 
@@ -1530,7 +1557,7 @@ class adLIFnoClampLayer(nn.Module):
         # Initialize normalization
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -1551,10 +1578,6 @@ class adLIFnoClampLayer(nn.Module):
             x_flip = x.flip(1)
             x = torch.cat([x, x_flip], dim=0)
 
-        # Change batch size if needed
-        if self.batch_size != x.shape[0]:
-            self.batch_size = x.shape[0]
-
         # Feed-forward affine transformations (all steps in parallel)
         Wx = self.W(x)
 
@@ -1713,10 +1736,15 @@ class LIFcomplexLayer(nn.Module):
         else:
             self.rst_detach = False
 
+        # Reference time loop or fixed-point parallel solver
+        self.spike_solver = extra_features.get("spike_solver", "loop")
+        if self.spike_solver not in ["loop", "fixed_point"]:
+            raise ValueError(f"Invalid spike solver {self.spike_solver}")
+
         # Initialize normalinzation
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -1734,10 +1762,6 @@ class LIFcomplexLayer(nn.Module):
             x_flip = x.flip(1)
             x = torch.cat([x, x_flip], dim=0)
 
-        # Change batch size if needed
-        if self.batch_size != x.shape[0]:
-            self.batch_size = x.shape[0]
-
         # Feed-forward affine transformations (all steps in parallel)
         Wx = self.W(x)
 
@@ -1774,6 +1798,7 @@ class LIFcomplexLayer(nn.Module):
             setattr(getattr(self, name), "_optim", optim)
 
 
+    @fp32
     def _lif_cell(self, Wx):
 
         # Initializations
@@ -1796,37 +1821,27 @@ class LIFcomplexLayer(nn.Module):
 
             # Recombine the clamped real and imaginary parts
             alpha = clamped_real + 1j * clamped_imag            
-        
-        if self.b!=None:
-            # Loop over time axis
-            for t in range(Wx.shape[1]):
-
-                if self.rst_detach:
-                    reset = st.clone().detach()
-                else: 
-                    reset = st
 
-                # Compute membrane potential (LIF)
-                ut = alpha * (ut - self.reset_factor*reset) + self.b * Wx[:, t, :]
-
-                # Compute spikes with surrogate gradient
-                st = self.spike_fct(2*ut.real - self.threshold)
-                s.append(st)
-        else:
-            # Loop over time axis
-            for t in range(Wx.shape[1]):
+        if self.spike_solver == "fixed_point":
+            return LIFcomplexFixedPoint.apply(
+                Wx, alpha, self.b, ut, st, self.threshold, self.spike_fct,
+                self.rst_detach, self.reset_factor,
+            )
+        
+        # Loop over time axis
+        for t in range(Wx.shape[1]):
 
-                if self.rst_detach:
-                    reset = st.clone().detach()
-                else: 
-                    reset = st
+            if self.rst_detach:
+                reset = st.clone().detach()
+            else: 
+                reset = st
 
-                # Compute membrane potential (LIF)
-                ut = alpha * (ut - self.reset_factor*reset) + (1-alpha.real) * Wx[:, t, :]
+            # Compute membrane potential (LIF)
+            ut = alpha * (ut - self.reset_factor*reset) + self.b * Wx[:, t, :]
 
-                # Compute spikes with surrogate gradient
-                st = self.spike_fct(2*ut.real - self.threshold)
-                s.append(st)            
+            # Compute spikes with surrogate gradient
+            st = self.spike_fct(2*ut.real - self.threshold)
+            s.append(st)
 
         return torch.stack(s, dim=1)
 
@@ -1903,7 +1918,7 @@ class ResonateFireLayer(nn.Module):
         # Initialize normalinzation
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -1919,10 +1934,6 @@ class ResonateFireLayer(nn.Module):
             x_flip = x.flip(1)
             x = torch.cat([x, x_flip], dim=0)
 
-        # Change batch size if needed
-        if self.batch_size != x.shape[0]:
-            self.batch_size = x.shape[0]
-
         # Feed-forward affine transformations (all steps in parallel)
         Wx = self.W(x)
 
@@ -1947,6 +1958,7 @@ class ResonateFireLayer(nn.Module):
 
         return s
 
+    @fp32
     def _rf_cell(self, Wx):
 
         # Initializations
@@ -2053,7 +2065,7 @@ class BRFLayer(nn.Module):
         # Initialize normalinzation
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -2069,10 +2081,6 @@ class BRFLayer(nn.Module):
             x_flip = x.flip(1)
             x = torch.cat([x, x_flip], dim=0)
 
-        # Change batch size if needed
-        if self.batch_size != x.shape[0]:
-            self.batch_size = x.shape[0]
-
         # Feed-forward affine transformations (all steps in parallel)
         Wx = self.W(x)
 
@@ -2097,6 +2105,7 @@ class BRFLayer(nn.Module):
 
         return s
 
+    @fp32
     def _rf_cell(self, Wx):
 
         # Initializations
@@ -2221,7 +2230,7 @@ class LIFrealcomplexLayer(nn.Module):
         # Initialize normalinzation
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -2239,10 +2248,6 @@ class LIFrealcomplexLayer(nn.Module):
             x_flip = x.flip(1)
             x = torch.cat([x, x_flip], dim=0)
 
-        # Change batch size if needed
-        if self.batch_size != x.shape[0]:
-            self.batch_size = x.shape[0]
-
         # Feed-forward affine transformations (all steps in parallel)
         Wx = self.W(x)
 
@@ -2279,6 +2284,7 @@ class LIFrealcomplexLayer(nn.Module):
             setattr(getattr(self, name), "_optim", optim)
 
 
+    @fp32
     def _lif_cell(self, Wx):
 
         # Initializations
@@ -2405,7 +2411,7 @@ class ReLULIFcomplexLayer(nn.Module):
         # Initialize normalinzation
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -2423,10 +2429,6 @@ class ReLULIFcomplexLayer(nn.Module):
             x_flip = x.flip(1)
             x = torch.cat([x, x_flip], dim=0)
 
-        # Change batch size if needed
-        if self.batch_size != x.shape[0]:
-            self.batch_size = x.shape[0]
-
         # Feed-forward affine transformations (all steps in parallel)
         Wx = self.W(x)
 
@@ -2463,6 +2465,7 @@ class ReLULIFcomplexLayer(nn.Module):
             setattr(getattr(self, name), "_optim", optim)
 
 
+    @fp32
     def _lif_cell(self, Wx):
 
         # Initializations
@@ -2576,7 +2579,7 @@ class RLIFcomplexLayer(nn.Module):
         # Initialize normalinzation
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -2597,10 +2600,6 @@ class RLIFcomplexLayer(nn.Module):
             x_flip = x.flip(1)
             x = torch.cat([x, x_flip], dim=0)
 
-        # Change batch size if needed
-        if self.batch_size != x.shape[0]:
-            self.batch_size = x.shape[0]
-
         # Feed-forward affine transformations (all steps in parallel)
         Wx = self.W(x)
 
@@ -2637,6 +2636,7 @@ class RLIFcomplexLayer(nn.Module):
             setattr(getattr(self, name), "_optim", optim)
 
 
+    @fp32
     def _lif_cell(self, Wx):
 
         # Initializations
@@ -2743,7 +2743,7 @@ class RLIFcomplex1MinAlphaLayer(nn.Module):
         # Initialize normalinzation
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -2759,10 +2759,6 @@ class RLIFcomplex1MinAlphaLayer(nn.Module):
             x_flip = x.flip(1)
             x = torch.cat([x, x_flip], dim=0)
 
-        # Change batch size if needed
-        if self.batch_size != x.shape[0]:
-            self.batch_size = x.shape[0]
-
         # Feed-forward affine transformations (all steps in parallel)
         Wx = self.W(x)
 
@@ -2799,6 +2795,7 @@ class RLIFcomplex1MinAlphaLayer(nn.Module):
             setattr(getattr(self, name), "_optim", optim)
 
 
+    @fp32
     def _lif_cell(self, Wx):
 
         # Initializations
@@ -2900,7 +2897,7 @@ class RLIFcomplex1MinAlphaNoBLayer(nn.Module):
         # Initialize normalinzation
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -2916,10 +2913,6 @@ class RLIFcomplex1MinAlphaNoBLayer(nn.Module):
             x_flip = x.flip(1)
             x = torch.cat([x, x_flip], dim=0)
 
-        # Change batch size if needed
-        if self.batch_size != x.shape[0]:
-            self.batch_size = x.shape[0]
-
         # Feed-forward affine transformations (all steps in parallel)
         Wx = self.W(x)
 
@@ -2956,6 +2949,7 @@ class RLIFcomplex1MinAlphaNoBLayer(nn.Module):
             setattr(getattr(self, name), "_optim", optim)
 
 
+    @fp32
     def _lif_cell(self, Wx):
 
         # Initializations
@@ -3063,7 +3057,7 @@ class LIFcomplexDiscrLayer(nn.Module):
         # Initialize normalinzation
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -3084,10 +3078,6 @@ class LIFcomplexDiscrLayer(nn.Module):
             x_flip = x.flip(1)
             x = torch.cat([x, x_flip], dim=0)
 
-        # Change batch size if needed
-        if self.batch_size != x.shape[0]:
-            self.batch_size = x.shape[0]
-
         # Feed-forward affine transformations (all steps in parallel)
         Wx = self.W(x)
 
@@ -3127,6 +3117,7 @@ class LIFcomplexDiscrLayer(nn.Module):
             setattr(getattr(self, name), "_optim", optim)
 
 
+    @fp32
     def _lif_cell(self, Wx):
 
         # Initializations
@@ -3248,7 +3239,7 @@ class LIFcomplex_gatedBLayer(nn.Module):
         # Initialize normalinzation
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -3257,7 +3248,7 @@ class LIFcomplex_gatedBLayer(nn.Module):
         # Initialize dropout
         self.drop = nn.Dropout(p=dropout)
         self.sigm = nn.Sigmoid()
-        self.normB = nn.BatchNorm1d(1, momentum=0.05)
+        self.normB = BatchNorm1d(1, momentum=0.05)
 
     def forward(self, x):
 
@@ -3266,10 +3257,6 @@ class LIFcomplex_gatedBLayer(nn.Module):
             x_flip = x.flip(1)
             x = torch.cat([x, x_flip], dim=0)
 
-        # Change batch size if needed
-        if self.batch_size != x.shape[0]:
-            self.batch_size = x.shape[0]
-
         # Feed-forward affine transformations (all steps in parallel)
         Wx = self.W(x)
 
@@ -3306,6 +3293,7 @@ class LIFcomplex_gatedBLayer(nn.Module):
             setattr(getattr(self, name), "_optim", optim)
 
 
+    @fp32
     def _lif_cell(self, Wx):
 
         # Initializations
@@ -3457,7 +3445,7 @@ class LIFcomplex_gatedDtLayer(nn.Module):
         # Initialize normalinzation
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -3473,10 +3461,6 @@ class LIFcomplex_gatedDtLayer(nn.Module):
             x_flip = x.flip(1)
             x = torch.cat([x, x_flip], dim=0)
 
-        # Change batch size if needed
-        if self.batch_size != x.shape[0]:
-            self.batch_size = x.shape[0]
-
         # Feed-forward affine transformations (all steps in parallel)
         Wx = self.W(x)
 
@@ -3513,6 +3497,7 @@ class LIFcomplex_gatedDtLayer(nn.Module):
             setattr(getattr(self, name), "_optim", optim)
 
 
+    @fp32
     def _lif_cell(self, Wx):
 
         # Initializations
@@ -3620,7 +3605,7 @@ class RLIFLayer(nn.Module):
         # Initialize normalization
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -3641,10 +3626,6 @@ class RLIFLayer(nn.Module):
             x_flip = x.flip(1)
             x = torch.cat([x, x_flip], dim=0)
 
-        # Change batch size if needed
-        if self.batch_size != x.shape[0]:
-            self.batch_size = x.shape[0]
-
         # Feed-forward affine transformations (all steps in parallel)
         Wx = self.W(x)
 
@@ -3667,6 +3648,7 @@ class RLIFLayer(nn.Module):
 
         return s
 
+    @fp32
     def _rlif_cell(self, Wx):
 
         # Initializations
@@ -3773,7 +3755,7 @@ class RadLIFLayer(nn.Module):
         # Initialize normalization
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -3794,10 +3776,6 @@ class RadLIFLayer(nn.Module):
             x_flip = x.flip(1)
             x = torch.cat([x, x_flip], dim=0)
 
-        # Change batch size if needed
-        if self.batch_size != x.shape[0]:
-            self.batch_size = x.shape[0]
-
         # Feed-forward affine transformations (all steps in parallel)
         Wx = self.W(x)
 
@@ -3820,6 +3798,7 @@ class RadLIFLayer(nn.Module):
 
         return s
 
+    @fp32
     def _radlif_cell(self, Wx):
 
         # Initializations
@@ -3914,7 +3893,7 @@ class ReadoutLayer(nn.Module):
         # Initialize normalization
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -3940,6 +3919,7 @@ class ReadoutLayer(nn.Module):
 
         return out
 
+    @fp32
     def _readout_cell(self, Wx):
 
         # Initializations
@@ -4011,7 +3991,7 @@ class SEReadoutLayer(nn.Module):
         # Initialize normalization
         self.normalize = False
         if normalization == "batchnorm":
-            self.norm = nn.BatchNorm1d(self.hidden_size, momentum=0.05)
+            self.norm = BatchNorm1d(self.hidden_size, momentum=0.05)
             self.normalize = True
         elif normalization == "layernorm":
             self.norm = nn.LayerNorm(self.hidden_size)
@@ -4037,6 +4017,7 @@ class SEReadoutLayer(nn.Module):
 
         return out
 
+    @fp32
     def _readout_cell(self, Wx):
 
         # Initializations
@@ -4247,7 +4228,6 @@ class S4Model(nn.Module):
     ):
         super().__init__()
 
-        self.device = torch.device("cuda")
         self.pure_complex = extra_features["pure_complex"]
         self.extra_features = extra_features
         self.normalization = normalization
@@ -4275,7 +4255,7 @@ class S4Model(nn.Module):
                 S4D_orig(d_model, d_state = d_state, dropout=dropout, transposed=True, lr = lr, pure_complex = self.pure_complex, dt_max = dt_max, dt_min = dt_min, activation = activation, premix = self.premix, mix = self.mix, residual1 = self.residual1)
             )
             if normalization == "batchnorm":
-                self.norms.append(nn.BatchNorm1d(d_model, momentum=0.05))
+                self.norms.append(BatchNorm1d(d_model, momentum=0.05))
             elif normalization == "layernorm":
                 self.norms.append(nn.LayerNorm(d_model))
 
@@ -4307,15 +4287,12 @@ class S4Model(nn.Module):
                 nn.Linear(d_model, d_model)
             )
 
-        self.to(self.device)
-        
 
 
     def forward(self, x):
         """
         Input x is shape (B, L, d_input)
         """
-        x = x.to(self.device)
         x = self.encoder(x)  # (B, L, d_input) -> (B, L, d_model)
 
         x = x.transpose(-1, -2)  # (B, L, d_model) -> (B, d_model, L)
@@ -4367,9 +4344,9 @@ class S4Model(nn.Module):
             x = x.mean(dim=1)
 
         # Decode the outputs
-        self.x = self.decoder(x)  # (B, d_model) -> (B, d_output)
+        x = self.decoder(x)  # (B, d_model) -> (B, d_output)
 
-        return self.x, 0
+        return x, 0
 
 
 class S4DKernel(nn.Module):
@@ -4377,23 +4354,22 @@ class S4DKernel(nn.Module):
 
     def __init__(self, d_model, N=64, dt_min=0.001, dt_max=0.1, lr=None, pure_complex = None):
         super().__init__()
-        self.device = torch.device("cuda")
         # Generate dt
         H = d_model
-        log_dt = torch.rand(H).to(self.device) * (
+        log_dt = torch.rand(H) * (
             math.log(dt_max) - math.log(dt_min)
         ) + math.log(dt_min)
 
-        C = torch.randn(H, N // 2, dtype=torch.cfloat).to(self.device)
+        C = torch.randn(H, N // 2, dtype=torch.cfloat)
 
         self.C = nn.Parameter(torch.view_as_real(C))
         self.register("log_dt", log_dt, lr)
 
-        log_A_real = torch.log(0.5 * torch.ones(H, N//2)).to(self.device)
+        log_A_real = torch.log(0.5 * torch.ones(H, N//2))
         if pure_complex:
-            A_imag = math.pi * repeat(torch.arange(1,N//2+1), 'n -> h n', h=H).to(self.device)
+            A_imag = math.pi * repeat(torch.arange(1,N//2+1), 'n -> h n', h=H)
         else:
-            A_imag = math.pi * repeat(torch.arange(N//2), 'n -> h n', h=H).to(self.device)
+            A_imag = math.pi * repeat(torch.arange(N//2), 'n -> h n', h=H)
         self.register("log_A_real", log_A_real, lr)
         self.register("A_imag", A_imag, lr)
 
@@ -4409,7 +4385,7 @@ class S4DKernel(nn.Module):
 
         # Vandermonde multiplication
         dtA = A * dt.unsqueeze(-1)  # (H N)
-        K = dtA.unsqueeze(-1) * torch.arange(L, device=self.device) # (H N L)
+        K = dtA.unsqueeze(-1) * torch.arange(L, device=dt.device) # (H N L)
         C = C * (torch.exp(dtA)-1.) / A
         K = 2 * torch.einsum('hn, hnl -> hl', C, torch.exp(K)).real
 
@@ -4467,21 +4443,13 @@ class S4D_orig(nn.Module):
         self.mix = mix
         self.residual1 = residual1
 
-        self.device = torch.device("cuda")
-
     def forward(self, u, **kwargs): # absorbs return_output and transformer src mask
         """ Input and output shape (B, H, L) """
         if not self.transposed: u = u.transpose(-1, -2)
         L = u.size(-1)
 
-        # Compute SSM Kernel
-        k = self.kernel(L=L) # (H L)
-        
-
-        # Convolution
-        k_f = torch.fft.rfft(k, n=2*L) # (H L)
-        u_f = torch.fft.rfft(u, n=2*L) # (B H L)
-        y = torch.fft.irfft(u_f*k_f, n=2*L)[..., :L] # (B H L)
+        # Compute SSM Kernel and convolution
+        y = self._ssm_conv(u) # (B H L)
 
         # Compute D term in state space equation - essentially a skip connection
         
@@ -4499,3 +4467,16 @@ class S4D_orig(nn.Module):
                 y = self.output_linear(y.transpose(1, 2)).transpose(1, 2)
         if not self.transposed: y = y.transpose(-1, -2)
         return y, None # Return a dummy state to satisfy this repo's interface, but this can be modified
+
+    @fp32
+    def _ssm_conv(self, u):
+        """ FFT convolution of the input (B H L) with the SSM kernel, in fp32 """
+        L = u.size(-1)
+
+        # Compute SSM Kernel
+        k = self.kernel(L=L) # (H L)
+
+        # Convolution
+        k_f = torch.fft.rfft(k, n=2*L) # (H L)
+        u_f = torch.fft.rfft(u, n=2*L) # (B H L)
+        return torch.fft.irfft(u_f*k_f, n=2*L)[..., :L] # (B H L)
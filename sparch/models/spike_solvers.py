@@ -0,0 +1,305 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is where the fixed-point parallel spike solver is defined for the
+resetting neuron models (LIF, adLIF and LIFcomplex).
+
+Between two spikes the dynamics of these neurons are linear, so that the
+membrane trace can be computed with a parallel scan over the time axis. The
+solver alternates between computing the trace under the assumption that no
+further reset happens, and committing the earliest new threshold crossing of
+every neuron. It stops when no new crossing is found, so that the number of
+sequential iterations is the largest number of spikes emitted by a single
+neuron (plus one) instead of the number of time steps.
+
+The backward passes reproduce the surrogate gradients of the reference time
+loops of the layers, including the gradient flowing through the reset.
+"""
+import torch
+
+
+def linear_scan(decay, drive):
+    """
+    Computes the linear recurrence h[t] = decay[t] * h[t-1] + drive[t] along
+    the time axis (dim 1) with h[-1] = 0, using a Hillis-Steele parallel scan
+    with log2(time) sequential steps.
+
+    Arguments
+    ---------
+    decay : tensor
+        Either a per-neuron constant with shape (feats) or time-varying
+        coefficients with the same shape as drive. Can be complex.
+    drive : tensor
+        Input of the recurrence with shape (batch, time, feats).
+    """
+    h = drive
+    a = decay
+    constant = decay.dim() == 1
+    d = 1
+    while d < drive.shape[1]:
+        if constant:
+            h = torch.cat([h[:, :d], h[:, d:] + a * h[:, :-d]], dim=1)
+            a = a * a
+        else:
+            h = torch.cat([h[:, :d], h[:, d:] + a[:, d:] * h[:, :-d]], dim=1)
+            a = torch.cat([a[:, :d], a[:, d:] * a[:, :-d]], dim=1)
+        d *= 2
+    return h
+
+
+def matrix_scan(decay, drive):
+    """
+    Same as linear_scan for a two-dimensional state per neuron, i.e. it
+    computes h[t] = decay[t] @ h[t-1] + drive[t] along the time axis.
+
+    Arguments
+    ---------
+    decay : tensor
+        Either per-neuron constant matrices with shape (feats, 2, 2) or
+        time-varying matrices with shape (batch, time, feats, 2, 2).
+    drive : tensor
+        Input of the recurrence with shape (batch, time, feats, 2).
+    """
+    h = drive
+    a = decay
+    constant = decay.dim() == 3
+    d = 1
+    while d < drive.shape[1]:
+        if constant:
+            h = torch.cat([h[:, :d], h[:, d:] + _matvec(a, h[:, :-d])], dim=1)
+            a = a @ a
+        else:
+            h = torch.cat(
+                [h[:, :d], h[:, d:] + _matvec(a[:, d:], h[:, :-d])], dim=1
+            )
+            a = torch.cat([a[:, :d], a[:, d:] @ a[:, :-d]], dim=1)
+        d *= 2
+    return h
+
+
+def _matvec(a, h):
+    return (a @ h.unsqueeze(-1)).squeeze(-1)
+
+
+def _shift(s, s0):
+    """Returns the spike trains delayed by one step, starting with s0."""
+    return torch.cat([s0.unsqueeze(1), s[:, :-1]], dim=1)
+
+
+def _surrogate_grad(spike_fct, v):
+    """Elementwise derivative of the surrogate spike function at v."""
+    with torch.enable_grad():
+        v = v.detach().requires_grad_(True)
+        s = spike_fct(v)
+        (grad,) = torch.autograd.grad(s, v, torch.ones_like(s))
+    return grad
+
+
+def _fixed_point(trace, Wx):
+    """
+    Finds the exact spike trains of a layer of resetting neurons.
+
+    The trace function maps spike trains to the membrane trace and to the
+    shifted potential whose positive values trigger spikes, both computed
+    under the assumption that no other spikes are emitted.
+    """
+    shape, device = Wx.shape, Wx.device
+    s = torch.zeros_like(Wx)
+    start = torch.zeros(shape[0], 1, shape[2], dtype=torch.long, device=device)
+    steps = torch.arange(shape[1], device=device).view(1, -1, 1)
+
+    while True:
+        h, v = trace(s)
+
+        # Earliest threshold crossing after the committed part of each train
+        crossing = (v > 0) & (steps >= start)
+        found = crossing.any(dim=1, keepdim=True)
+        if not found.any():
+            return s, h
+        first = crossing.float().argmax(dim=1, keepdim=True)
+
+        # Commit the new spike, the trace before it is now exact
+        s = s + ((steps == first) & found).to(s.dtype)
+        start = torch.where(found, first + 1, torch.full_like(first, shape[1]))
+
+
+class LIFFixedPoint(torch.autograd.Function):
+    """
+    Fixed-point solver for LIFLayer, u[t] = alpha*(u[t-1] - s[t-1])
+    + (1-alpha)*Wx[t] and s[t] = spike_fct(u[t] - threshold).
+    """
+
+    @staticmethod
+    def forward(ctx, Wx, alpha, u0, s0, threshold, spike_fct, rst_detach):
+
+        def trace(s):
+            drive = (1 - alpha) * Wx - alpha * _shift(s, s0)
+            drive = torch.cat([drive[:, :1] + alpha * u0.unsqueeze(1), drive[:, 1:]], 1)
+            u = linear_scan(alpha, drive)
+            return u, u - threshold
+
+        s, u = _fixed_point(trace, Wx)
+
+        ctx.save_for_backward(Wx, alpha, u0, s0, u, s)
+        ctx.threshold = threshold
+        ctx.spike_fct = spike_fct
+        ctx.rst_detach = rst_detach
+        return s
+
+    @staticmethod
+    def backward(ctx, grad_s):
+        Wx, alpha, u0, s0, u, s = ctx.saved_tensors
+        sg = _surrogate_grad(ctx.spike_fct, u - ctx.threshold)
+        d = 0.0 if ctx.rst_detach else 1.0
+
+        # Adjoint recursion gu[t] = sg[t]*G[t] + alpha*(1 - d*sg[t])*gu[t+1]
+        decay = alpha * (1 - d * sg)
+        gu = linear_scan(decay.flip(1), (sg * grad_s).flip(1)).flip(1)
+
+        u_prev = _shift(u, u0)
+        s_prev = _shift(s, s0)
+        grad_Wx = (1 - alpha) * gu
+        grad_alpha = (gu * (u_prev - s_prev - Wx)).sum(dim=(0, 1))
+
+        return grad_Wx, grad_alpha, None, None, None, None, None
+
+
+class adLIFFixedPoint(torch.autograd.Function):
+    """
+    Fixed-point solver for adLIFLayer, w[t] = beta*w[t-1] + a*u[t-1]
+    + b*r*s[t-1], u[t] = alpha*(u[t-1] - r*s[t-1]) + (1-alpha)*(Wx[t] - w[t])
+    and s[t] = spike_fct(u[t] - threshold), where r is the reset factor.
+    """
+
+    @staticmethod
+    def forward(
+        ctx, Wx, alpha, beta, a, b, u0, w0, s0, threshold, spike_fct,
+        rst_detach, reset_factor,
+    ):
+        # Transition matrix of the (u, w) state between two spikes
+        M = torch.stack(
+            [
+                torch.stack([alpha - (1 - alpha) * a, -(1 - alpha) * beta], -1),
+                torch.stack([a, beta], -1),
+            ],
+            dim=-2,
+        )
+        h0 = _matvec(M, torch.stack([u0, w0], -1))
+
+        def trace(s):
+            r = reset_factor * _shift(s, s0)
+            drive = torch.stack(
+                [(1 - alpha) * Wx - (alpha + (1 - alpha) * b) * r, b * r], -1
+            )
+            drive = torch.cat([drive[:, :1] + h0.unsqueeze(1), drive[:, 1:]], 1)
+            h = matrix_scan(M, drive)
+            return h, h[..., 0] - threshold
+
+        s, h = _fixed_point(trace, Wx)
+
+        ctx.save_for_backward(Wx, alpha, beta, a, b, u0, w0, s0, h, s)
+        ctx.threshold = threshold
+        ctx.spike_fct = spike_fct
+        ctx.rst_detach = rst_detach
+        ctx.reset_factor = reset_factor
+        return s
+
+    @staticmethod
+    def backward(ctx, grad_s):
+        Wx, alpha, beta, a, b, u0, w0, s0, h, s = ctx.saved_tensors
+        u, w = h[..., 0], h[..., 1]
+        sg = _surrogate_grad(ctx.spike_fct, u - ctx.threshold)
+        r = ctx.reset_factor
+        d = 0.0 if ctx.rst_detach else 1.0
+
+        # Adjoint recursion (gu, gw)[t] = e[t] + C[t] @ (gu, gw)[t+1]
+        p = alpha * (1 - d * r * sg)
+        q = a + d * r * b * sg
+        C = torch.stack(
+            [
+                torch.stack([p, q], -1),
+                torch.stack([-(1 - alpha) * p, beta - (1 - alpha) * q], -1),
+            ],
+            dim=-2,
+        )
+        e = torch.stack([sg * grad_s, -(1 - alpha) * sg * grad_s], -1)
+        g = matrix_scan(C.flip(1), e.flip(1)).flip(1)
+        gu, gw = g[..., 0], g[..., 1]
+
+        u_prev = _shift(u, u0)
+        w_prev = _shift(w, w0)
+        r_prev = r * _shift(s, s0)
+        grad_Wx = (1 - alpha) * gu
+        grad_alpha = (gu * (u_prev - r_prev - Wx + w)).sum(dim=(0, 1))
+        grad_beta = (gw * w_prev).sum(dim=(0, 1))
+        grad_a = (gw * u_prev).sum(dim=(0, 1))
+        grad_b = (gw * r_prev).sum(dim=(0, 1))
+
+        return (
+            grad_Wx, grad_alpha, grad_beta, grad_a, grad_b,
+            None, None, None, None, None, None, None,
+        )
+
+
+class LIFcomplexFixedPoint(torch.autograd.Function):
+    """
+    Fixed-point solver for LIFcomplexLayer, u[t] = alpha*(u[t-1] - r*s[t-1])
+    + b*Wx[t] with complex alpha and s[t] = spike_fct(2*Re(u[t]) - threshold),
+    where r is the reset factor.
+    """
+
+    @staticmethod
+    def forward(
+        ctx, Wx, alpha, b, u0, s0, threshold, spike_fct, rst_detach, reset_factor
+    ):
+
+        def trace(s):
+            drive = b * Wx - alpha * reset_factor * _shift(s, s0)
+            drive = torch.cat([drive[:, :1] + alpha * u0.unsqueeze(1), drive[:, 1:]], 1)
+            u = linear_scan(alpha, drive)
+            return u, 2 * u.real - threshold
+
+        s, u = _fixed_point(trace, Wx)
+
+        ctx.save_for_backward(Wx, alpha, b, u0, s0, u, s)
+        ctx.threshold = threshold
+        ctx.spike_fct = spike_fct
+        ctx.rst_detach = rst_detach
+        ctx.reset_factor = reset_factor
+        return s
+
+    @staticmethod
+    def backward(ctx, grad_s):
+        Wx, alpha, b, u0, s0, u, s = ctx.saved_tensors
+        sg = _surrogate_grad(ctx.spike_fct, 2 * u.real - ctx.threshold)
+        r = ctx.reset_factor
+        d = 0.0 if ctx.rst_detach else 1.0
+
+        # Adjoint recursion on (Re, Im) of gu, following the conjugate
+        # Wirtinger convention of autograd, gu[t] = 2*sg[t]*G[t] + z
+        # - 2*sg[t]*d*r*Re(z) with z = conj(alpha)*gu[t+1]
+        k = 1 - 2 * d * r * sg
+        ar = alpha.real.expand_as(k)
+        ai = alpha.imag.expand_as(k)
+        C = torch.stack(
+            [torch.stack([k * ar, k * ai], -1), torch.stack([-ai, ar], -1)],
+            dim=-2,
+        )
+        e = torch.stack([2 * sg * grad_s, torch.zeros_like(grad_s)], -1)
+        g = matrix_scan(C.flip(1), e.flip(1)).flip(1)
+        gu = torch.complex(g[..., 0], g[..., 1])
+
+        u_prev = _shift(u, u0)
+        r_prev = r * _shift(s, s0)
+        grad_Wx = b * gu.real
+        grad_alpha = (torch.conj(u_prev - r_prev) * gu).sum(dim=(0, 1))
+        grad_b = (Wx * gu.real).sum(dim=(0, 1))
+
+        return grad_Wx, grad_alpha, grad_b, None, None, None, None, None, None
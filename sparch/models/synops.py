@@ -0,0 +1,236 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is where the counting of synaptic operations (SynOps) and the energy
+estimates of SNNs, ANNs and S4Models are defined.
+
+Four types of operations are counted per layer with forward hooks:
+    dense_macs : multiply-accumulates of a dense implementation of the
+        feedforward and recurrent connections.
+    spike_acs : accumulates triggered by the non-zero inputs of spiking
+        layers, i.e. input spikes times fan-out.
+    recurrent_synops : accumulates triggered by the spikes sent through
+        the recurrent connections of spiking layers.
+    state_updates : updates of neuron (or SSM) state variables, where
+        complex states count as two variables.
+
+The energy estimate uses 4.6 pJ per MAC and 0.9 pJ per accumulate (32-bit
+floating point, 45nm CMOS), with event-driven spiking layers paying for
+accumulates and state updates only.
+"""
+import torch.nn as nn
+
+OPS = ["dense_macs", "spike_acs", "recurrent_synops", "state_updates"]
+E_MAC = 4.6e-12
+E_AC = 0.9e-12
+
+# Layers with two state variables per neuron (adaptation or complex)
+_TWO_STATES = ["adLIF", "RadLIF", "CadLIF", "RSEadLIF", "adLIFclamp", "adLIFnoClamp"]
+
+
+class SynOpCounter:
+    """
+    Counts the operations of every layer of a model during its forward
+    passes. Counts of the last batch and running totals are kept as device
+    tensors and only read by summary(), so that counting does not add host
+    syncs to the training loop.
+
+    Arguments
+    ---------
+    net : nn.Module
+        SNN, ANN or S4Model, possibly wrapped by torch.compile.
+    root : nn.Module
+        Module called once per batch, e.g. a wrapper that runs the layers of
+        net without calling its forward. By default, net itself.
+    """
+
+    def __init__(self, net, root=None):
+        self.net = getattr(net, "_orig_mod", net)
+        root = self.net if root is None else root
+        self.handles = [root.register_forward_pre_hook(self._new_batch)]
+        self.spikes = {}
+        for name, layer, count in self._layers():
+            self.handles.append(layer.register_forward_hook(self._hook(name, count)))
+
+            # Spikes sent through V are the outputs of the layer before dropout
+            drop = getattr(layer, "drop", None)
+            if count is _count_snn_layer and _recurrent_fanout(layer) and drop:
+                self.handles.append(drop.register_forward_hook(self._spike_hook(name)))
+        self.reset()
+
+    def _layers(self):
+        net = self.net
+        name = type(net).__name__
+        if name == "SNN":
+            for i, layer in enumerate(net.snn):
+                yield f"layer{i}", layer, _count_snn_layer
+        elif name == "ANN":
+            for i, layer in enumerate(net.ann):
+                yield f"layer{i}", layer, _count_ann_layer
+        elif name == "S4Model":
+            yield "encoder", net.encoder, _count_linear
+            for i, layer in enumerate(net.s4_layers):
+                yield f"layer{i}", layer, _count_s4_layer
+            if not net.premix:
+                yield "mix", net.output_linear, _count_linear
+            if isinstance(net.decoder, nn.Linear):
+                yield "decoder", net.decoder, _count_linear
+            else:
+                yield "decoder", net.decoder, _count_snn_layer
+        else:
+            raise NotImplementedError(f"SynOp counting of {name} is not supported")
+
+    def _new_batch(self, module, inputs):
+        self.batch = {}
+        self.samples += inputs[0].shape[0]
+        self.batches += 1
+
+    def _spike_hook(self, name):
+        def hook(module, inputs, output):
+            self.spikes[name] = (inputs[0] != 0).sum()
+
+        return hook
+
+    def _hook(self, name, count):
+        def hook(module, inputs, output):
+            if name in self.spikes:
+                ops = count(module, inputs[0], output, self.spikes.pop(name))
+            else:
+                ops = count(module, inputs[0], output)
+            for op, value in ops.items():
+                key = f"{name}/{op}"
+                self.batch[key] = self.batch.get(key, 0) + value
+                self.total[key] = self.total.get(key, 0) + value
+
+        return hook
+
+    def reset(self):
+        """Resets the running totals, e.g. at the beginning of an epoch."""
+        self.batch = {}
+        self.total = {}
+        self.samples = 0
+        self.batches = 0
+
+    def summary(self, per_sample=True):
+        """
+        Returns the running totals per layer and summed over layers, with the
+        estimated energy in joules, averaged per sample if per_sample.
+        """
+        norm = max(self.samples, 1) if per_sample else 1
+        out = {key: float(value) / norm for key, value in self.total.items()}
+        for op in OPS + ["energy"]:
+            out[op] = sum(v for k, v in out.items() if k.endswith("/" + op))
+        return out
+
+    def remove(self):
+        """Removes the hooks from the model."""
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+
+def _energy(ops, event_driven):
+    if event_driven:
+        return E_AC * (ops["spike_acs"] + ops["recurrent_synops"]) + E_MAC * ops[
+            "state_updates"
+        ]
+    return E_MAC * (ops["dense_macs"] + ops["state_updates"])
+
+
+def _recurrent_fanout(layer):
+    V = getattr(layer, "V", None)
+    if isinstance(V, nn.Linear):
+        return V.weight.shape[0]
+    if isinstance(V, nn.Parameter):
+        return V.shape[-1]
+    return 0
+
+
+def _count_snn_layer(layer, x, out, spikes=None):
+    """
+    Spiking layers and the non-spiking readout layer. The recurrent synops
+    are counted from the number of output spikes before dropout if given,
+    and from the outputs otherwise.
+    """
+    if spikes is None:
+        spikes = (out != 0).sum()
+    directions = 1 + bool(getattr(layer, "bidirectional", False))
+    B, T, I = x.shape
+    H = layer.W.weight.shape[0]
+    fanout = _recurrent_fanout(layer)
+    name = type(layer).__name__
+    n_states = 2 if (name[:-5] in _TWO_STATES or "complex" in name) else 1
+
+    ops = {
+        "dense_macs": directions * B * T * (I + fanout) * H,
+        "spike_acs": directions * (x != 0).sum() * H,
+        "recurrent_synops": spikes * fanout if fanout else 0,
+        "state_updates": directions * n_states * B * T * H,
+    }
+    ops["energy"] = _energy(ops, event_driven=True)
+    return ops
+
+
+def _count_ann_layer(layer, x, out):
+    """MLP, RNN, LiGRU, GRU and readout layers."""
+    directions = 1 + bool(getattr(layer, "bidirectional", False))
+    B, T, I = x.shape
+    H = layer.W.weight.shape[0]
+    gates = sum(hasattr(layer, w) for w in ["W", "Wz", "Wr"])
+    recurrent = sum(hasattr(layer, v) for v in ["V", "Vz", "Vr"])
+
+    # The readout layer applies its weights once to the sum over time
+    steps = 1 if type(layer).__name__ == "ReadoutLayerANN" else T
+    ops = {
+        "dense_macs": directions * B * steps * H * (gates * I + recurrent * H),
+        "spike_acs": 0,
+        "recurrent_synops": 0,
+        "state_updates": directions * B * T * (H if recurrent else 0),
+    }
+    ops["energy"] = _energy(ops, event_driven=False)
+    return ops
+
+
+def _count_linear(layer, x, out):
+    """nn.Linear, or nn.Sequential with a Conv1d of kernel size 1 (GLU mix)."""
+    if isinstance(layer, nn.Sequential):
+        layer = layer[0]
+    in_features, out_features = layer.weight.shape[1], layer.weight.shape[0]
+    positions = x.numel() // in_features
+    ops = {
+        "dense_macs": positions * in_features * out_features,
+        "spike_acs": 0,
+        "recurrent_synops": 0,
+        "state_updates": 0,
+    }
+    ops["energy"] = _energy(ops, event_driven=False)
+    return ops
+
+
+def _count_s4_layer(layer, x, out):
+    """
+    S4D layer counted in its recurrent form. Each complex state counts as
+    two state variables, the output projection 2*Re(C*h) adds two MACs per
+    complex state and step, plus the skip connection and the mixing.
+    """
+    B, H, L = x.shape
+    N = layer.kernel.C.shape[1]
+    mix = 0
+    if not layer.premix:
+        W = layer.output_linear[0].weight
+        mix = W.shape[0] * W.shape[1]
+    ops = {
+        "dense_macs": B * L * (2 * H * N + H + mix),
+        "spike_acs": 0,
+        "recurrent_synops": 0,
+        "state_updates": 2 * B * L * H * N,
+    }
+    ops["energy"] = _energy(ops, event_driven=False)
+    return ops
@@ -0,0 +1,286 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is where the weight files of the models are defined.
+
+A model is saved as two files next to each other, a JSON spec with the
+class and constructor arguments of the model (neuron type, sizes,
+extra_features, ...) and the name, dtype, shape and offset of every tensor
+of its state dict, and a flat binary file with the raw tensor data,
+
+    best_model.json
+    best_model.bin
+
+Loading memory-maps the binary file, so that only the pages of the tensors
+that are used are read, and rebuilds the SNN, ANN, S4Model or Ensemble from
+the spec instead of unpickling a module, which ties the file to the source
+of the classes. The model is built on the meta device and the loaded
+tensors are assigned to it, so that its weights are not initialized
+first. Pickled .pth modules are still loaded by load_model.
+
+Usage: python -m sparch.models.weights path/to/best_model.pth [...]
+converts pickled modules to weight files.
+"""
+import argparse
+import inspect
+import itertools
+import json
+import logging
+import os
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+# Offsets of tensors are aligned for every dtype
+ALIGNMENT = 64
+
+
+def model_spec(net):
+    """Class and constructor arguments of a model."""
+    net = getattr(net, "_orig_mod", net)
+
+    # Classes are matched by name, so that only the models used are imported
+    name = type(net).__name__
+
+    if name == "Ensemble":
+        return {
+            "class": "Ensemble",
+            "size": net.size,
+            "tensorized": net.tensorized,
+            "member": model_spec(net.base),
+        }
+
+    if name in ["SNN", "ANN"]:
+        input_shape = [net.batch_size, None, int(net.input_size)]
+        if net.reshape:
+            input_shape.append(1)
+        kwargs = {
+            "input_shape": input_shape,
+            "layer_sizes": list(net.layer_sizes),
+            "dropout": net.dropout,
+            "normalization": net.normalization,
+            "use_bias": net.use_bias,
+            "bidirectional": net.bidirectional,
+            "use_readout_layer": net.use_readout_layer,
+        }
+        if name == "ANN":
+            return {"class": "ANN", "kwargs": {**kwargs, "ann_type": net.ann_type}}
+        kwargs.update(
+            {
+                "neuron_type": net.neuron_type,
+                "threshold": float(net.threshold),
+                "extra_features": net.extra_features,
+                "track_firing_rates": getattr(net, "track_firing_rates", True),
+            }
+        )
+        return {"class": "SNN", "kwargs": kwargs}
+
+    if name == "S4Model":
+        layer = net.s4_layers[0]
+        log_dt = layer.kernel.log_dt
+        if isinstance(log_dt, torch.nn.Parameter):
+            lr = getattr(log_dt, "_optim", {}).get("lr")
+        else:
+            lr = 0.0
+        decoder = net.decoder
+        return {
+            "class": "S4Model",
+            "kwargs": {
+                "d_input": net.encoder.in_features,
+                "d_output": getattr(decoder, "hidden_size", None)
+                or decoder.out_features,
+                "d_model": net.encoder.out_features,
+                "d_state": layer.n,
+                "n_layers": len(net.s4_layers),
+                "dropout": net.dropouts[0].p if len(net.dropouts) else 0.0,
+                "prenorm": net.prenorm,
+                "lr": lr,
+                "batch_size": getattr(decoder, "batch_size", 0),
+                "normalization": net.normalization,
+                "extra_features": net.extra_features,
+            },
+        }
+
+    raise ValueError(f"Cannot save weights of {name}")
+
+
+def build_model(spec):
+    """Builds a model with random weights from its spec."""
+    if spec["class"] == "Ensemble":
+        from .ensemble import Ensemble
+
+        members = [build_model(spec["member"]) for _ in range(spec["size"])]
+        return Ensemble(members, tensorize=spec["tensorized"])
+    if spec["class"] == "ANN":
+        from .anns import ANN
+
+        return ANN(**spec["kwargs"])
+    from . import snns
+
+    return getattr(snns, spec["class"])(**spec["kwargs"])
+
+
+def save_weights(net, path):
+    """
+    Saves a model to the weight files path.json and path.bin, each written
+    to a temporary file first and renamed once complete.
+    """
+    path = _stem(path)
+    net = getattr(net, "_orig_mod", net)
+    state = net.state_dict()
+
+    tensors = {}
+    offset = 0
+    with open(path + ".bin.tmp", "wb") as f:
+        for name, tensor in state.items():
+            data = tensor.detach().cpu().contiguous()
+            nbytes = data.numel() * data.element_size()
+            padding = -offset % ALIGNMENT
+            f.write(b"\0" * padding)
+            offset += padding
+            f.write(data.view(-1).view(torch.uint8).numpy().tobytes())
+            tensors[name] = {
+                "dtype": str(data.dtype).replace("torch.", ""),
+                "shape": list(data.shape),
+                "offset": offset,
+                "nbytes": nbytes,
+            }
+            offset += nbytes
+
+    spec = {
+        "format": "sparch",
+        "version": FORMAT_VERSION,
+        "model": model_spec(net),
+        "tensors": tensors,
+    }
+    with open(path + ".json.tmp", "w") as f:
+        json.dump(spec, f, indent=2)
+
+    # Binary file first, so that a complete spec always has its data
+    os.replace(path + ".bin.tmp", path + ".bin")
+    os.replace(path + ".json.tmp", path + ".json")
+
+
+def read_spec(path):
+    """Returns the spec of the weight files of path."""
+    with open(_stem(path) + ".json") as f:
+        return json.load(f)
+
+
+def load_tensors(path, names=None):
+    """
+    Returns the memory-mapped tensors of the weight files of path, all of
+    them or only the given names, without building the model.
+    """
+    path = _stem(path)
+    spec = read_spec(path)
+    if names is None:
+        names = list(spec["tensors"])
+
+    # Copy-on-write mapping, pages are only read when accessed
+    data = np.memmap(path + ".bin", dtype=np.uint8, mode="c")
+    tensors = {}
+    for name in names:
+        info = spec["tensors"][name]
+        dtype = getattr(torch, info["dtype"])
+        if info["nbytes"] == 0:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        chunk = data[info["offset"] : info["offset"] + info["nbytes"]]
+        tensors[name] = torch.frombuffer(chunk, dtype=dtype).view(info["shape"])
+    return tensors
+
+
+def load_weights(path, map_location="cpu", names=None):
+    """
+    Rebuilds a model from the weight files of path. With names, only these
+    tensors of the state dict are loaded, for scripts that only read some
+    parameters such as alpha or beta, and the other ones are left on the
+    meta device, or randomly initialized if the model cannot be built there.
+    """
+    spec = read_spec(path)
+    tensors = {k: v.to(map_location) for k, v in load_tensors(path, names).items()}
+    net = _build_on_meta(spec["model"], tensors, strict=names is None)
+    if net is not None:
+        return net
+
+    # Random initialization overwritten by the saved tensors
+    net = build_model(spec["model"]).to(map_location)
+    net.load_state_dict(tensors, strict=names is None)
+    return net
+
+
+def _build_on_meta(spec, tensors, strict):
+    """
+    Builds a model on the meta device and assigns it the loaded tensors,
+    which skips the random initialization of the weights. Returns None if
+    the installed torch or the model does not support it, e.g. when the
+    constructor computes values or non-persistent buffers from its tensors.
+    """
+    if "assign" not in inspect.signature(torch.nn.Module.load_state_dict).parameters:
+        return None
+    try:
+        with torch.device("meta"):
+            net = build_model(spec)
+    except (NotImplementedError, RuntimeError):
+        return None
+
+    # Attributes of the parameters, such as the learning rate in _optim
+    attributes = {n: dict(p.__dict__) for n, p in net.named_parameters()}
+    net.load_state_dict(tensors, strict=strict, assign=True)
+    for name, param in net.named_parameters():
+        param.__dict__.update(attributes.get(name, {}))
+
+    state = itertools.chain(net.parameters(), net.buffers())
+    if strict and any(t.is_meta for t in state):
+        return None
+    return net
+
+
+def has_weights(path):
+    """Whether the weight files of path exist."""
+    return os.path.exists(_stem(path) + ".json")
+
+
+def load_model(path, map_location="cpu", names=None):
+    """
+    Loads a model from weight files if they exist next to path, or from a
+    pickled module otherwise. The names of the tensors to load only apply
+    to weight files, see load_weights.
+    """
+    if has_weights(path):
+        return load_weights(path, map_location, names)
+    net = torch.load(path, map_location=map_location, weights_only=False)
+    return getattr(net, "_orig_mod", net)
+
+
+def _stem(path):
+    root, ext = os.path.splitext(path)
+    return root if ext in [".json", ".bin", ".pth", ".pt"] else path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert pickled models.")
+    parser.add_argument("model_path", nargs="+", help="Paths of pickled models.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    for path in args.model_path:
+        net = torch.load(path, map_location="cpu", weights_only=False)
+        save_weights(net, path)
+        logger.info(f"Converted {path} to {_stem(path)}.json/.bin")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,7 +11,8 @@
 This is where the parser for the model configuration is defined.
 """
 import logging
-from distutils.util import strtobool
+
+from sparch.parsers.utils import strtobool
 
 logger = logging.getLogger(__name__)
 
@@ -154,6 +155,16 @@ def add_model_options(parser):
         default=[False],
         help="Detach reset signal specifically for autograd. True by default",
     )
+    parser.add_argument(
+        "--spike_solver",
+        nargs='+',
+        type=str,
+        choices=["loop", "fixed_point"],
+        default=["loop"],
+        help="Algorithm used to compute the spike trains of LIF, adLIF and "
+        "LIFcomplex layers, either the reference time loop or the fixed-point "
+        "parallel solver that only iterates over spikes.",
+    )
     parser.add_argument(
         "--dt_min",
         type=float,
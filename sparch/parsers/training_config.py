@@ -11,7 +11,8 @@
 This is where the parser for the training configuration is defined.
 """
 import logging
-from distutils.util import strtobool
+
+from sparch.parsers.utils import strtobool
 
 logger = logging.getLogger(__name__)
 
@@ -29,6 +30,58 @@ def add_training_options(parser):
         default=None,
         help="Id of the current sweep to execute.",
     )
+    parser.add_argument(
+        "--local_sweep",
+        action='store_true',
+        help="Run the sweep locally in a pool of processes instead of with "
+        "a wandb agent.",
+    )
+    parser.add_argument(
+        "--sweep_dir",
+        type=str,
+        default=None,
+        help="Folder of the results of a local sweep, exp/sweeps/<sweep_name> "
+        "by default. An interrupted sweep resumes from it.",
+    )
+    parser.add_argument(
+        "--sweep_workers",
+        type=int,
+        default=1,
+        help="Number of trials of a local sweep run in parallel.",
+    )
+    parser.add_argument(
+        "--cores_per_trial",
+        type=int,
+        default=None,
+        help="Number of CPU cores each trial of a local sweep is pinned to. "
+        "All cores are split between the workers by default.",
+    )
+    parser.add_argument(
+        "--sweep_count",
+        type=int,
+        default=20,
+        help="Number of trials of a local bayes sweep.",
+    )
+    parser.add_argument(
+        "--asha",
+        action='store_true',
+        help="Stop under-performing trials of a sweep early with asynchronous "
+        "successive halving on the valid accuracy. Debug runs are compared "
+        "with the previous runs of the sweep folder.",
+    )
+    parser.add_argument(
+        "--asha_min_epochs",
+        type=int,
+        default=3,
+        help="Epoch of the first rung of successive halving.",
+    )
+    parser.add_argument(
+        "--asha_eta",
+        type=int,
+        default=3,
+        help="Reduction factor of successive halving, only the top 1/eta "
+        "trials go on at every rung.",
+    )
     parser.add_argument(
         "--debug",
         action='store_true',
@@ -106,6 +159,35 @@ def add_training_options(parser):
         default=128,
         help="Number of input examples inside a single batch.",
     )
+    parser.add_argument(
+        "--micro_batch_size",
+        type=int,
+        default=None,
+        help="Optional size of the micro-batches each batch is split into, "
+        "with gradients accumulated over them and a single optimizer step "
+        "per batch. Reduces memory without changing the effective batch "
+        "size, but the gradient differs from the one of the full batch: "
+        "BatchNorm layers normalize each micro-batch with its own statistics "
+        "(their running statistics still cover the whole batch), and the "
+        "firing rate regularizer is applied to the rates of each micro-batch "
+        "and averaged.",
+    )
+    parser.add_argument(
+        "--find_batch_size",
+        type=lambda x: bool(strtobool(str(x))),
+        default=False,
+        help="Whether to probe training steps on synthetic inputs before "
+        "training to find the largest batch size that fits the memory "
+        "budget. If the configured batch size does not fit, it is split "
+        "into micro-batches of the largest size that fits.",
+    )
+    parser.add_argument(
+        "--memory_budget",
+        type=float,
+        default=None,
+        help="Memory budget in MB of the batch size search. Defaults to the "
+        "memory of the GPU or the available RAM.",
+    )
     parser.add_argument(
         "--nb_steps",
         nargs="+",
@@ -178,6 +260,14 @@ def add_training_options(parser):
         help="Factor between 0 and 1 by which the learning rate gets "
         "decreased when the scheduler patience is reached.",
     )
+    parser.add_argument(
+        "--track_firing_rates",
+        type=lambda x: bool(strtobool(str(x))),
+        default=True,
+        help="Whether SNNs return the mean firing rates of their layers, "
+        "which are needed by the regularizers and for the logged spike "
+        "activity.",
+    )
     parser.add_argument(
         "--use_regularizers",
         type=lambda x: bool(strtobool(str(x))),
@@ -205,6 +295,116 @@ def add_training_options(parser):
         help="Highest firing frequency value of spiking neurons for which "
         "there is no regularization loss.",
     )
+    parser.add_argument(
+        "--compile",
+        type=lambda x: bool(strtobool(str(x))),
+        default=False,
+        help="Whether to compile the model with torch.compile. The time loops "
+        "are unrolled once for the configured number of timesteps and the "
+        "batch dimension is kept dynamic.",
+    )
+    parser.add_argument(
+        "--count_synops",
+        type=lambda x: bool(strtobool(str(x))),
+        default=False,
+        help="Whether to count the synaptic operations of every layer (dense "
+        "MACs, spike-driven accumulates, recurrent SynOps and state updates) "
+        "and to log them per sample with an energy estimate at every epoch.",
+    )
+    parser.add_argument(
+        "--profile",
+        type=lambda x: bool(strtobool(str(x))),
+        default=False,
+        help="Whether to profile the W projection, normalization, cell loop, "
+        "dropout and readout of every layer. A summary table is logged and a "
+        "Chrome trace is saved in the experiment folder at every epoch.",
+    )
+    parser.add_argument(
+        "--telemetry_file",
+        type=str,
+        default=None,
+        help="Optional file for the throughput metrics of every training "
+        "epoch. Files ending with .prom are written in Prometheus text "
+        "format, other files get one JSON line per epoch.",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        choices=["fp32", "bf16", "fp16"],
+        default="fp32",
+        help="Precision of training and evaluation. With bf16 or fp16 the "
+        "loops run under autocast, fp16 also uses a gradient scaler. Complex "
+        "recurrences, BatchNorm, readout softmax and S4 FFT stay in fp32.",
+    )
+    parser.add_argument(
+        "--dist_backend",
+        type=str,
+        choices=["gloo", "nccl"],
+        default="gloo",
+        help="Backend of data parallel training when launched with torchrun "
+        "on several processes. The batch size is split between processes.",
+    )
+    parser.add_argument(
+        "--sync_batchnorm",
+        type=lambda x: bool(strtobool(str(x))),
+        default=False,
+        help="Whether to synchronize the BatchNorm statistics between the "
+        "processes of data parallel training.",
+    )
+    parser.add_argument(
+        "--ensemble",
+        type=str,
+        default=None,
+        help="Trains an ensemble of models stacked in a single process. "
+        "Either a number K of members with seeds seed, ..., seed+K-1, or a "
+        "JSON list of per-member overrides of seed, lr, threshold and "
+        "extra config such as dt_min and dt_max, e.g. "
+        "'[{\"seed\": 0, \"lr\": 0.01}, {\"seed\": 1, \"threshold\": 0.5}]'.",
+    )
+    parser.add_argument(
+        "--resume",
+        type=lambda x: bool(strtobool(str(x))),
+        default=False,
+        help="Whether to continue an interrupted training from the last "
+        "checkpoint of its experiment folder.",
+    )
+    parser.add_argument(
+        "--checkpoint_every",
+        type=int,
+        default=1,
+        help="Number of epochs between checkpoints of the full training "
+        "state, 0 to only save at the last epoch.",
+    )
+    parser.add_argument(
+        "--keep_checkpoints",
+        type=int,
+        default=3,
+        help="Number of last checkpoints kept.",
+    )
+    parser.add_argument(
+        "--results_db",
+        type=str,
+        default="",
+        help="Path of the SQLite store the final results of experiments are "
+        "appended to, e.g. results.db. Results are not saved if empty.",
+    )
+    parser.add_argument(
+        "--frozen_layers",
+        type=int,
+        default=0,
+        help="Number of lower layers of an SNN that are not trained. They "
+        "are run once over the dataset and the upper layers are trained on "
+        "their cached output spikes, e.g. to fine-tune a pretrained model.",
+    )
+    parser.add_argument(
+        "--log_backend",
+        type=str,
+        choices=["wandb", "offline"],
+        default="wandb",
+        help="Where metrics are logged besides the metrics.jsonl file of the "
+        "experiment folder, wandb or nowhere for offline runs, which are "
+        "synced later with python -m sparch.run_logger.",
+    )
     parser.add_argument(
         "--use_augm",
         type=lambda x: bool(strtobool(str(x))),
@@ -230,16 +430,34 @@ def print_training_options(config):
         Log to file: {log_tofile}
         Save best model: {save_best}
         Batch size: {batch_size}
+        Micro-batch size: {micro_batch_size}
+        Find batch size: {find_batch_size}
+        Memory budget: {memory_budget}
         Number of epochs: {nb_epochs}
         Start epoch: {start_epoch}
         Initial learning rate: {lr}
         Scheduler patience: {scheduler_patience}
         Scheduler factor: {scheduler_factor}
+        Track firing rates: {track_firing_rates}
         Use regularizers: {use_regularizers}
         Regularization factor: {reg_factor}
         Regularization min firing rate: {reg_fmin}
         Reguarization max firing rate: {reg_fmax}
         Use data augmentation: {use_augm}
+        Compile model: {compile}
+        Count synaptic operations: {count_synops}
+        Profile layers: {profile}
+        Telemetry file: {telemetry_file}
+        Precision: {precision}
+        Distributed backend: {dist_backend}
+        Synchronize BatchNorm: {sync_batchnorm}
+        Ensemble: {ensemble}
+        Resume: {resume}
+        Checkpoint every: {checkpoint_every}
+        Keep checkpoints: {keep_checkpoints}
+        Results store: {results_db}
+        Log backend: {log_backend}
+        Frozen layers: {frozen_layers}
         Seed {seed}
     """.format(
             **config
@@ -0,0 +1,210 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is where the pre-flight search of the largest batch size that fits a
+memory budget is defined.
+
+Training steps (forward and backward) are probed on synthetic inputs of
+the configured shape, doubling the batch size until the budget is exceeded
+and then bisecting. On CUDA the peak allocated memory is measured, and out
+of memory errors count as not fitting. On CPU the memory is estimated from
+the parameters, their gradients and the tensors saved for the backward
+pass. The optimizer states, which are only allocated at the first step,
+are added in both cases. The weights, buffers and random number generator
+states are restored after probing, so that training is unaffected.
+"""
+import contextlib
+import os
+import time
+
+import torch
+
+from sparch.models.precision import autocast
+
+
+def available_memory(device):
+    """Total memory of a CUDA device or available RAM, in bytes."""
+    if device.type == "cuda":
+        return torch.cuda.get_device_properties(device).total_memory
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+class BatchSizeFinder:
+    """
+    Probes training steps of a model for increasing batch sizes.
+
+    Arguments
+    ---------
+    net : nn.Module
+        Model to probe, possibly wrapped by torch.compile.
+    loss_fn : callable
+        Loss function of the outputs and labels.
+    device : torch.device
+        Device of the model.
+    nb_steps : int
+        Number of time steps of the synthetic inputs.
+    nb_inputs : int
+        Number of input features.
+    nb_outputs : int
+        Number of classes of the synthetic labels.
+    spiking : bool
+        Whether the synthetic inputs are sparse binary spikes or dense
+        features.
+    precision : str
+        Precision of the training steps, see sparch.models.precision.
+    optimizer_states : int
+        Number of optimizer states per parameter, e.g. 2 for Adam.
+    """
+
+    def __init__(
+        self,
+        net,
+        loss_fn,
+        device,
+        nb_steps,
+        nb_inputs,
+        nb_outputs,
+        spiking=True,
+        precision="fp32",
+        optimizer_states=2,
+    ):
+        self.net = net
+        self.loss_fn = loss_fn
+        self.device = device
+        self.nb_steps = nb_steps
+        self.nb_inputs = nb_inputs
+        self.nb_outputs = nb_outputs
+        self.spiking = spiking
+        self.precision = precision
+
+        params = [p for p in net.parameters() if p.requires_grad]
+        param_bytes = sum(p.numel() * p.element_size() for p in params)
+        self.optimizer_bytes = optimizer_states * param_bytes
+        self.static_bytes = 2 * param_bytes  # weights and gradients on CPU
+
+    def _inputs(self, batch_size):
+        shape = (batch_size, self.nb_steps, self.nb_inputs)
+        if self.spiking:
+            x = (torch.rand(shape, device=self.device) < 0.02).float()
+        else:
+            x = torch.randn(shape, device=self.device)
+        y = torch.randint(self.nb_outputs, (batch_size,), device=self.device)
+        return x, y
+
+    def _step(self, x, y, saved=None):
+        def pack(t):
+            saved[0] += t.numel() * t.element_size()
+            return t
+
+        if saved is not None:
+            hooks = torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t)
+        else:
+            hooks = contextlib.nullcontext()
+        with hooks, autocast(self.device, self.precision):
+            output, _ = self.net(x)
+            loss = self.loss_fn(output, y)
+        loss.backward()
+        self.net.zero_grad(set_to_none=True)
+
+    @contextlib.contextmanager
+    def preserved_state(self):
+        """Context restoring the weights, buffers and RNG states on exit."""
+        state = _save_state(self.net, self.device)
+        was_training = self.net.training
+        self.net.train()
+        try:
+            yield
+        finally:
+            _restore_state(self.net, self.device, state)
+            self.net.train(was_training)
+
+    def probe(self, batch_size, repeats=1):
+        """
+        Runs training steps with the given batch size and returns the peak
+        memory in bytes (None if out of memory) and the mean step time. The
+        steps change the model, see preserved_state.
+        """
+        x, y = self._inputs(batch_size)
+        try:
+            if self.device.type == "cuda":
+                torch.cuda.empty_cache()
+                torch.cuda.reset_peak_memory_stats(self.device)
+                self._step(x, y)
+                memory = torch.cuda.max_memory_allocated(self.device)
+            else:
+                saved = [0]
+                self._step(x, y, saved)
+                memory = self.static_bytes + x.numel() * x.element_size() + saved[0]
+        except torch.cuda.OutOfMemoryError:
+            self.net.zero_grad(set_to_none=True)
+            torch.cuda.empty_cache()
+            return None, None
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            self._step(x, y)
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        step_time = (time.perf_counter() - start) / repeats
+
+        return memory + self.optimizer_bytes, step_time
+
+    def search(self, max_batch_size, budget, repeats=3):
+        """
+        Returns the largest batch size up to max_batch_size whose training
+        step fits the memory budget in bytes, with its memory and step time
+        and all probes, as a dict.
+        """
+        probes = {}
+
+        def fits(batch_size):
+            memory, step_time = self.probe(batch_size, repeats)
+            probes[batch_size] = {"memory": memory, "step_time": step_time}
+            return memory is not None and memory <= budget
+
+        with self.preserved_state():
+            # Double until too large, then bisect between last two sizes
+            low, high = 0, 1
+            while high <= max_batch_size and fits(high):
+                low, high = high, 2 * high
+            high = min(high, max_batch_size + 1)
+            while high - low > 1:
+                mid = (low + high) // 2
+                if fits(mid):
+                    low = mid
+                else:
+                    high = mid
+
+        best = probes.get(low, {"memory": None, "step_time": None})
+        return {
+            "batch_size": low,
+            "memory": best["memory"],
+            "step_time": best["step_time"],
+            "budget": budget,
+            "probes": probes,
+        }
+
+
+def _save_state(net, device):
+    weights = net.state_dict()
+    state = {
+        "model": {k: v.detach().to("cpu", copy=True) for k, v in weights.items()},
+        "rng": torch.get_rng_state(),
+    }
+    if device.type == "cuda":
+        state["cuda_rng"] = torch.cuda.get_rng_state(device)
+    return state
+
+
+def _restore_state(net, device, state):
+    net.load_state_dict(state["model"])
+    torch.set_rng_state(state["rng"])
+    if device.type == "cuda":
+        torch.cuda.set_rng_state(state["cuda_rng"], device)
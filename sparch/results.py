@@ -0,0 +1,169 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is where the store of the final results of all experiments is defined.
+
+Results are rows of a SQLite database, indexed by dataset, model type,
+number of layers and number of neurons. Every experiment appends its row
+in a single short transaction, so that the cost does not grow with the
+number of results and parallel sweep workers finishing together wait for
+each other's lock instead of overwriting each other's results. Plots
+query the rows they need instead of loading all results.
+
+Usage: python -m sparch.results resultsSHD.json --dataset_name shd
+imports the results of the former JSON files.
+"""
+import argparse
+import json
+import logging
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+RESULTS_DB = "results.db"
+
+# Columns of a result, with the keys of the former JSON entries
+COLUMNS = [
+    "dataset_name",
+    "model_type",
+    "number_layers",
+    "number_neurons",
+    "test_acc",
+    "best_val_acc",
+    "exp_folder",
+    "seed",
+]
+
+# Columns that queries filter on
+INDEXED = ["dataset_name", "model_type", "number_layers", "number_neurons"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    dataset_name TEXT NOT NULL,
+    model_type TEXT NOT NULL,
+    number_layers INTEGER NOT NULL,
+    number_neurons INTEGER NOT NULL,
+    test_acc REAL,
+    best_val_acc REAL,
+    exp_folder TEXT,
+    seed INTEGER,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_by_model
+    ON results (dataset_name, model_type, number_layers, number_neurons);
+CREATE INDEX IF NOT EXISTS results_by_size
+    ON results (dataset_name, number_layers, number_neurons);
+"""
+
+
+class ResultsStore:
+    """
+    Append-only store of the results of experiments.
+
+    Arguments
+    ---------
+    path : str
+        Path of the SQLite database, created if it does not exist.
+    timeout : float
+        Seconds to wait for the lock of another process.
+    """
+
+    def __init__(self, path=RESULTS_DB, timeout=60.0):
+        self.path = path
+        self.timeout = timeout
+        db = self.connect()
+        try:
+            db.executescript(SCHEMA)
+        finally:
+            db.close()
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=self.timeout)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def add(self, entries):
+        """Appends one result or a list of results."""
+        if isinstance(entries, dict):
+            entries = [entries]
+        rows = [
+            [entry.get(column) for column in COLUMNS] + [time.time()]
+            for entry in entries
+        ]
+        columns = ", ".join(COLUMNS + ["created"])
+        values = ", ".join("?" * (len(COLUMNS) + 1))
+        db = self.connect()
+        try:
+            # Lock taken at the start of the transaction, held for one insert
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                db.executemany(
+                    f"INSERT INTO results ({columns}) VALUES ({values})", rows
+                )
+        finally:
+            db.close()
+
+    def query(self, **filters):
+        """
+        Returns the results matching the filters on the indexed columns,
+        each a value or a list of accepted values, oldest first.
+        """
+        clauses = []
+        params = []
+        for column, value in filters.items():
+            if column not in INDEXED:
+                raise ValueError(f"Cannot filter results on {column}")
+            if value is None:
+                continue
+            if isinstance(value, (list, tuple, set)):
+                value = list(value)
+                clauses.append(f"{column} IN ({', '.join('?' * len(value))})")
+                params += value
+            else:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+
+        sql = "SELECT * FROM results"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY id"
+
+        db = self.connect()
+        try:
+            return [dict(row) for row in db.execute(sql, params)]
+        finally:
+            db.close()
+
+    def import_json(self, path, dataset_name):
+        """Appends the entries of a former results JSON file."""
+        with open(path) as f:
+            entries = json.load(f)
+        self.add([{"dataset_name": dataset_name, **entry} for entry in entries])
+        return len(entries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import results JSON files.")
+    parser.add_argument("json_path", nargs="+", help="Paths of results files.")
+    parser.add_argument("--dataset_name", type=str, required=True)
+    parser.add_argument("--results_db", type=str, default=RESULTS_DB)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    store = ResultsStore(args.results_db)
+    for path in args.json_path:
+        count = store.import_json(path, args.dataset_name)
+        logger.info(f"Imported {count} results of {path} to {args.results_db}")
+
+
+if __name__ == "__main__":
+    main()
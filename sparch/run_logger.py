@@ -0,0 +1,224 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is where the logger of the metrics of a run is defined.
+
+Metrics are logged as with wandb.log, accumulated until a commit, and the
+committed steps are handed to a background thread, which writes them in
+batches, so that the training loop never waits for the disk or the
+network. Every step is appended to metrics.jsonl in the experiment
+folder, and also sent to wandb for online runs. Offline runs are synced to
+wandb later with
+
+    python -m sparch.run_logger exp/final/<experiment folder> --project S3_SHD_runs
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of the logged steps in the queue
+_CLOSE = object()
+
+
+class JsonlBackend:
+    """
+    Appends the steps to a JSON lines file. The steps of a former run from
+    start_step on are dropped, e.g. those logged after the checkpoint a run
+    is resumed from, so that steps stay unique and increasing.
+    """
+
+    def __init__(self, path, start_step=0):
+        rows = []
+        if start_step and os.path.exists(path):
+            rows = [row for row in read_metrics(path) if row["step"] < start_step]
+        self.file = open(path, "w")
+        self.write(rows)
+
+    def write(self, rows):
+        for row in rows:
+            self.file.write(json.dumps(row, default=float) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class WandbBackend:
+    """Sends the steps to the current wandb run."""
+
+    def write(self, rows):
+        import wandb
+
+        for row in rows:
+            metrics = {k: v for k, v in row.items() if k not in ["step", "time"]}
+            wandb.log(metrics, step=row["step"])
+
+    def close(self):
+        pass
+
+
+class RunLogger:
+    """
+    Buffered logger of the metrics of a run, written by a background thread.
+
+    Arguments
+    ---------
+    backends : list
+        Backends the steps are written to, none to drop all metrics, e.g.
+        on the processes other than the main one.
+    batch_size : int
+        Maximum number of steps written at once.
+    flush_interval : float
+        Seconds after which pending steps are written.
+    step : int
+        First step, e.g. the step of the checkpoint a run is resumed from.
+    """
+
+    def __init__(self, backends, batch_size=64, flush_interval=5.0, step=0):
+        self.backends = backends
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.step = step
+        self.pending = {}
+        self.error = None
+        self.queue = queue.Queue()
+        self.thread = None
+        if backends:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def log(self, metrics, commit=True):
+        """
+        Adds metrics to the current step, which is committed, as with
+        wandb.log, unless commit is False.
+        """
+        if self.thread is None:
+            return
+        if self.error is not None:
+            raise RuntimeError("Metrics logger failed") from self.error
+        self.pending.update(metrics)
+        if commit:
+            self.commit()
+
+    def commit(self):
+        """Hands the current step to the writer thread."""
+        if not self.pending:
+            return
+        self.queue.put({"step": self.step, "time": time.time(), **self.pending})
+        self.pending = {}
+        self.step += 1
+
+    def close(self):
+        """Commits the last step and waits for all steps to be written."""
+        if self.thread is None:
+            return
+        self.commit()
+        self.queue.put(_CLOSE)
+        self.thread.join()
+        self.thread = None
+        for backend in self.backends:
+            backend.close()
+        if self.error is not None:
+            raise RuntimeError("Metrics logger failed") from self.error
+
+    def _run(self):
+        closed = False
+        while not closed:
+            try:
+                rows = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+
+            # Batch the steps that arrived in the meantime
+            while len(rows) < self.batch_size:
+                try:
+                    rows.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _CLOSE in rows:
+                rows = [row for row in rows if row is not _CLOSE]
+                closed = True
+
+            if rows and self.error is None:
+                try:
+                    for backend in self.backends:
+                        backend.write(rows)
+                except Exception as error:
+                    logger.exception("Failed to write metrics")
+                    self.error = error
+
+
+def read_metrics(path):
+    """Returns the steps of a metrics.jsonl file, skipping a partial last line."""
+    rows = []
+    with open(path) as f:
+        for line in f:
+            try:
+                rows.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+    return rows
+
+
+def sync(exp_folder, project, entity=None):
+    """
+    Creates a wandb run with the config and logged metrics of an offline
+    experiment, once, and returns its id.
+    """
+    import wandb
+
+    marker = os.path.join(exp_folder, "wandb_run.txt")
+    if os.path.exists(marker):
+        with open(marker) as f:
+            run_id = f.read().strip()
+        logger.info(f"{exp_folder} already synced to run {run_id}")
+        return run_id
+
+    config = {}
+    config_path = os.path.join(exp_folder, "config.json")
+    if os.path.exists(config_path):
+        with open(config_path) as f:
+            config = json.load(f)
+
+    run = wandb.init(
+        entity=entity,
+        project=project,
+        config=config,
+        name=os.path.basename(os.path.normpath(exp_folder)),
+    )
+    WandbBackend().write(read_metrics(os.path.join(exp_folder, "metrics.jsonl")))
+    run.finish()
+
+    with open(marker, "w") as f:
+        f.write(run.id)
+    logger.info(f"Synced {exp_folder} to run {run.id}")
+    return run.id
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sync offline runs to wandb.")
+    parser.add_argument("exp_folder", nargs="+", help="Experiment folders.")
+    parser.add_argument("--project", type=str, required=True)
+    parser.add_argument("--entity", type=str, default="maximes_crew")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    for exp_folder in args.exp_folder:
+        sync(exp_folder, args.project, args.entity)
+
+
+if __name__ == "__main__":
+    main()
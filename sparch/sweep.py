@@ -0,0 +1,537 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is where the local sweep engine is defined.
+
+It runs the grid and bayes sweeps built by run_exp.py without wandb. Trials
+run in parallel processes, each pinned to its own subset of CPU cores (and
+to a GPU if any), and their configs, per-epoch metrics and results are
+written to a local store,
+
+    sweep_dir/sweep.json
+    sweep_dir/trials/<trial_id>/trial.json
+    sweep_dir/trials/<trial_id>/metrics.jsonl
+
+while checkpoints and logs go to the experiment folder of the config, see
+sparch.exp_cache. An interrupted sweep resumes from its store: finished
+trials are skipped and the others are run again from scratch, and configs
+completed by any previous run are not trained again.
+
+With an early_terminate entry in the sweep config, as for wandb hyperband,
+under-performing trials are stopped by asynchronous successive halving.
+"""
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+from multiprocessing.connection import wait
+
+import numpy as np
+
+from sparch.exp_cache import find_completed
+from sparch.exp_cache import write_json
+
+logger = logging.getLogger(__name__)
+
+FINISHED = "finished"
+FAILED = "failed"
+RUNNING = "running"
+STOPPED = "stopped"
+PENDING = "pending"
+
+
+class SweepStore:
+    """
+    Local store of the configs, metrics and results of the trials of a sweep.
+    """
+
+    def __init__(self, sweep_dir):
+        self.sweep_dir = sweep_dir
+        self.trials_dir = os.path.join(sweep_dir, "trials")
+        os.makedirs(self.trials_dir, exist_ok=True)
+
+    def save_sweep(self, sweep_config):
+        write_json(os.path.join(self.sweep_dir, "sweep.json"), sweep_config)
+
+    def trial_dir(self, trial_id):
+        return os.path.join(self.trials_dir, trial_id)
+
+    def trial_ids(self):
+        return sorted(os.listdir(self.trials_dir))
+
+    def read_trial(self, trial_id):
+        path = os.path.join(self.trial_dir(trial_id), "trial.json")
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def write_trial(self, trial_id, record):
+        os.makedirs(self.trial_dir(trial_id), exist_ok=True)
+        write_json(os.path.join(self.trial_dir(trial_id), "trial.json"), record)
+
+    def update_trial(self, trial_id, **fields):
+        record = self.read_trial(trial_id)
+        record.update(fields)
+        self.write_trial(trial_id, record)
+        return record
+
+    def trials(self):
+        """All trial records, in order of creation."""
+        records = [self.read_trial(t) for t in self.trial_ids()]
+        return [r for r in records if r is not None]
+
+    def append_metrics(self, trial_id, metrics):
+        path = os.path.join(self.trial_dir(trial_id), "metrics.jsonl")
+        with open(path, "a") as f:
+            f.write(json.dumps(metrics) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def metrics(self, trial_id):
+        """Per-epoch metrics reported by a trial."""
+        path = os.path.join(self.trial_dir(trial_id), "metrics.jsonl")
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def new_trial_id(self):
+        return f"trial-{len(self.trial_ids()):04d}"
+
+    def add_trial(self, trial_id, config, metric, status=PENDING):
+        self.write_trial(
+            trial_id, {"id": trial_id, "config": config, "metric": metric, "status": status}
+        )
+
+    def reset_metrics(self, trial_id):
+        path = os.path.join(self.trial_dir(trial_id), "metrics.jsonl")
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def grid_configs(parameters):
+    """Returns the configs of all combinations of the parameter values."""
+    names = sorted(parameters)
+    choices = []
+    for name in names:
+        spec = parameters[name]
+        if "values" not in spec:
+            raise ValueError(f"Grid sweep needs a list of values for {name}")
+        choices.append(spec["values"])
+    return [dict(zip(names, values)) for values in itertools.product(*choices)]
+
+
+class BayesSearch:
+    """
+    Bayesian optimization of the parameters of a sweep, with a Gaussian
+    process and expected improvement, like wandb bayes sweeps.
+
+    Parameters are either a list of values or a range given by min and max,
+    sampled as integers if both bounds are integers.
+
+    Arguments
+    ---------
+    parameters : dict
+        Parameters of the sweep config.
+    goal : str
+        Either "maximize" or "minimize".
+    nb_initial : int
+        Number of random configs before the Gaussian process is used.
+    nb_candidates : int
+        Number of random candidates scored by the expected improvement.
+    seed : int
+        Seed of the random sampling.
+    """
+
+    def __init__(
+        self, parameters, goal="maximize", nb_initial=5, nb_candidates=1000, seed=0
+    ):
+        self.parameters = parameters
+        self.names = sorted(parameters)
+        self.sign = 1.0 if goal == "maximize" else -1.0
+        self.nb_initial = nb_initial
+        self.nb_candidates = nb_candidates
+        self.rng = np.random.default_rng(seed)
+
+    def _sample(self):
+        config = {}
+        for name in self.names:
+            spec = self.parameters[name]
+            if "values" in spec:
+                config[name] = spec["values"][self.rng.integers(len(spec["values"]))]
+            elif isinstance(spec["min"], int) and isinstance(spec["max"], int):
+                config[name] = int(self.rng.integers(spec["min"], spec["max"] + 1))
+            else:
+                config[name] = float(self.rng.uniform(spec["min"], spec["max"]))
+        return config
+
+    def _encode(self, config):
+        # Map every parameter to [0, 1], values by their index
+        features = []
+        for name in self.names:
+            spec = self.parameters[name]
+            if "values" in spec:
+                values = spec["values"]
+                index = values.index(config[name]) if config[name] in values else 0
+                features.append(index / max(len(values) - 1, 1))
+            else:
+                span = max(spec["max"] - spec["min"], 1e-12)
+                features.append((config[name] - spec["min"]) / span)
+        return np.array(features)
+
+    def suggest(self, history):
+        """
+        Returns the next config to try given the (config, metric) pairs of
+        the finished trials.
+        """
+        if len(history) < self.nb_initial:
+            return self._sample()
+
+        x = np.stack([self._encode(c) for c, _ in history])
+        y = self.sign * np.array([v for _, v in history], dtype=float)
+        y_mean, y_std = y.mean(), y.std() + 1e-12
+        y = (y - y_mean) / y_std
+
+        candidates = [self._sample() for _ in range(self.nb_candidates)]
+        xc = np.stack([self._encode(c) for c in candidates])
+
+        # Posterior of the Gaussian process with RBF kernel
+        k = _rbf(x, x) + 1e-4 * np.eye(len(x))
+        kc = _rbf(xc, x)
+        k_inv = np.linalg.inv(k)
+        mu = kc @ k_inv @ y
+        var = np.clip(1.0 - np.einsum("ij,jk,ik->i", kc, k_inv, kc), 1e-12, None)
+        sigma = np.sqrt(var)
+
+        # Expected improvement over the best finished trial
+        z = (mu - y.max()) / sigma
+        cdf = 0.5 * (1 + np.vectorize(math.erf)(z / math.sqrt(2)))
+        pdf = np.exp(-0.5 * z**2) / math.sqrt(2 * math.pi)
+        ei = (mu - y.max()) * cdf + sigma * pdf
+        return candidates[int(np.argmax(ei))]
+
+
+def _rbf(a, b, length_scale=0.2):
+    d2 = ((a[:, None, :] - b[None, :, :]) ** 2).sum(-1)
+    return np.exp(-0.5 * d2 / length_scale**2)
+
+
+def core_slots(workers, cores_per_trial=None):
+    """Splits the cores available to the process between the workers."""
+    cores = sorted(os.sched_getaffinity(0))
+    if cores_per_trial is None:
+        cores_per_trial = max(1, len(cores) // workers)
+    if workers * cores_per_trial > len(cores):
+        raise ValueError(
+            f"{workers} workers with {cores_per_trial} cores each do not fit "
+            f"the {len(cores)} available cores"
+        )
+    return [cores[i * cores_per_trial : (i + 1) * cores_per_trial] for i in range(workers)]
+
+
+class SuccessiveHalving:
+    """
+    Asynchronous successive halving (ASHA) of the trials of a sweep, in its
+    stopping form. Rungs are at min_epochs * eta**k epochs. A trial reaching
+    a rung goes on only if its metric is in the top 1/eta of the metrics of
+    all trials of the store at that rung, and is stopped otherwise. Trials
+    go on while fewer than eta of them reached the rung.
+
+    Arguments
+    ---------
+    store : SweepStore
+        Store of the per-epoch metrics of the trials.
+    metric : dict
+        Name and goal of the metric, as in the sweep config.
+    min_epochs : int
+        Epoch of the first rung.
+    eta : int
+        Reduction factor between rungs.
+    """
+
+    def __init__(self, store, metric, min_epochs=3, eta=3):
+        if min_epochs < 1 or eta < 2:
+            raise ValueError("Successive halving needs min_epochs >= 1 and eta >= 2")
+        self.store = store
+        self.metric = metric
+        self.min_epochs = min_epochs
+        self.eta = eta
+
+    @classmethod
+    def from_config(cls, store, sweep_config):
+        """Scheduler of the early_terminate entry of a sweep config, or None."""
+        spec = sweep_config.get("early_terminate")
+        if spec is None:
+            return None
+        if spec.get("type") != "hyperband":
+            raise ValueError(f"Invalid early_terminate type {spec.get('type')}")
+        return cls(store, sweep_config["metric"], spec["min_iter"], spec.get("eta", 3))
+
+    def is_rung(self, epoch):
+        rung = self.min_epochs
+        while rung < epoch:
+            rung *= self.eta
+        return rung == epoch
+
+    def keep(self, trial_id, epoch, value):
+        """Whether a trial goes on after reaching a rung with the value."""
+        name = self.metric["name"]
+        sign = 1 if self.metric.get("goal", "maximize") == "maximize" else -1
+        values = [value]
+        for other in self.store.trial_ids():
+            if other == trial_id:
+                continue
+            for metrics in self.store.metrics(other):
+                if metrics["epoch"] == epoch and name in metrics:
+                    values.append(metrics[name])
+        if len(values) < self.eta:
+            return True
+        rank = sorted((sign * v for v in values), reverse=True).index(sign * value)
+        return rank < len(values) // self.eta
+
+    def callback(self, trial_id):
+        """Experiment callback stopping the trial at rungs."""
+        from sparch.exp import StopTraining
+
+        name = self.metric["name"]
+
+        def check(epoch, metrics):
+            if name in metrics and self.is_rung(epoch):
+                if not self.keep(trial_id, epoch, metrics[name]):
+                    raise StopTraining(
+                        f"{name}={metrics[name]} not in top 1/{self.eta} at rung {epoch}"
+                    )
+
+        return check
+
+
+def track_trial(experiment, store, trial_id, scheduler=None):
+    """
+    Reports the metrics of every epoch of the experiment of a trial to the
+    store, and lets the scheduler, if any, stop it early.
+    """
+
+    def report(epoch, metrics):
+        store.append_metrics(trial_id, {"epoch": epoch, **metrics})
+
+    experiment.callbacks.append(report)
+    if scheduler is not None:
+        experiment.callbacks.append(scheduler.callback(trial_id))
+
+
+def finish_trial(experiment, store, trial_id):
+    """Writes the status, best metric and final metrics of a trial."""
+    return _finish(
+        store,
+        trial_id,
+        STOPPED if experiment.stopped_epoch is not None else FINISHED,
+        epochs=len(experiment.history),
+        result=experiment.epoch_metrics,
+        exp_folder=experiment.exp_folder,
+    )
+
+
+def _finish(store, trial_id, status, **fields):
+    metric = store.read_trial(trial_id)["metric"]
+    history = [
+        m[metric["name"]] for m in store.metrics(trial_id) if metric["name"] in m
+    ]
+    best = max if metric.get("goal", "maximize") == "maximize" else min
+    return store.update_trial(
+        trial_id, status=status, value=best(history) if history else None, **fields
+    )
+
+
+def run_trial(sweep_dir, trial_id, cores, slot):
+    """
+    Runs the experiment of a trial in the current process, pinned to the
+    given cores and to the GPU of its slot, and writes its metrics and
+    result to the store. Configs that were already trained are taken from
+    the experiment cache.
+    """
+    # Only trial processes import torch and the experiments
+    import torch
+
+    from sparch.ensemble_exp import EnsembleExperiment
+    from sparch.exp import Experiment
+
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    gpu = slot % torch.cuda.device_count() if torch.cuda.is_available() else 0
+
+    store = SweepStore(sweep_dir)
+    with open(os.path.join(sweep_dir, "sweep.json")) as f:
+        scheduler = SuccessiveHalving.from_config(store, json.load(f))
+    record = store.read_trial(trial_id)
+
+    # Trials log to their experiment folder, without wandb
+    config = dict(record["config"])
+    config.update({"debug": True, "log_tofile": True, "use_pretrained_model": False})
+
+    completed = find_completed(config)
+    if completed is not None:
+        for metrics in completed["history"]:
+            store.append_metrics(trial_id, metrics)
+        _finish(
+            store,
+            trial_id,
+            FINISHED,
+            epochs=0,
+            cached=True,
+            result={"test acc": completed["test acc"], "test loss": completed["test loss"]},
+            exp_folder=completed["exp_folder"],
+        )
+        return
+
+    if config.get("ensemble"):
+        experiment = EnsembleExperiment(config, gpu)
+    else:
+        experiment = Experiment(config, gpu)
+    track_trial(experiment, store, trial_id, scheduler)
+    experiment.forward()
+    finish_trial(experiment, store, trial_id)
+
+
+class LocalSweep:
+    """
+    Runs the trials of a grid or bayes sweep in a pool of processes.
+
+    Arguments
+    ---------
+    sweep_config : dict
+        Sweep config with method, metric and parameters, as for wandb.
+    sweep_dir : str
+        Folder of the local store of the sweep.
+    workers : int
+        Number of trials run in parallel.
+    cores_per_trial : int
+        Number of CPU cores of each trial, all cores split between the
+        workers by default.
+    count : int
+        Number of trials of a bayes sweep.
+    """
+
+    def __init__(self, sweep_config, sweep_dir, workers=1, cores_per_trial=None, count=20):
+        self.sweep_config = sweep_config
+        self.method = sweep_config["method"]
+        self.metric = sweep_config["metric"]
+        self.workers = workers
+        self.slots = core_slots(workers, cores_per_trial)
+        self.count = count
+        self.store = SweepStore(sweep_dir)
+        self.store.save_sweep(sweep_config)
+        self.launched = set()
+
+        if self.method == "grid":
+            self._add_grid_trials()
+        elif self.method == "bayes":
+            self.search = BayesSearch(sweep_config["parameters"], self.metric["goal"])
+        else:
+            raise ValueError(f"Invalid sweep method {self.method}")
+
+    def _add_grid_trials(self):
+        for i, config in enumerate(grid_configs(self.sweep_config["parameters"])):
+            trial_id = f"trial-{i:04d}"
+            record = self.store.read_trial(trial_id)
+            if record is not None and record["config"] != config:
+                raise ValueError(
+                    f"Sweep store {self.store.sweep_dir} belongs to another sweep"
+                )
+            if record is None:
+                self.store.add_trial(trial_id, config, self.metric)
+
+    def next_trial(self):
+        """Returns the id of the next trial to run, or None."""
+        for record in self.store.trials():
+            done = record["status"] in [FINISHED, STOPPED]
+            if not done and record["id"] not in self.launched:
+                return record["id"]
+
+        # Propose new configs of bayes sweep from finished trials
+        trials = self.store.trials()
+        if self.method == "bayes" and len(trials) < self.count:
+            history = [
+                (r["config"], r["value"])
+                for r in trials
+                if r["status"] in [FINISHED, STOPPED] and r.get("value") is not None
+            ]
+            trial_id = self.store.new_trial_id()
+            self.store.add_trial(trial_id, self.search.suggest(history), self.metric)
+            return trial_id
+        return None
+
+    def _start(self, trial_id, slot):
+
+        # Unfinished trials restart from scratch
+        self.store.reset_metrics(trial_id)
+        self.store.update_trial(trial_id, status=RUNNING, cores=self.slots[slot])
+        self.launched.add(trial_id)
+
+        process = multiprocessing.get_context("spawn").Process(
+            target=run_trial,
+            args=(self.store.sweep_dir, trial_id, self.slots[slot], slot),
+            name=trial_id,
+        )
+        process.start()
+        logging.info(f"Started {trial_id} on cores {self.slots[slot]}")
+        return process
+
+    def run(self):
+        """
+        Runs all trials and returns the record of the best finished one.
+        """
+        free = list(range(self.workers))
+        running = {}
+
+        while True:
+            while free:
+                trial_id = self.next_trial()
+                if trial_id is None:
+                    break
+                slot = free.pop(0)
+                process = self._start(trial_id, slot)
+                running[process.sentinel] = (trial_id, slot, process)
+
+            if not running:
+                break
+
+            for sentinel in wait(list(running)):
+                trial_id, slot, process = running.pop(sentinel)
+                process.join()
+                free.append(slot)
+                record = self.store.read_trial(trial_id)
+                if process.exitcode != 0 and record["status"] == RUNNING:
+                    self.store.update_trial(trial_id, status=FAILED)
+                    logging.warning(f"{trial_id} failed with exit code {process.exitcode}")
+                else:
+                    logging.info(f"{trial_id} {record['status']}: {record.get('value')}")
+
+        # Compute used by the sweep, lower than the full budget if stopped early
+        trials = self.store.trials()
+        epochs = sum(r.get("epochs", 0) for r in trials)
+        stopped = sum(r["status"] == STOPPED for r in trials)
+        logging.info(f"Sweep trained {epochs} epochs in total, {stopped} trials stopped")
+
+        return self.best_trial()
+
+    def best_trial(self):
+        """Record of the best finished trial, or None."""
+        finished = [
+            r for r in self.store.trials()
+            if r["status"] == FINISHED and r.get("value") is not None
+        ]
+        if not finished:
+            return None
+        sign = 1 if self.metric.get("goal", "maximize") == "maximize" else -1
+        return max(finished, key=lambda r: sign * r["value"])
+
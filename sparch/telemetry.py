@@ -0,0 +1,155 @@
+#
+# SPDX-FileCopyrightText: Copyright © 2022 Idiap Research Institute <contact@idiap.ch>
+#
+# SPDX-FileContributor: Alexandre Bittar <abittar@idiap.ch>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# This file is part of the sparch package
+#
+"""
+This is where the epoch-level throughput telemetry of the experiments is
+defined.
+
+For every epoch it measures the number of samples per second, the time the
+host is blocked waiting for the next batch of the dataloader versus the time
+spent in forward, backward and optimizer steps, the peak memory and, on
+CUDA devices, the number of host-device synchronizations. The peak memory
+is the one of the epoch on CUDA devices, and the peak resident set size of
+the whole process so far on CPU, which cannot be reset.
+
+An epoch is measured in a with block, which restores the warning filters
+and the sync debug mode also if the epoch fails,
+
+    with telemetry:
+        for batch in telemetry.wrap(loader):
+            ...
+        metrics = telemetry.stop()
+"""
+import json
+import resource
+import time
+import warnings
+
+import torch
+
+
+class EpochTelemetry:
+    """
+    Collects throughput metrics over one pass on a dataloader.
+
+    Arguments
+    ---------
+    device : torch.device
+        Device of the model.
+    path : str
+        Optional file where the metrics of every epoch are written. Files
+        ending with .prom are overwritten with the metrics of the last epoch
+        in Prometheus text format (e.g. for the textfile collector of
+        node_exporter), other files get one JSON line per epoch.
+    """
+
+    def __init__(self, device, path=None):
+        self.device = device
+        self.path = path
+        self.cuda = device.type == "cuda"
+        self._catcher = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._restore()
+
+    def start(self):
+        """Resets the metrics, e.g. at the beginning of an epoch."""
+        self.samples = 0
+        self.batches = 0
+        self.wait = 0.0
+        self.start_time = time.perf_counter()
+
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+            # Synchronizing operations raise warnings in debug mode
+            self._catcher = warnings.catch_warnings(record=True)
+            self._records = self._catcher.__enter__()
+            warnings.simplefilter("always")
+            torch.cuda.set_sync_debug_mode(1)
+
+    def wrap(self, loader):
+        """Iterates over the loader while measuring the time waiting for it."""
+        iterator = iter(loader)
+        while True:
+            t0 = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.wait += time.perf_counter() - t0
+            self.samples += len(batch[0])
+            self.batches += 1
+            yield batch
+
+    def _restore(self):
+        """Restores the sync debug mode and the warning filters."""
+        if self._catcher is None:
+            return
+        torch.cuda.set_sync_debug_mode(0)
+        self._catcher.__exit__(None, None, None)
+        self._catcher = None
+
+    def stop(self):
+        """Returns the metrics since the last call to start."""
+        elapsed = time.perf_counter() - self.start_time
+        syncs = 0
+
+        if self.cuda:
+            self._restore()
+            for record in self._records:
+                if "synchronizing" in str(record.message):
+                    syncs += 1
+                else:
+                    warnings.showwarning(
+                        record.message, record.category, record.filename, record.lineno
+                    )
+            peak_memory = torch.cuda.max_memory_allocated(self.device)
+            scope = "epoch"
+        else:
+            # Peak resident set size since the start of the process, in kB
+            # on Linux
+            peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            scope = "process"
+
+        return {
+            "samples": self.samples,
+            "batches": self.batches,
+            "elapsed": elapsed,
+            "samples_per_sec": self.samples / max(elapsed, 1e-9),
+            "loader_wait": self.wait,
+            "compute": elapsed - self.wait,
+            "loader_fraction": self.wait / max(elapsed, 1e-9),
+            "peak_memory_mb": peak_memory / 1e6,
+            "peak_memory_scope": scope,
+            "host_syncs": syncs if self.cuda else None,
+        }
+
+    def write(self, metrics, epoch, split):
+        """Writes the metrics of an epoch to the telemetry file, if any."""
+        if self.path is None:
+            return
+
+        if self.path.endswith(".prom"):
+            lines = []
+            for key, value in metrics.items():
+                if value is None or isinstance(value, str):
+                    continue
+                name = f"sparch_{split}_{key}"
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f'{name}{{epoch="{epoch}"}} {value}')
+            with open(self.path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+        else:
+            with open(self.path, "a") as f:
+                f.write(json.dumps({"epoch": epoch, "split": split, **metrics}) + "\n")